@@ -0,0 +1,245 @@
+'''
+Cached static basemap layers of the map quick-looks.
+The static part of a map (Cartopy coastlines, gridlines, tick labels) depends only on
+the extent, the projection, the figure size and the dpi, but drawing it dominates
+the render time of a frame. It is rendered once per (extent, projection, size, dpi)
+into a transparent RGBA raster, kept in a bounded in-memory LRU cache and cached on disk
+(the least recently used files beyond max_cached_files are removed) together with the
+position of the map in the figure. A quick-look then only rasterizes the data layer
+(mesh, colorbar, title) on a plain matplotlib axes placed at the same position, and
+the basemap raster is composited on top of it.
+
+'''
+import os
+import glob
+import hashlib
+import numpy as np
+from lru_cache import LRUCache
+
+
+# folder of the rendered layers (one .npz per extent, projection, size and dpi)
+cache_folder = os.path.join(os.path.expanduser('~'), '.cache', 'itcz_basemaps')
+
+# style of the static layers, part of the cache key: change it when the style changes
+style_version = 1
+
+# position of the map and of the colorbar in the figure (fraction of the figure)
+map_rect = [0.08, 0.1, 0.7, 0.8]
+colorbar_rect = [0.86, 0.25, 0.025, 0.5]
+
+# number of layers kept in memory and on disk (one per extent, projection, size and dpi)
+max_layers = 16
+max_cached_files = 64
+
+# rendered layers of this process
+_layers = LRUCache(max_layers)
+
+
+def map_axes(fig, extent, projection='PlateCarree', rect=None):
+    """
+    Create the map axes with the static layers: extent, coastlines and gridlines.
+    Args:
+        fig (matplotlib.figure.Figure): figure where the axes are created.
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max) of the map.
+        projection (str): name of the cartopy projection of the map.
+        rect (list): position of the axes in the figure (None = one subplot filling the figure).
+    Returns:
+        ax (cartopy GeoAxes): the map axes.
+    """
+    import cartopy.crs as ccrs
+    import matplotlib.ticker as mticker
+    from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+
+    crs = getattr(ccrs, projection)()
+    if rect is None:
+        ax = fig.add_subplot(1, 1, 1, projection=crs)
+    else:
+        ax = fig.add_axes(rect, projection=crs)
+    ax.set_extent(list(extent), crs=ccrs.PlateCarree())
+    ax.coastlines(resolution="110m", linewidth=1)
+    gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+                      linewidth=1, color='black', linestyle='--')
+    gl.top_labels = False
+    gl.right_labels = False
+    gl.xlines = True
+    gl.xlocator = mticker.FixedLocator([-60, -45, -30, -15, 0, 15])
+    gl.ylocator = mticker.FixedLocator([-15, -10, -5, 0, 5, 10, 15])
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+    gl.xlabel_style = {'size': 16, 'color': 'black'}
+    gl.ylabel_style = {'size': 16, 'color': 'black'}
+    return ax
+
+def basemap_layer(extent, projection='PlateCarree', figsize=(12, 8), dpi=100, folder=None):
+    """
+    Return the static layers of a map as a transparent RGBA raster, rendering them only
+    the first time for a given (extent, projection, figsize, dpi).
+    Args:
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max) of the map.
+        projection (str): name of the cartopy projection of the map.
+        figsize (tuple): size of the figure (inches).
+        dpi (int): resolution of the figure.
+        folder (str): folder of the cached layers (default: cache_folder).
+    Returns:
+        layer (dict): 'rgba' (uint8 raster), 'position' of the map axes after the aspect
+            adjustment of Cartopy (left, bottom, width, height in figure fraction) and
+            'xlim', 'ylim' of the map in projection coordinates.
+    """
+    key = hashlib.sha1(repr((tuple(float(value) for value in extent), projection, tuple(figsize), dpi,
+                             map_rect, style_version)).encode()).hexdigest()[:16]
+    layer = _layers.get(key)
+    if layer is not None:
+        return layer
+
+    folder = folder or cache_folder
+    cache_file = os.path.join(folder, f'basemap_{key}.npz')
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as stored:
+            layer = {name: stored[name] for name in stored.files}
+        # the modification time orders the files for _prune_cache
+        os.utime(cache_file)
+    else:
+        layer = _render_basemap(extent, projection, figsize, dpi)
+        os.makedirs(folder, exist_ok=True)
+        # written to a temporary file and renamed, several processes may render the same layer
+        tmp_file = cache_file + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp_file, **layer)
+        os.replace(tmp_file, cache_file)
+        _prune_cache(folder)
+
+    _layers.put(key, layer)
+    return layer
+
+def make_quicklook(extent, lon_edges, lat_edges, cmap, norm, label, projection='PlateCarree', figsize=(12, 8), dpi=100,
+                   transparent=False):
+    """
+    Build the data layer of a quick-look: a figure without cartopy, with the mesh at the
+    position of the cached basemap, its colorbar and the title. The figure is built once
+    and reused for all the frames on the same grid (see render_quicklook).
+    Args:
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max) of the map.
+        lon_edges (numpy.ndarray): longitudes of the cell edges.
+        lat_edges (numpy.ndarray): latitudes of the cell edges.
+        cmap (matplotlib.colors.Colormap): colormap of the data.
+        norm (matplotlib.colors.Normalize): normalization of the data.
+        label (str): label of the colorbar.
+        projection (str): name of the cartopy projection of the map.
+        figsize (tuple): size of the figure (inches).
+        dpi (int): resolution of the figure.
+        transparent (bool): transparent background outside the map.
+    Returns:
+        quicklook (dict): 'fig', 'mesh', 'title' and the 'basemap' layer.
+    """
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    layer = basemap_layer(extent, projection, figsize, dpi)
+
+    # Agg figure outside pyplot: nothing to close, no interaction with the current figure
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0. if transparent else 1.)
+    ax = fig.add_axes(list(layer['position']))
+    ax.set_axis_off()
+
+    x, y = np.meshgrid(lon_edges, lat_edges)
+    if projection != 'PlateCarree':
+        # mesh in the coordinates of the projection, transformed once per grid
+        import cartopy.crs as ccrs
+        points = getattr(ccrs, projection)().transform_points(ccrs.PlateCarree(), x, y)
+        x, y = points[..., 0], points[..., 1]
+    data = np.zeros((len(lat_edges) - 1, len(lon_edges) - 1))
+    mesh = ax.pcolormesh(x, y, np.ma.masked_invalid(data), cmap=cmap, norm=norm, shading='flat')
+    ax.set_xlim(*layer['xlim'])
+    ax.set_ylim(*layer['ylim'])
+
+    cax = fig.add_axes(colorbar_rect)
+    cb = fig.colorbar(mesh, cax=cax, orientation='vertical')
+    cb.set_label(label, size=20)
+    cb.ax.tick_params(labelsize=16)
+
+    left, bottom, width, height = layer['position']
+    title = fig.text(left + width / 2, bottom + height + 0.02, '', ha='center', va='bottom',
+                     size=matplotlib.rcParams['axes.titlesize'])
+
+    return {'fig': fig, 'mesh': mesh, 'title': title, 'basemap': layer}
+
+def render_quicklook(quicklook, data, title, file_name=None):
+    """
+    Rasterize the data layer of a frame and composite the cached basemap on top of it.
+    Args:
+        quicklook (dict): figure bundle of make_quicklook.
+        data (numpy.ndarray): (lat, lon) data of the frame, on the grid of the mesh.
+        title (str): title of the frame.
+        file_name (str): path of the PNG image (None = not saved).
+    Returns:
+        rgba (numpy.ndarray): the composited image (uint8, height x width x 4).
+    """
+    import matplotlib.image as mimage
+
+    quicklook['mesh'].set_array(np.ma.masked_invalid(data))
+    quicklook['title'].set_text(title)
+    canvas = quicklook['fig'].canvas
+    canvas.draw()
+    rgba = composite(np.asarray(canvas.buffer_rgba()), quicklook['basemap']['rgba'])
+    if file_name is not None:
+        mimage.imsave(file_name, rgba)
+    return rgba
+
+def composite(under, over):
+    """
+    Alpha-composite an RGBA raster over another one ('over' operator).
+    Args:
+        under (numpy.ndarray): bottom raster (uint8 RGBA).
+        over (numpy.ndarray): top raster (uint8 RGBA, same size).
+    Returns:
+        rgba (numpy.ndarray): composited raster (uint8 RGBA).
+    """
+    under = under.astype('float32') / 255.
+    over = over.astype('float32') / 255.
+    alpha_over, alpha_under = over[..., 3:], under[..., 3:]
+    alpha = alpha_over + alpha_under * (1. - alpha_over)
+    rgb = over[..., :3] * alpha_over + under[..., :3] * alpha_under * (1. - alpha_over)
+    rgb = np.divide(rgb, alpha, out=np.zeros_like(rgb), where=alpha > 0)
+    return (np.concatenate([rgb, alpha], axis=-1) * 255. + 0.5).astype('uint8')
+
+def _prune_cache(folder, max_files=None):
+    """
+    Remove the least recently used layer files of the cache folder beyond max_files (default: max_cached_files).
+    """
+    cache_files = sorted(glob.glob(os.path.join(folder, 'basemap_*.npz')), key=os.path.getmtime, reverse=True)
+    for cache_file in cache_files[max_files or max_cached_files:]:
+        try:
+            os.remove(cache_file)
+        except FileNotFoundError:
+            # removed by another process
+            pass
+
+def _render_basemap(extent, projection, figsize, dpi):
+    """
+    Render the static layers of a map on a transparent figure.
+    Args:
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max) of the map.
+        projection (str): name of the cartopy projection of the map.
+        figsize (tuple): size of the figure (inches).
+        dpi (int): resolution of the figure.
+    Returns:
+        layer (dict): 'rgba', 'position', 'xlim' and 'ylim' (see basemap_layer).
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0.)
+    ax = map_axes(fig, extent, projection, rect=map_rect)
+    ax.patch.set_visible(False)
+    canvas.draw()
+
+    # position after the aspect adjustment applied while drawing
+    position = ax.get_position()
+    return {'rgba': np.array(canvas.buffer_rgba()),
+            'position': np.array([position.x0, position.y0, position.width, position.height]),
+            'xlim': np.array(ax.get_xlim()),
+            'ylim': np.array(ax.get_ylim())}
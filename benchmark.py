@@ -0,0 +1,551 @@
+'''
+Offline benchmark of the GridSat and IMERG pipelines.
+Synthetic files with the layout of the real ones are generated locally:
+- GridSat: NetCDF with irwin_cdr (int16, scale/offset/fill) on the global 0.07 deg grid
+  and the extra variables dropped by get_geo_gridsat (variables_to_drop)
+- IMERG: HDF5 with a Grid group containing precipitation and the other variables of
+  the half-hourly granules on the global 0.1 deg grid
+and served by a local HTTP server with configurable latency and bandwidth (with
+Range requests and a NCEI-style directory listing). Each stage of get_geo_gridsat,
+get_imerg and plot_geost (list, download, crop, compress, write, plot) is timed,
+and its throughput (files/s, MB/s) and peak memory are reported, so that
+regressions are found without NASA/NCEI access and multi-GB downloads.
+
+'''
+import os
+import time
+import json
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from http.server import SimpleHTTPRequestHandler
+
+
+def main():
+
+    # folder of the synthetic files, downloads and outputs (emptied by the user)
+    work_folder = '/tmp/itcz_benchmark'
+
+    # number of synthetic GridSat files (3-hourly) and IMERG days (48 granules each)
+    n_files_geost = 8
+    n_days_imerg = 1
+
+    # size of the synthetic grids relative to the real ones (1 = real size)
+    scale = 1.
+
+    # latency (s) and bandwidth (MB/s, None = unlimited) of the local server
+    latency = 0.05
+    bandwidth = 50.
+
+    # number of concurrent downloads
+    n_workers = 4
+
+    # compression of the cropped files
+    codec = 'zlib'
+    complevel = 9
+
+    run_benchmark(work_folder, n_files_geost=n_files_geost, n_days_imerg=n_days_imerg, scale=scale,
+                  latency=latency, bandwidth=bandwidth, n_workers=n_workers, codec=codec, complevel=complevel,
+                  report_file=os.path.join(work_folder, 'benchmark_report.json'))
+
+def run_benchmark(work_folder, n_files_geost=8, n_days_imerg=1, scale=1., latency=0.05, bandwidth=50.,
+                  n_workers=4, codec='zlib', complevel=9, trace_memory=True, report_file=None):
+    """
+    Generate the synthetic files, serve them locally and time every stage of the pipelines.
+    The download of the IMERG granules uses the same streaming download as GridSat
+    (earthaccess.download needs Earthdata Login), the IMERG search is replaced by a
+    search stub returning the synthetic granules (see get_imerg.get_granule_catalog).
+    Args:
+        work_folder (str): folder of the synthetic files, downloads and outputs.
+        n_files_geost (int): number of GridSat files.
+        n_days_imerg (int): number of IMERG days.
+        scale (float): size of the synthetic grids relative to the real ones.
+        latency (float): latency of each request to the local server (s).
+        bandwidth (float): bandwidth of each transfer from the local server (MB/s, None = unlimited).
+        n_workers (int): number of concurrent downloads.
+        codec (str): compression codec of the cropped files (see get_geo_gridsat.compression_encoding).
+        complevel (int): compression level.
+        trace_memory (bool): measure the peak memory of each stage with tracemalloc.
+        report_file (str): if given, the report is also saved in this json file.
+    Returns:
+        report (list): for each stage a dict with product, stage, seconds, files, mb,
+            files_s, mb_s and peak_mb.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from domains import domain_bounds
+    from download_utils import make_session
+    from ingest_journal import atomic_to_netcdf
+    import get_geo_gridsat
+    import get_imerg
+    import plot_geost
+
+    lat_min, lat_max, lon_min, lon_max = domain_bounds('itcz')
+    folders = {name: os.path.join(work_folder, name) for name in
+               ['remote', 'raw_geost', 'raw_imerg', 'geost', 'imerg', 'scratch', 'plots']}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+
+    # synthetic remote files (not timed)
+    remote_geost = os.path.join(folders['remote'], 'gridsat', '2024')
+    remote_imerg = os.path.join(folders['remote'], 'imerg')
+    geost_names = make_synthetic_gridsat_files(remote_geost, n_files_geost, scale=scale)
+    imerg_names = make_synthetic_imerg_files(remote_imerg, n_days_imerg, scale=scale)
+
+    server, base_url = serve_files(folders['remote'], latency=latency, bandwidth=bandwidth)
+    report = []
+    try:
+        # GridSat: list, download, crop, write (uncompressed), compress (codec and level of the run)
+        manifest_file = os.path.join(folders['scratch'], 'gridsat_manifest.json')
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        measure(report, 'geost', 'list', get_geo_gridsat.sync_manifest, base_url + 'gridsat/', ['2024'], manifest_file,
+                n_files=1, trace_memory=trace_memory)
+
+        raw_geost = [os.path.join(folders['raw_geost'], name) for name in geost_names]
+        session = make_session(pool_size=n_workers)
+        def download_all(urls, files):
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                return list(executor.map(lambda args: get_geo_gridsat.download_file(session, *args), zip(urls, files)))
+        measure(report, 'geost', 'download', download_all,
+                [base_url + 'gridsat/2024/' + name for name in geost_names], raw_geost,
+                n_files=len(raw_geost), files=[os.path.join(remote_geost, name) for name in geost_names],
+                trace_memory=trace_memory)
+
+        crops = measure(report, 'geost', 'crop',
+                        lambda: [get_geo_gridsat.read_crop_geost(file, lat_min, lat_max, lon_min, lon_max).load()
+                                 for file in raw_geost],
+                        n_files=len(raw_geost), files=raw_geost, trace_memory=trace_memory)
+        measure(report, 'geost', 'write',
+                lambda crops=crops: [get_geo_gridsat._save_crops([(ds, folders['scratch'])], name, 'none', 0)
+                         for ds, name in zip(crops, geost_names)],
+                n_files=len(crops), files=[os.path.join(folders['scratch'], name) for name in geost_names],
+                trace_memory=trace_memory)
+        measure(report, 'geost', 'compress',
+                lambda crops=crops: [get_geo_gridsat._save_crops([(ds, folders['geost'])], name, codec, complevel)
+                         for ds, name in zip(crops, geost_names)],
+                n_files=len(crops), files=[os.path.join(folders['geost'], name) for name in geost_names],
+                trace_memory=trace_memory)
+        # the lambdas take the crops as default argument, the crops are freed here
+        del crops
+
+        # IMERG: list (catalog from the search stub), download, crop, write
+        days = sorted({granule_day(name) for name in imerg_names})
+        catalog_file = os.path.join(folders['scratch'], 'granule_catalog.json')
+        if os.path.exists(catalog_file):
+            os.remove(catalog_file)
+        search = lambda start, end, domain: [SyntheticGranule(base_url + 'imerg/' + name,
+                                                              os.path.getsize(os.path.join(remote_imerg, name)))
+                                             for name in imerg_names]
+        catalog = measure(report, 'imerg', 'list', get_imerg.get_granule_catalog, days[0], days[-1],
+                          [lon_min, lat_min, lon_max, lat_max], catalog_file, search=search,
+                          n_files=1, trace_memory=trace_memory)
+
+        for day in days:
+            urls = [granule['url'] for granule in catalog[day]]
+            raw_imerg = [os.path.join(folders['raw_imerg'], url.split('/')[-1]) for url in urls]
+            measure(report, 'imerg', 'download', download_all, urls, raw_imerg,
+                    n_files=len(raw_imerg), files=[os.path.join(remote_imerg, url.split('/')[-1]) for url in urls],
+                    trace_memory=trace_memory)
+            ds = measure(report, 'imerg', 'crop',
+                         lambda: get_imerg.read_and_crop_dataset(raw_imerg, lat_min, lat_max, lon_min, lon_max).load(),
+                         n_files=len(raw_imerg), files=raw_imerg, trace_memory=trace_memory)
+            file_name = os.path.join(folders['imerg'], day + '_imerg_30min_ITCZ.nc')
+            measure(report, 'imerg', 'write', atomic_to_netcdf, ds, file_name, mode='w',
+                    n_files=1, files=[file_name], trace_memory=trace_memory)
+        session.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # plot: quick-looks of all the GridSat time steps (rendered in a child process)
+    frames = [os.path.join(folders['plots'], name) for name in os.listdir(folders['plots'])]
+    for frame in frames:
+        os.remove(frame)
+    measure(report, 'plot', 'plot', plot_geost.render_batch, '2024-01-01', '2024-12-31T23:59',
+            folders['geost'], folders['imerg'], folders['plots'], lat_min, lat_max, lon_min, lon_max, n_processes=1,
+            n_files=n_files_geost, trace_memory=trace_memory)
+
+    print_report(report)
+    if report_file is not None:
+        with open(report_file, 'w') as file:
+            json.dump({'settings': {'n_files_geost': n_files_geost, 'n_days_imerg': n_days_imerg, 'scale': scale,
+                                    'latency': latency, 'bandwidth': bandwidth, 'n_workers': n_workers,
+                                    'codec': codec, 'complevel': complevel},
+                       'max_rss_mb': max_rss_mb(),
+                       'stages': report}, file, indent=1)
+        print('Benchmark report saved to', report_file)
+
+    return report
+
+def measure(report, product, stage, function, *args, n_files=0, files=None, trace_memory=True, **kwargs):
+    """
+    Run a stage, time it and append its throughput and peak memory to the report.
+    Args:
+        report (list): report of the benchmark, one dict per stage.
+        product (str): 'geost', 'imerg' or 'plot'.
+        stage (str): name of the stage.
+        function (function): function running the stage, called with *args and **kwargs.
+        n_files (int): number of files processed by the stage.
+        files (list): files whose total size is the volume processed by the stage (read after the stage).
+        trace_memory (bool): measure the peak of the python/numpy allocations with tracemalloc.
+    Returns:
+        result: the result of function.
+    """
+    import tracemalloc
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if trace_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+    mb = sum(os.path.getsize(file) for file in (files or []) if os.path.exists(file)) / 1e6
+    report.append({'product': product,
+                   'stage': stage,
+                   'seconds': seconds,
+                   'files': n_files,
+                   'mb': mb,
+                   'files_s': n_files / seconds if seconds > 0 else None,
+                   'mb_s': mb / seconds if seconds > 0 else None,
+                   'peak_mb': peak_mb})
+    return result
+
+def print_report(report):
+    """
+    Print the report of the benchmark as a table.
+    Args:
+        report (list): report of the benchmark (see measure).
+    """
+    print(f"{'product':>8} {'stage':>9} {'time [s]':>9} {'files':>6} {'MB':>9} {'files/s':>8} {'MB/s':>8} {'peak [MB]':>10}")
+    for line in report:
+        peak = f"{line['peak_mb']:>10.1f}" if line['peak_mb'] is not None else f"{'-':>10}"
+        print(f"{line['product']:>8} {line['stage']:>9} {line['seconds']:>9.3f} {line['files']:>6} {line['mb']:>9.1f} "
+              f"{line['files_s'] or 0:>8.2f} {line['mb_s'] or 0:>8.1f} {peak}")
+    print(f"maximum resident memory: {max_rss_mb():.0f} MB (benchmark) and {max_rss_mb(children=True):.0f} MB (child processes)")
+
+def max_rss_mb(children=False):
+    """
+    Maximum resident memory of the benchmark process (or of its child processes) since it started.
+    Args:
+        children (bool): report the largest child process (crop and plot pools) instead.
+    Returns:
+        (float): maximum resident memory in MB.
+    """
+    import resource
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # kilobytes on linux
+    return usage.ru_maxrss / 1e3
+
+def make_synthetic_gridsat_files(folder, n_files, start=datetime(2024, 1, 1), scale=1., seed=0):
+    """
+    Write synthetic GridSat-B1 files, one every 3 hours, with the variables and
+    encoding of the real files: irwin_cdr and the extra channels are int16 with
+    scale_factor, add_offset and _FillValue on the global 0.07 deg grid, the
+    satellite ids are bytes. Files already in the folder are kept.
+    Args:
+        folder (str): output folder (the remote directory of the year).
+        n_files (int): number of files.
+        start (datetime): time of the first file.
+        scale (float): size of the grid relative to the real one.
+        seed (int): seed of the random fields.
+    Returns:
+        file_names (list): names of the files.
+    """
+    import xarray as xr
+    from get_geo_gridsat import variables_to_drop
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_lat, n_lon = int(2000 * scale), int(5143 * scale)
+    lat = np.linspace(-70, 70, n_lat, endpoint=False, dtype='float32') + 70. / n_lat
+    lon = np.linspace(-180, 180, n_lon, endpoint=False, dtype='float32') + 180. / n_lon
+
+    file_names = []
+    for i in range(n_files):
+        time = start + timedelta(hours=3 * i)
+        file_name = time.strftime('GRIDSAT-B1.%Y.%m.%d.%H.v02r01.nc')
+        file_names.append(file_name)
+        path = os.path.join(folder, file_name)
+        if os.path.exists(path):
+            continue
+
+        # warm background with cold convective clusters around the ITCZ
+        bt = 290. - 15. * (lat[:, None] / 70.) ** 2 + rng.normal(0, 2, (n_lat, n_lon)).astype('float32')
+        bt = bt - 80. * (rng.random((n_lat, n_lon)) < 0.05 * np.exp(-(lat[:, None] / 10.) ** 2))
+        data_vars = {'irwin_cdr': (('time', 'lat', 'lon'), bt[None].astype('float32'))}
+        encoding = {'irwin_cdr': {'dtype': 'int16', 'scale_factor': 0.01, 'add_offset': 200., '_FillValue': -31999,
+                                  'zlib': True, 'complevel': 4, 'chunksizes': (1, min(n_lat, 500), min(n_lon, 500))}}
+        for name in set(variables_to_drop) | {'sparse3ir', 'irwvp_2'}:
+            if name.startswith('satid') or name.startswith('sparse'):
+                data_vars[name] = (('time', 'lat', 'lon'), rng.integers(0, 20, (1, n_lat, n_lon), dtype='int8'))
+                encoding[name] = {'zlib': True, 'complevel': 4}
+            else:
+                data_vars[name] = (('time', 'lat', 'lon'), (bt[None] + rng.normal(0, 1, (1, n_lat, n_lon))).astype('float32'))
+                encoding[name] = {'dtype': 'int16', 'scale_factor': 0.01, 'add_offset': 200., '_FillValue': -31999,
+                                  'zlib': True, 'complevel': 4}
+        ds = xr.Dataset(data_vars, coords={'time': [time], 'lat': lat, 'lon': lon})
+        encoding['time'] = {'units': 'days since 1970-01-01 00:00:00', 'calendar': 'julian'}
+        ds.to_netcdf(path + '.tmp', encoding=encoding)
+        os.replace(path + '.tmp', path)
+
+    return file_names
+
+def make_synthetic_imerg_files(folder, n_days, start=datetime(2024, 1, 1), scale=1., seed=0):
+    """
+    Write synthetic IMERG half-hourly granules (48 per day) as HDF5 files with a
+    Grid group, (time, lon, lat) variables on the global 0.1 deg grid and the
+    names of the GPM_3IMERGHH V07 granules. Files already in the folder are kept.
+    Args:
+        folder (str): output folder.
+        n_days (int): number of days.
+        start (datetime): first day.
+        scale (float): size of the grid relative to the real one.
+        seed (int): seed of the random fields.
+    Returns:
+        file_names (list): names of the granules.
+    """
+    import xarray as xr
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_lat, n_lon = int(1800 * scale), int(3600 * scale)
+    lat = np.linspace(-90, 90, n_lat, endpoint=False, dtype='float32') + 90. / n_lat
+    lon = np.linspace(-180, 180, n_lon, endpoint=False, dtype='float32') + 180. / n_lon
+
+    file_names = []
+    for i in range(48 * n_days):
+        time = start + timedelta(minutes=30 * i)
+        file_name = (time.strftime('3B-HHR.MS.MRG.3IMERG.%Y%m%d-S%H%M%S-E')
+                     + (time + timedelta(minutes=29, seconds=59)).strftime('%H%M%S')
+                     + f'.{(i % 48) * 30:04d}.V07B.HDF5')
+        file_names.append(file_name)
+        path = os.path.join(folder, file_name)
+        if os.path.exists(path):
+            continue
+
+        # mostly dry, with rain in a band around the equator
+        rain = rng.gamma(0.5, 2., (n_lon, n_lat)).astype('float32')
+        rain = np.where(rng.random((n_lon, n_lat)) < 0.1 + 0.3 * np.exp(-(lat[None, :] / 10.) ** 2), rain, 0.)
+        dims = ('time', 'lon', 'lat')
+        ds = xr.Dataset({
+            'precipitation': (dims, rain[None].astype('float32')),
+            'randomError': (dims, (0.5 * rain[None]).astype('float32')),
+            'probabilityLiquidPrecipitation': (dims, rng.integers(0, 100, (1, n_lon, n_lat), dtype='int16')),
+            'precipitationQualityIndex': (dims, rng.random((1, n_lon, n_lat), dtype='float32')),
+            'precipitationUncal': (dims, rain[None].astype('float32')),
+            'MWprecipitation': (dims, rain[None].astype('float32')),
+            'IRprecipitation': (dims, rain[None].astype('float32')),
+            'IRinfluence': (dims, rng.integers(0, 100, (1, n_lon, n_lat), dtype='int16')),
+        }, coords={'time': [time], 'lon': lon, 'lat': lat})
+        encoding = {name: {'zlib': True, 'complevel': 4, 'chunksizes': (1, min(n_lon, 145), n_lat)}
+                    for name in ds.data_vars}
+        for name in ['precipitation', 'randomError', 'precipitationQualityIndex',
+                     'precipitationUncal', 'MWprecipitation', 'IRprecipitation']:
+            encoding[name]['_FillValue'] = np.float32(-9999.9)
+        encoding['time'] = {'units': 'seconds since 1970-01-01 00:00:00 UTC', 'calendar': 'julian'}
+        ds.to_netcdf(path + '.tmp', group='Grid', engine='h5netcdf', encoding=encoding)
+        os.replace(path + '.tmp', path)
+
+    return file_names
+
+def granule_day(file_name):
+    """
+    Day of an IMERG granule from its name.
+    Args:
+        file_name (str): name of the granule (3B-HHR.MS.MRG.3IMERG.YYYYMMDD-S...).
+    Returns:
+        day (str): day in the format 'YYYY-MM-DD'.
+    """
+    date = file_name.split('.')[4][:8]
+    return date[:4] + '-' + date[4:6] + '-' + date[6:]
+
+class SyntheticGranule(dict):
+    """
+    Granule returned by the search stub, with the interface of earthaccess.DataGranule
+    used by get_imerg.granule_record.
+    """
+    def __init__(self, url, size):
+        name = url.split('/')[-1]
+        day = granule_day(name)
+        hhmmss = name.split('.')[4][10:16]
+        super().__init__(umm={'GranuleUR': name,
+                              'TemporalExtent': {'RangeDateTime': {
+                                  'BeginningDateTime': f'{day}T{hhmmss[:2]}:{hhmmss[2:4]}:{hhmmss[4:]}.000Z'}}})
+        self.url = url
+        self.size_bytes = size
+
+    def data_links(self):
+        return [self.url]
+
+    def size(self):
+        return self.size_bytes / 1e6
+
+def serve_files(folder, latency=0., bandwidth=None, port=0, credentials=None):
+    """
+    Serve the files of a folder with a local HTTP server running in a thread.
+    Each request waits latency seconds, transfers are throttled to bandwidth,
+    Range requests are supported (resumed downloads, remote subsets) and the
+    directories are listed as a NCEI-style table (see get_geo_gridsat.parse_listing).
+    With credentials, the server also stands in for Earthdata Login: requests without
+    the session cookie are redirected to /urs/authorize on the host 'localhost', which
+    checks the basic authentication, and back to the file with a cookie
+    (use auth_host='localhost' in subset_ingest).
+    Args:
+        folder (str): root folder of the server.
+        latency (float): latency of each request (s).
+        bandwidth (float): bandwidth of each transfer (MB/s, None = unlimited).
+        port (int): port of the server (0 = any free port).
+        credentials (tuple): (user, password) required by the login (None = no login).
+    Returns:
+        server (http.server.ThreadingHTTPServer): the running server (stop it with shutdown()).
+        base_url (str): URL of the root folder, ending with '/'.
+    """
+    from functools import partial
+    from http.server import ThreadingHTTPServer
+
+    handler = type('Handler', (_ThrottledHandler,), {'latency': latency, 'bandwidth': bandwidth,
+                                                     'credentials': credentials})
+    server = ThreadingHTTPServer(('127.0.0.1', port), partial(handler, directory=folder))
+    thread = threading.Thread(target=server.serve_forever, name='benchmark_server', daemon=True)
+    thread.start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+class _ThrottledHandler(SimpleHTTPRequestHandler):
+    """
+    Request handler of serve_files: static files with latency, bandwidth limit and Range requests,
+    behind an Earthdata Login-like redirection if credentials are set.
+    """
+    latency = 0.
+    bandwidth = None
+    credentials = None
+    chunk_size = 64 * 1024
+    cookie_name = 'urs_stand_in_session'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        time.sleep(self.latency)
+        if self.credentials is not None and not self._logged_in():
+            return
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return self._send_listing(path, send_body)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        range_header = self.headers.get('Range')
+        if range_header is not None and range_header.startswith('bytes='):
+            start, _, end = range_header[len('bytes='):].split(',')[0].partition('-')
+            if start == '':
+                first = max(size - int(end), 0)
+            else:
+                first = int(start)
+                last = min(int(end), size - 1) if end else size - 1
+            if first >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(last - first + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', self.date_time_string(os.path.getmtime(path)))
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(path, 'rb') as file:
+            file.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                started = time.perf_counter()
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                if self.bandwidth:
+                    time.sleep(max(len(chunk) / (self.bandwidth * 1e6) - (time.perf_counter() - started), 0))
+
+    def _logged_in(self):
+        """
+        Login stand-in: returns True if the request carries the session cookie, otherwise
+        answers with the redirection of the login flow and returns False.
+        """
+        import base64
+        from http.cookies import SimpleCookie
+        from urllib.parse import urlparse, parse_qs, quote
+
+        port = self.server.server_address[1]
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path == '/urs/authorize':
+            # login host: check the basic authentication and send back to the data host
+            user, password = self.credentials
+            expected = 'Basic ' + base64.b64encode(f'{user}:{password}'.encode()).decode()
+            if self.headers.get('Authorization') != expected:
+                self.send_response(401)
+                self.send_header('WWW-Authenticate', 'Basic realm="Please enter your Earthdata Login credentials"')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return False
+            self._redirect(f'http://127.0.0.1:{port}/urs/callback?redirect={quote(query["redirect"][0])}')
+            return False
+        if parsed.path == '/urs/callback':
+            # data host: set the session cookie and send back to the file
+            self.send_response(302)
+            self.send_header('Set-Cookie', f'{self.cookie_name}=ok; Path=/')
+            self.send_header('Location', query['redirect'][0])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+        cookies = SimpleCookie(self.headers.get('Cookie', ''))
+        if self.cookie_name in cookies:
+            return True
+        self._redirect(f'http://localhost:{port}/urs/authorize?redirect={quote(self.path)}')
+        return False
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_listing(self, path, send_body):
+        rows = []
+        for name in sorted(os.listdir(path)):
+            full_path = os.path.join(path, name)
+            href = name + '/' if os.path.isdir(full_path) else name
+            mtime = datetime.utcfromtimestamp(os.path.getmtime(full_path)).strftime('%Y-%m-%d %H:%M')
+            size = f'{os.path.getsize(full_path) / 1e6:.1f}M' if os.path.isfile(full_path) else '-'
+            rows.append(f'<tr><td><a href="{href}">{href}</a></td><td>{mtime}</td><td>{size}</td></tr>')
+        body = ('<html><body><table>' + ''.join(rows) + '</table></body></html>').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    main()
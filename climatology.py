@@ -0,0 +1,331 @@
+'''
+Out-of-core streaming climatology of the cropped IMERG and GridSat archives.
+The files of a year are read one time step at a time and added to running
+accumulators (sums and counts) stored as memory-mapped .npy files in a state folder:
+- daily, monthly and diurnal-cycle sums and counts of precipitation / brightness temperature
+- cold-cloud counts (BT below a threshold, GridSat only) on the same periods
+- the ITCZ latitude for each longitude and time step: precipitation-weighted mean
+  latitude (IMERG) or mean latitude of the cold-cloud pixels (GridSat)
+Memory is bounded by the time steps of one file plus the staged fields of a batch of files.
+The new values of the accumulators touched by a batch of files (one daily IMERG file, one
+day of 3-hourly GridSat files) are staged in memory and committed together with the files
+in the list of processed files (through a write-ahead log, see _commit), so a run stopped
+at any point never counts a file twice. The state remembers the processed files, so
+new days are added incrementally instead of recomputing the whole year. Means are derived from the state with climatology_dataset and written
+one day at a time with write_climatology.
+
+'''
+import os
+import json
+import glob
+import numpy as np
+from datetime import datetime
+
+
+# variable, number of time steps per day and number of files per commit (see _commit) of each product
+product_settings = {
+    'imerg': {'variable': 'precipitation', 'steps_per_day': 48, 'commit_files': 1},
+    'geost': {'variable': 'irwin_cdr', 'steps_per_day': 8, 'commit_files': 8},
+}
+
+
+def update_climatology(folder, product, year, state_folder, bt_threshold=235., commit_files=None):
+    """
+    Add to the climatology state the files of a year that were not processed yet.
+    Args:
+        folder (str): folder of the cropped files of the product.
+        product (str): 'imerg' or 'geost'.
+        year (int): year of the climatology.
+        state_folder (str): folder of the accumulators.
+        bt_threshold (float): brightness temperature threshold of cold clouds (K).
+        commit_files (int): number of files staged before each commit (None = commit_files of product_settings).
+    Returns:
+        n_files (int): number of files added.
+    """
+    import xarray as xr
+    from time_index import file_patterns, to_standard_calendar
+
+    settings = product_settings[product]
+    state = _load_state(state_folder)
+    if product == 'geost' and state.get('bt_threshold', bt_threshold) != bt_threshold:
+        # the cold-cloud counts of the processed files were computed with the stored threshold
+        raise ValueError(f"The state in {state_folder} was computed with bt_threshold={state['bt_threshold']}, "
+                         f"rebuild the climatology in a new state folder to use {bt_threshold}")
+    state['bt_threshold'] = bt_threshold
+
+    # complete the commit of the files interrupted by the previous run
+    accumulators = None
+    if os.path.exists(os.path.join(state_folder, 'pending.npz')):
+        accumulators = _open_accumulators(state_folder, state, state['product'], state['year'],
+                                          np.array(state['lat']), np.array(state['lon']))
+        _apply_pending(state_folder, state, accumulators)
+
+    new_files = []
+    for path in sorted(glob.glob(os.path.join(folder, file_patterns[product]))):
+        name = os.path.basename(path)
+        if name not in state['files']:
+            new_files.append(path)
+        elif state['files'][name] != os.path.getmtime(path):
+            # the sums cannot remove the old contribution of a file
+            print(f"File modified after it was processed, rebuild the climatology to include it: {name}")
+
+    commit_files = commit_files or settings['commit_files']
+    staged = {}
+    batch = {}
+    for k, path in enumerate(new_files):
+        with xr.open_dataset(path, use_cftime=True) as ds:
+            data = ds[settings['variable']].transpose('time', 'lat', 'lon')
+            if accumulators is None:
+                accumulators = _open_accumulators(state_folder, state, product, year,
+                                                  ds['lat'].values, ds['lon'].values)
+            for i in range(data.sizes['time']):
+                time = to_standard_calendar(data['time'].values[i])
+                if time.year != year:
+                    continue
+                _stage(accumulators, staged, product, time, data[i].values.astype('float32'),
+                       ds['lat'].values, settings['steps_per_day'], bt_threshold)
+        batch[os.path.basename(path)] = os.path.getmtime(path)
+        if len(batch) == commit_files or k == len(new_files) - 1:
+            _commit(state_folder, state, accumulators, staged, batch)
+            print(f"Climatology updated with: {', '.join(batch)}")
+            staged = {}
+            batch = {}
+
+    return len(new_files)
+
+def climatology_dataset(state_folder):
+    """
+    Build the climatology products from the accumulators, as lazy (dask) arrays read from the
+    memory-mapped accumulators one day, month or hour at a time: nothing is computed before the
+    dataset is written (see write_climatology) or loaded.
+    Args:
+        state_folder (str): folder of the accumulators.
+    Returns:
+        ds (xarray.Dataset): daily, monthly and diurnal means, cold-cloud fractions (GridSat)
+            and ITCZ latitude per longitude and time step.
+    """
+    import dask.array as da
+    import xarray as xr
+
+    state = _load_state(state_folder)
+    product, year = state['product'], state['year']
+    steps_per_day = product_settings[product]['steps_per_day']
+    lat = np.array(state['lat'])
+    lon = np.array(state['lon'])
+    dims = {'daily': 'day', 'monthly': 'month', 'diurnal': 'hour'}
+
+    def accumulator(name):
+        array = np.load(os.path.join(state_folder, name + '.npy'), mmap_mode='r')
+        if name == 'itcz_lat':
+            return xr.DataArray(da.from_array(array, chunks=(steps_per_day, -1)), dims=('time', 'lon'))
+        return xr.DataArray(da.from_array(array, chunks=(1, -1, -1)), dims=(dims[name.split('_')[0]], 'lat', 'lon'))
+
+    def mean(total, count):
+        # NaN where nothing was counted
+        return total / count.where(count > 0)
+
+    data_vars = {'itcz_lat': accumulator('itcz_lat')}
+    for period in dims:
+        count = accumulator(period + '_count')
+        data_vars[f'{period}_mean'] = mean(accumulator(period + '_sum'), count)
+        if product == 'geost':
+            data_vars[f'{period}_cold_fraction'] = mean(accumulator(period + '_cold'), count)
+
+    days = np.arange(np.datetime64(f'{year}-01-01'), np.datetime64(f'{year + 1}-01-01'))
+    steps = np.datetime64(f'{year}-01-01T00:00') + np.arange(data_vars['itcz_lat'].shape[0]) * np.timedelta64(1440 // steps_per_day, 'm')
+    hours = np.arange(steps_per_day) * 24. / steps_per_day
+
+    ds = xr.Dataset(data_vars, coords={'day': days, 'month': np.arange(1, 13), 'hour': hours,
+                                       'time': steps, 'lat': lat, 'lon': lon})
+    ds.attrs['product'] = product
+    if product == 'geost':
+        ds.attrs['bt_threshold'] = state['bt_threshold']
+    return ds
+
+def write_climatology(state_folder, output_file):
+    """
+    Write the climatology products to a netCDF file, one chunk (day, month or hour) at a time,
+    so that memory is bounded by one (lat, lon) field per variable.
+    Args:
+        state_folder (str): folder of the accumulators.
+        output_file (str): path of the netCDF file.
+    """
+    ds = climatology_dataset(state_folder)
+    ds.to_netcdf(output_file + '.tmp')
+    os.replace(output_file + '.tmp', output_file)
+    print(f"Climatology saved to: {output_file}")
+
+def itcz_latitude(field, lat, product, bt_threshold=235.):
+    """
+    ITCZ latitude for each longitude of one time step.
+    Args:
+        field (numpy.ndarray): (lat, lon) precipitation (IMERG) or brightness temperature (GridSat).
+        lat (numpy.ndarray): latitudes.
+        product (str): 'imerg' or 'geost'.
+        bt_threshold (float): brightness temperature threshold of cold clouds (K).
+    Returns:
+        itcz_lat (numpy.ndarray): (lon) precipitation-weighted latitude (IMERG) or mean latitude
+            of the cold-cloud pixels (GridSat), NaN where there is no rain / cold cloud.
+    """
+    if product == 'imerg':
+        weights = np.where(np.isfinite(field) & (field > 0), field, 0.)
+    else:
+        weights = (np.isfinite(field) & (field < bt_threshold)).astype('float32')
+    total = weights.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, (weights * lat[:, None]).sum(axis=0) / total, np.nan)
+
+def _stage(acc, staged, product, time, field, lat, steps_per_day, bt_threshold):
+    """
+    Add one time step to the staged values of the accumulators (the accumulators are not modified).
+    Args:
+        acc (dict): memory-mapped accumulators.
+        staged (dict): new values {(accumulator, index): array} of the files being processed, updated in place.
+        product (str): 'imerg' or 'geost'.
+        time (datetime.datetime): time of the step (standard calendar).
+        field (numpy.ndarray): (lat, lon) field of the time step.
+        lat (numpy.ndarray): latitudes.
+        steps_per_day (int): number of time steps per day of the product.
+        bt_threshold (float): brightness temperature threshold of cold clouds (K).
+    """
+    day = time.timetuple().tm_yday - 1
+    month = time.month - 1
+    slot = (time.hour * 60 + time.minute) * steps_per_day // 1440
+    step = day * steps_per_day + slot
+
+    def add(name, index, values):
+        if (name, index) not in staged:
+            staged[(name, index)] = np.array(acc[name][index])
+        staged[(name, index)] += values
+
+    valid = np.isfinite(field)
+    values = np.where(valid, field, 0.)
+    for period, index in (('daily', day), ('monthly', month), ('diurnal', slot)):
+        add(period + '_sum', index, values)
+        add(period + '_count', index, valid)
+    if product == 'geost':
+        cold = valid & (field < bt_threshold)
+        for period, index in (('daily', day), ('monthly', month), ('diurnal', slot)):
+            add(period + '_cold', index, cold)
+
+    staged[('itcz_lat', step)] = itcz_latitude(field, lat, product, bt_threshold)
+
+def _commit(state_folder, state, acc, staged, files):
+    """
+    Write the staged values of a batch of files to the accumulators and add the files to the processed files.
+    The staged values are first saved to pending.npz: if the run stops before the state
+    is saved, the next run writes them again (they are new values, not increments, so
+    writing them twice gives the same accumulators).
+    Args:
+        state_folder (str): folder of the accumulators.
+        state (dict): state of the climatology.
+        acc (dict): memory-mapped accumulators.
+        staged (dict): new values {(accumulator, index): array} of the files.
+        files (dict): modification time of each file of the batch.
+    """
+    keys = list(staged)
+    meta = {'files': files, 'keys': keys}
+    pending_file = os.path.join(state_folder, 'pending.npz')
+    with open(pending_file + '.tmp', 'wb') as file:
+        np.savez(file, *[staged[key] for key in keys], meta=np.array(json.dumps(meta)))
+    os.replace(pending_file + '.tmp', pending_file)
+    _apply_pending(state_folder, state, acc)
+
+def _apply_pending(state_folder, state, acc):
+    """
+    Write the values of pending.npz to the accumulators, flush them, save the state with
+    the files of the values and remove pending.npz.
+    Args:
+        state_folder (str): folder of the accumulators.
+        state (dict): state of the climatology (updated with the files).
+        acc (dict): memory-mapped accumulators.
+    """
+    pending_file = os.path.join(state_folder, 'pending.npz')
+    with np.load(pending_file) as pending:
+        meta = json.loads(str(pending['meta']))
+        for k, (name, index) in enumerate(meta['keys']):
+            acc[name][index] = pending[f'arr_{k}']
+    for array in acc.values():
+        array.flush()
+    state['files'].update(meta['files'])
+    _save_state(state_folder, state)
+    os.remove(pending_file)
+
+def _accumulator_shapes(product, year, n_lat, n_lon):
+    """
+    Shapes of the accumulators of a product.
+    Args:
+        product (str): 'imerg' or 'geost'.
+        year (int): year of the climatology.
+        n_lat, n_lon (int): size of the grid.
+    Returns:
+        shapes (dict): shape of each accumulator.
+    """
+    n_days = (datetime(year + 1, 1, 1) - datetime(year, 1, 1)).days
+    steps_per_day = product_settings[product]['steps_per_day']
+    shapes = {}
+    for period, size in (('daily', n_days), ('monthly', 12), ('diurnal', steps_per_day)):
+        shapes[period + '_sum'] = (size, n_lat, n_lon)
+        shapes[period + '_count'] = (size, n_lat, n_lon)
+        if product == 'geost':
+            shapes[period + '_cold'] = (size, n_lat, n_lon)
+    shapes['itcz_lat'] = (n_days * steps_per_day, n_lon)
+    return shapes
+
+def _open_accumulators(state_folder, state, product, year, lat, lon):
+    """
+    Open the memory-mapped accumulators, creating them at the first call.
+    Args:
+        state_folder (str): folder of the accumulators.
+        state (dict): state of the climatology (updated with product, year and grid).
+        product (str): 'imerg' or 'geost'.
+        year (int): year of the climatology.
+        lat, lon (numpy.ndarray): grid of the product.
+    Returns:
+        acc (dict): memory-mapped accumulators.
+    """
+    if 'product' in state and (state['product'] != product or state['year'] != year):
+        raise ValueError(f"The state in {state_folder} is for {state['product']} {state['year']}")
+    state.update({'product': product, 'year': year, 'lat': lat.tolist(), 'lon': lon.tolist()})
+    os.makedirs(state_folder, exist_ok=True)
+
+    acc = {}
+    for name, shape in _accumulator_shapes(product, year, len(lat), len(lon)).items():
+        path = os.path.join(state_folder, name + '.npy')
+        if os.path.exists(path):
+            acc[name] = np.load(path, mmap_mode='r+')
+        else:
+            dtype = 'float64' if name.endswith('_sum') else 'float32' if name == 'itcz_lat' else 'int32'
+            acc[name] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+            if name == 'itcz_lat':
+                acc[name][:] = np.nan
+    # grid of the accumulators, needed to reopen them if the run stops during the first file
+    _save_state(state_folder, state)
+    return acc
+
+def _load_state(state_folder):
+    """
+    Read the state of a climatology (processed files, product, year, grid).
+    Args:
+        state_folder (str): folder of the accumulators.
+    Returns:
+        state (dict): the state, with an empty list of files for a new climatology.
+    """
+    state_file = os.path.join(state_folder, 'state.json')
+    if not os.path.exists(state_file):
+        return {'files': {}}
+    with open(state_file, 'r') as file:
+        return json.load(file)
+
+def _save_state(state_folder, state):
+    """
+    Write the state of a climatology (after the accumulators have been flushed).
+    Args:
+        state_folder (str): folder of the accumulators.
+        state (dict): the state.
+    """
+    os.makedirs(state_folder, exist_ok=True)
+    state_file = os.path.join(state_folder, 'state.json')
+    with open(state_file + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(state_file + '.tmp', state_file)
@@ -0,0 +1,349 @@
+'''
+Detection and tracking of cold cloud objects (deep convection) in the cropped GridSat files.
+The GridSat slots of a period are streamed one at a time with the matched IMERG
+precipitation (see temporal_join.py), and for each slot:
+- the pixels with brightness temperature below a threshold (235 K) are labeled into
+  connected objects (8-connectivity, scipy.ndimage.label)
+- area, minimum and mean BT, area-weighted centroid and the collocated IMERG rain
+  (nearest IMERG cell of each GridSat pixel) of all the objects are computed at once
+  with bincount / labeled reductions
+- the objects are linked to the objects of the previous slot (3 hours before) by their
+  pixel overlap: each object continues the track of the previous object it overlaps most,
+  the largest object continues a track that splits, the others start new tracks
+Only the objects of the current and of the previous slot and the aggregates of the active
+tracks are kept in memory. Objects and ended tracks are written as compact columnar tables
+(parquet, one part per block of slots) instead of gridded fields.
+
+'''
+import os
+import numpy as np
+
+
+# object table columns and their types
+object_columns = {
+    'object_id': 'int64', 'track_id': 'int64', 'time': 'datetime64[s]',
+    'area_km2': 'float32', 'n_pixels': 'int32', 'bt_min': 'float32', 'bt_mean': 'float32',
+    'lat': 'float32', 'lon': 'float32', 'rain_mean': 'float32', 'rain_max': 'float32',
+    'rain_volume': 'float32', 'parent_id': 'int64', 'overlap': 'float32',
+}
+
+# length of a degree of latitude (km)
+km_per_degree = 111.32
+
+
+def main():
+
+    url_itcz = '/data/trade_pc/ITCZ/2024'
+    path_geost = url_itcz + '/geost/'
+    path_imerg = url_itcz + '/imerg/'
+
+    # tables of the objects and of the tracks
+    output_folder = url_itcz + '/cloud_objects'
+
+    # cold cloud threshold (K) and smallest object kept (km2)
+    bt_threshold = 235.
+    min_area = 1000.
+
+    track_objects(path_geost, path_imerg, '2024-01-01', '2024-12-31T23:59', output_folder,
+                  bt_threshold=bt_threshold, min_area=min_area)
+
+def track_objects(path_geost, path_imerg, start, end, output_folder, bt_threshold=235., min_area=1000.,
+                  min_overlap=0.25, max_gap=np.timedelta64(3, 'h'), mode='window-mean', block_slots=248):
+    """
+    Detect and track the cold cloud objects of a period in one pass over the GridSat slots.
+    Args:
+        path_geost (str): folder of the cropped GridSat files.
+        path_imerg (str): folder of the cropped IMERG files.
+        start (str): first time in ISO format (e.g. '2024-01-01').
+        end (str): last time in ISO format (e.g. '2024-12-31T23:59').
+        output_folder (str): folder of the object and track tables.
+        bt_threshold (float): brightness temperature threshold of the cold clouds (K).
+        min_area (float): objects smaller than min_area (km2) are discarded.
+        min_overlap (float): minimum overlap, as a fraction of the smaller object, to link two objects.
+        max_gap (numpy.timedelta64): slots further apart are not linked (missing slots end the tracks).
+        mode (str): matching of the IMERG time steps (see temporal_join.join_modes).
+        block_slots (int): number of slots in each part of the object table (248 = one month).
+    Returns:
+        n_objects (int): number of objects detected.
+        n_tracks (int): number of tracks.
+    """
+    from temporal_join import iterate_pairs
+
+    os.makedirs(output_folder, exist_ok=True)
+    rows = []
+    active = {}
+    tracks = []
+    previous = None
+    counters = {'object_id': 0, 'track_id': 0, 'part': 0, 'track_part': 0}
+    rain_index = None
+    n_objects = 0
+    n_tracks = 0
+
+    for i, (time, ds_geost, ds_imerg) in enumerate(iterate_pairs(path_geost, path_imerg, start, end, mode=mode)):
+        bt = ds_geost['irwin_cdr'].transpose('lat', 'lon').values.astype('float32')
+        lat, lon = ds_geost['lat'].values, ds_geost['lon'].values
+        if rain_index is None:
+            rain_index = nearest_cells(lat, lon, ds_imerg['lat'].values, ds_imerg['lon'].values)
+            pixel_area = pixel_areas(lat, lon)
+        rain = ds_imerg['precipitation'].transpose('lat', 'lon').values.astype('float32')
+        rain = np.where(rain_index[2], rain[rain_index[0], rain_index[1]], np.nan)
+
+        labels, objects = detect_objects(bt, rain, lat, lon, pixel_area, bt_threshold, min_area)
+        objects['object_id'] = counters['object_id'] + np.arange(1, len(objects['n_pixels']) + 1)
+        counters['object_id'] += len(objects['n_pixels'])
+
+        # link to the previous slot if it is close enough in time
+        linked = previous is not None and time - previous['time'] <= max_gap
+        if linked:
+            parent, overlap = link_objects(previous['labels'], previous['n_pixels'], labels, objects['n_pixels'], min_overlap)
+        else:
+            parent = np.zeros(len(objects['n_pixels']), dtype='int64')
+            overlap = np.zeros(len(objects['n_pixels']), dtype='float32')
+        objects['time'] = np.full(len(objects['n_pixels']), time, dtype='datetime64[s]')
+        objects['track_id'] = _assign_tracks(objects, parent, overlap, previous, active, counters)
+        # object id of the parents (the previous slot may have no objects)
+        objects['parent_id'] = np.zeros_like(parent)
+        if linked:
+            has_parent = parent > 0
+            objects['parent_id'][has_parent] = previous['object_id'][parent[has_parent] - 1]
+        objects['overlap'] = overlap
+
+        # tracks not continued in this slot are complete
+        continued = set(objects['track_id'].tolist())
+        for track_id in [track_id for track_id in active if track_id not in continued]:
+            tracks.append(active.pop(track_id))
+            n_tracks += 1
+        _update_tracks(active, objects)
+
+        rows.append(objects)
+        n_objects += len(objects['n_pixels'])
+        previous = {'time': time, 'labels': labels, 'n_pixels': objects['n_pixels'],
+                    'object_id': objects['object_id'], 'track_id': objects['track_id']}
+
+        if (i + 1) % block_slots == 0:
+            _write_objects(rows, output_folder, counters)
+            _write_tracks(tracks, output_folder, counters)
+            rows = []
+            tracks = []
+            print(f"Objects and ended tracks written up to {time}")
+
+    # the tracks still active at the end of the period end with it
+    n_tracks += len(active)
+    tracks.extend(active.values())
+    _write_objects(rows, output_folder, counters)
+    _write_tracks(tracks, output_folder, counters)
+    print(f"{n_objects} objects and {n_tracks} tracks saved to: {output_folder}")
+
+    return n_objects, n_tracks
+
+def detect_objects(bt, rain, lat, lon, pixel_area, bt_threshold=235., min_area=1000.):
+    """
+    Label the cold cloud objects of one slot and compute their properties.
+    Args:
+        bt (numpy.ndarray): (lat, lon) brightness temperature (K).
+        rain (numpy.ndarray): (lat, lon) collocated precipitation (mm/hr, NaN where missing).
+        lat, lon (numpy.ndarray): coordinates of the pixels.
+        pixel_area (numpy.ndarray): (lat, lon) area of the pixels (km2), see pixel_areas.
+        bt_threshold (float): brightness temperature threshold (K).
+        min_area (float): objects smaller than min_area (km2) are discarded.
+    Returns:
+        labels (numpy.ndarray): (lat, lon) label of each pixel, 1..n_objects (0 = no object).
+        objects (dict): one array per column of object_columns (area_km2, n_pixels, bt_min, ...).
+    """
+    from scipy import ndimage
+
+    with np.errstate(invalid='ignore'):
+        mask = bt < bt_threshold
+    labels, n_labels = ndimage.label(mask, structure=np.ones((3, 3), dtype=bool))
+
+    flat = labels.ravel()
+    area = np.bincount(flat, weights=pixel_area.ravel(), minlength=n_labels + 1)
+
+    # discard the small objects and renumber the others 1..n_objects
+    keep = area >= min_area
+    keep[0] = False
+    new_label = np.zeros(n_labels + 1, dtype='int32')
+    new_label[keep] = np.arange(1, keep.sum() + 1)
+    labels = new_label[labels]
+    flat = labels.ravel()
+    n_objects = int(keep.sum())
+    index = np.arange(1, n_objects + 1)
+
+    weights = pixel_area.ravel()
+    area = np.bincount(flat, weights=weights, minlength=n_objects + 1)[1:]
+    n_pixels = np.bincount(flat, minlength=n_objects + 1)[1:]
+    lat2d = np.broadcast_to(lat[:, None], bt.shape).ravel()
+    lon2d = np.broadcast_to(lon[None, :], bt.shape).ravel()
+    bt_flat = np.nan_to_num(bt.ravel())
+
+    rain_flat = rain.ravel()
+    rain_valid = np.isfinite(rain_flat)
+    rain_area = np.bincount(flat, weights=weights * rain_valid, minlength=n_objects + 1)[1:]
+    rain_sum = np.bincount(flat, weights=weights * np.where(rain_valid, rain_flat, 0.), minlength=n_objects + 1)[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rain_mean = np.where(rain_area > 0, rain_sum / rain_area, np.nan)
+    rain_max = ndimage.maximum(np.where(rain_valid, rain_flat, -np.inf).reshape(bt.shape), labels, index) \
+        if n_objects > 0 else np.zeros(0)
+
+    objects = {
+        'area_km2': area.astype('float32'),
+        'n_pixels': n_pixels.astype('int32'),
+        'bt_min': np.asarray(ndimage.minimum(bt, labels, index) if n_objects > 0 else [], dtype='float32'),
+        'bt_mean': (np.bincount(flat, weights=weights * bt_flat, minlength=n_objects + 1)[1:] / area).astype('float32'),
+        'lat': (np.bincount(flat, weights=weights * lat2d, minlength=n_objects + 1)[1:] / area).astype('float32'),
+        'lon': (np.bincount(flat, weights=weights * lon2d, minlength=n_objects + 1)[1:] / area).astype('float32'),
+        'rain_mean': rain_mean.astype('float32'),
+        'rain_max': np.where(np.isfinite(rain_max), rain_max, np.nan).astype('float32'),
+        # mm/hr * km2 = 1e3 m3/hr
+        'rain_volume': (rain_sum * 1e3).astype('float32'),
+    }
+    return labels, objects
+
+def link_objects(previous_labels, previous_pixels, labels, n_pixels, min_overlap=0.25):
+    """
+    Find the parent of each object in the previous slot: the previous object with the largest
+    pixel overlap, if the overlap is at least min_overlap of the smaller of the two objects.
+    Args:
+        previous_labels (numpy.ndarray): (lat, lon) labels of the previous slot.
+        previous_pixels (numpy.ndarray): number of pixels of the previous objects.
+        labels (numpy.ndarray): (lat, lon) labels of the current slot.
+        n_pixels (numpy.ndarray): number of pixels of the current objects.
+        min_overlap (float): minimum overlap fraction.
+    Returns:
+        parent (numpy.ndarray): label of the parent of each object in the previous slot (0 = none).
+        overlap (numpy.ndarray): overlap fraction with the parent.
+    """
+    parent = np.zeros(len(n_pixels), dtype='int64')
+    overlap = np.zeros(len(n_pixels), dtype='float32')
+    both = (previous_labels > 0) & (labels > 0)
+    if not both.any():
+        return parent, overlap
+
+    # pixel count of each (previous, current) pair of overlapping objects
+    pairs = previous_labels[both].astype('int64') * (len(n_pixels) + 1) + labels[both]
+    pairs, counts = np.unique(pairs, return_counts=True)
+    previous_id, current_id = np.divmod(pairs, len(n_pixels) + 1)
+    fraction = counts / np.minimum(previous_pixels[previous_id - 1], n_pixels[current_id - 1])
+
+    # largest overlap of each current object
+    order = np.lexsort((-counts, current_id))
+    first = np.unique(current_id[order], return_index=True)[1]
+    best = order[first]
+    linked = fraction[best] >= min_overlap
+    parent[current_id[best][linked] - 1] = previous_id[best][linked]
+    overlap[current_id[best][linked] - 1] = fraction[best][linked]
+    return parent, overlap
+
+def nearest_cells(lat, lon, grid_lat, grid_lon):
+    """
+    Nearest cell of a regular grid (IMERG) for each pixel of another grid (GridSat).
+    Args:
+        lat, lon (numpy.ndarray): coordinates of the pixels.
+        grid_lat, grid_lon (numpy.ndarray): increasing coordinates of the cell centers of the grid.
+    Returns:
+        (i_lat, i_lon, inside): (lat, lon) indexes of the nearest cell and mask of the pixels inside the grid.
+    """
+    def nearest(x, centers):
+        step = np.diff(centers).mean()
+        i = np.rint((x - centers[0]) / step).astype('int64')
+        inside = (i >= 0) & (i < len(centers))
+        return np.clip(i, 0, len(centers) - 1), inside
+
+    i_lat, in_lat = nearest(lat, grid_lat)
+    i_lon, in_lon = nearest(lon, grid_lon)
+    return i_lat[:, None], i_lon[None, :], in_lat[:, None] & in_lon[None, :]
+
+def pixel_areas(lat, lon):
+    """
+    Area of the pixels of a regular lat/lon grid.
+    Args:
+        lat, lon (numpy.ndarray): coordinates of the pixel centers.
+    Returns:
+        area (numpy.ndarray): (lat, lon) area of each pixel (km2).
+    """
+    dlat = np.abs(np.diff(lat).mean())
+    dlon = np.abs(np.diff(lon).mean())
+    area = (dlat * km_per_degree) * (dlon * km_per_degree * np.cos(np.deg2rad(lat)))
+    return np.broadcast_to(area[:, None], (len(lat), len(lon)))
+
+def _assign_tracks(objects, parent, overlap, previous, active, counters):
+    """
+    Track of each object: the track of its parent if it is the largest overlap among the
+    children of the parent (the others are splits and start new tracks), a new track otherwise.
+    """
+    track_id = np.zeros(len(parent), dtype='int64')
+    order = np.argsort(-overlap * objects['n_pixels'], kind='stable')
+    continued = set()
+    for k in order:
+        if parent[k] > 0:
+            parent_track = int(previous['track_id'][parent[k] - 1])
+            if parent_track not in continued:
+                track_id[k] = parent_track
+                continued.add(parent_track)
+                continue
+            split_from = parent_track
+        else:
+            split_from = 0
+        counters['track_id'] += 1
+        track_id[k] = counters['track_id']
+        active[counters['track_id']] = {'track_id': counters['track_id'], 'split_from': split_from, 'n_objects': 0}
+    return track_id
+
+def _update_tracks(active, objects):
+    """
+    Add the objects of a slot to the aggregates of their tracks.
+    """
+    for k, track_id in enumerate(objects['track_id'].tolist()):
+        track = active[track_id]
+        if track['n_objects'] == 0:
+            track.update(start=objects['time'][k], lat_start=objects['lat'][k], lon_start=objects['lon'][k],
+                         area_max=0., bt_min=np.inf, rain_volume=0.)
+        track['n_objects'] += 1
+        track['end'] = objects['time'][k]
+        track['lat_end'], track['lon_end'] = objects['lat'][k], objects['lon'][k]
+        track['area_max'] = max(track['area_max'], float(objects['area_km2'][k]))
+        track['bt_min'] = min(track['bt_min'], float(objects['bt_min'][k]))
+        if np.isfinite(objects['rain_volume'][k]):
+            track['rain_volume'] += float(objects['rain_volume'][k])
+
+def _write_objects(rows, output_folder, counters):
+    """
+    Write the objects of a block of slots as one part of the object table.
+    """
+    import pandas as pd
+
+    if len(rows) == 0:
+        return
+    table = pd.DataFrame({name: np.concatenate([row[name] for row in rows]).astype(dtype)
+                          for name, dtype in object_columns.items()})
+    counters['part'] += 1
+    part_file = os.path.join(output_folder, f"objects_part{counters['part']:04d}.parquet")
+    table.to_parquet(part_file + '.tmp', index=False)
+    os.replace(part_file + '.tmp', part_file)
+
+def _write_tracks(tracks, output_folder, counters):
+    """
+    Write the tracks ended in a block of slots as one part of the track table: one row per
+    track with start, end, duration, number of objects, genesis and lysis position,
+    maximum area, minimum BT, accumulated rain and split origin.
+    """
+    import pandas as pd
+
+    if len(tracks) == 0:
+        return
+
+    columns = ['track_id', 'split_from', 'start', 'end', 'n_objects', 'lat_start', 'lon_start',
+               'lat_end', 'lon_end', 'area_max', 'bt_min', 'rain_volume']
+    table = pd.DataFrame([{name: track[name] for name in columns} for track in tracks], columns=columns)
+    table['duration_hours'] = (table['end'] - table['start']) / np.timedelta64(1, 'h')
+    table = table.astype({'n_objects': 'int32', 'lat_start': 'float32', 'lon_start': 'float32', 'lat_end': 'float32',
+                          'lon_end': 'float32', 'area_max': 'float32', 'bt_min': 'float32', 'rain_volume': 'float32',
+                          'duration_hours': 'float32'})
+    counters['track_part'] += 1
+    tracks_file = os.path.join(output_folder, f"tracks_part{counters['track_part']:04d}.parquet")
+    table.sort_values('track_id').to_parquet(tracks_file + '.tmp', index=False)
+    os.replace(tracks_file + '.tmp', tracks_file)
+
+
+if __name__ == "__main__":
+    main()
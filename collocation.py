@@ -0,0 +1,185 @@
+'''
+Collocation of GridSat brightness temperature (0.07 deg grid) on the IMERG grid (0.1 deg).
+Conservative (area-weighted) regridding weights between the two ITCZ grids are computed
+once and cached on disk as a sparse matrix. Regridding is then a sparse matrix product
+applied to blocks of time steps at once, so that a matched BT/precipitation cube for a
+year costs one weight computation plus cheap batched products.
+
+'''
+import os
+import hashlib
+import numpy as np
+
+
+# folder where the regridding weights are cached
+weights_folder = '/data/trade_pc/ITCZ/weights'
+
+
+def cell_edges(centers):
+    """
+    Edges of the cells of a regular grid from the cell centers.
+    Args:
+        centers (numpy.ndarray): increasing coordinates of the cell centers.
+    Returns:
+        edges (numpy.ndarray): the len(centers) + 1 cell edges.
+    """
+    centers = np.asarray(centers, dtype='float64')
+    step = np.diff(centers).mean()
+    return np.concatenate([centers[:1] - step / 2, (centers[1:] + centers[:-1]) / 2, centers[-1:] + step / 2])
+
+def overlap_weights_1d(src_edges, dst_edges):
+    """
+    Overlap lengths between the cells of two 1D grids.
+    Args:
+        src_edges (numpy.ndarray): increasing edges of the source cells.
+        dst_edges (numpy.ndarray): increasing edges of the destination cells.
+    Returns:
+        overlap (scipy.sparse.csr_matrix): (n_dst, n_src) overlap length of each pair of cells.
+    """
+    from scipy import sparse
+
+    rows, cols, values = [], [], []
+    for i in range(len(dst_edges) - 1):
+        # source cells that can intersect the destination cell i
+        first = max(np.searchsorted(src_edges, dst_edges[i], side='right') - 1, 0)
+        last = min(np.searchsorted(src_edges, dst_edges[i + 1], side='left'), len(src_edges) - 1)
+        j = np.arange(first, last)
+        overlap = np.minimum(src_edges[j + 1], dst_edges[i + 1]) - np.maximum(src_edges[j], dst_edges[i])
+        keep = overlap > 0
+        rows.append(np.full(keep.sum(), i))
+        cols.append(j[keep])
+        values.append(overlap[keep])
+
+    return sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(dst_edges) - 1, len(src_edges) - 1))
+
+def conservative_weights(src_lat, src_lon, dst_lat, dst_lon):
+    """
+    Conservative regridding weights between two regular lat/lon grids.
+    The overlap area of two cells is the product of the overlap in longitude and
+    the overlap in sin(latitude), so the 2D weights are the Kronecker product of
+    two 1D overlap matrices. Rows are normalized by the covered area of each
+    destination cell. Fields are flattened in (lat, lon) order.
+    Args:
+        src_lat, src_lon (numpy.ndarray): cell centers of the source grid.
+        dst_lat, dst_lon (numpy.ndarray): cell centers of the destination grid.
+    Returns:
+        weights (scipy.sparse.csr_matrix): (n_dst_lat * n_dst_lon, n_src_lat * n_src_lon) weights.
+    """
+    from scipy import sparse
+
+    sin_src = np.sin(np.deg2rad(cell_edges(src_lat)))
+    sin_dst = np.sin(np.deg2rad(cell_edges(dst_lat)))
+    weights_lat = overlap_weights_1d(sin_src, sin_dst)
+    weights_lon = overlap_weights_1d(cell_edges(src_lon), cell_edges(dst_lon))
+
+    weights = sparse.kron(weights_lat, weights_lon, format='csr')
+
+    # normalize by the area of each destination cell covered by the source grid
+    covered = np.asarray(weights.sum(axis=1)).ravel()
+    covered[covered == 0] = 1.
+    return sparse.diags(1. / covered) @ weights
+
+def get_weights(src_lat, src_lon, dst_lat, dst_lon, folder=None):
+    """
+    Return the conservative weights between two grids, reading them from the cache
+    folder if they were already computed for the same grids.
+    Args:
+        src_lat, src_lon (numpy.ndarray): cell centers of the source grid.
+        dst_lat, dst_lon (numpy.ndarray): cell centers of the destination grid.
+        folder (str): cache folder (default: weights_folder).
+    Returns:
+        weights (scipy.sparse.csr_matrix): regridding weights (see conservative_weights).
+    """
+    from scipy import sparse
+
+    folder = folder or weights_folder
+    key = hashlib.sha1()
+    for coords in (src_lat, src_lon, dst_lat, dst_lon):
+        key.update(np.round(np.asarray(coords, dtype='float64'), 6).tobytes())
+    weights_file = os.path.join(folder, 'conservative_' + key.hexdigest()[:16] + '.npz')
+
+    if os.path.exists(weights_file):
+        return sparse.load_npz(weights_file).tocsr()
+
+    weights = conservative_weights(src_lat, src_lon, dst_lat, dst_lon)
+    os.makedirs(folder, exist_ok=True)
+    sparse.save_npz(weights_file + '.tmp.npz', weights)
+    os.replace(weights_file + '.tmp.npz', weights_file)
+    print('Regridding weights saved to:', weights_file)
+
+    return weights
+
+def regrid(data, weights, dst_shape):
+    """
+    Regrid a block of time steps with one sparse matrix product. Missing values
+    (NaN) are excluded and the weights of the valid source cells renormalized.
+    Args:
+        data (numpy.ndarray): (time, n_src_lat, n_src_lon) source fields.
+        weights (scipy.sparse.csr_matrix): regridding weights (see conservative_weights).
+        dst_shape (tuple): (n_dst_lat, n_dst_lon) shape of the destination grid.
+    Returns:
+        regridded (numpy.ndarray): (time, n_dst_lat, n_dst_lon) fields, NaN where no valid source cell.
+    """
+    n_times = data.shape[0]
+    flat = data.reshape(n_times, -1).T
+    valid = np.isfinite(flat)
+
+    total = weights @ np.where(valid, flat, 0.)
+    covered = weights @ valid.astype(flat.dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        regridded = np.where(covered > 0, total / covered, np.nan)
+
+    return regridded.T.reshape((n_times,) + tuple(dst_shape))
+
+def collocate(ds_geost, ds_imerg, store, block_size=248, folder=None):
+    """
+    Produce the matched BT/precipitation cube on the IMERG grid: GridSat irwin_cdr
+    regridded conservatively and IMERG precipitation at the GridSat times, written
+    block by block to a Zarr store, so memory is bounded by block_size time steps.
+    The time steps already in the store are skipped, so a stopped or repeated run only
+    adds the missing ones (appended, or inserted in time order, see zarr_archive.insert_times).
+    Args:
+        ds_geost (xarray.Dataset): cropped GridSat data (standard calendar), e.g. from zarr_archive.open_archive.
+        ds_imerg (xarray.Dataset): cropped IMERG data (standard calendar) with precipitation(time, lon, lat).
+        store (str): path of the Zarr store of the collocated cube.
+        block_size (int): number of time steps regridded with one product.
+        folder (str): cache folder of the weights.
+    Returns:
+        n_times (int): number of time steps collocated by this call.
+    """
+    import xarray as xr
+    from zarr_archive import append_to_archive, insert_times, open_archive
+
+    dst_lat = ds_imerg['lat'].values
+    dst_lon = ds_imerg['lon'].values
+    weights = get_weights(ds_geost['lat'].values, ds_geost['lon'].values, dst_lat, dst_lon, folder)
+
+    # GridSat times present in IMERG
+    times = np.intersect1d(ds_geost['time'].values, ds_imerg['time'].values)
+    last_time = None
+    if os.path.exists(store):
+        store_times = open_archive('collocated', store).time.values
+        times = np.setdiff1d(times, store_times)
+        last_time = store_times[-1]
+        print(f"{len(store_times)} time steps already collocated in {store}")
+
+    for start in range(0, len(times), block_size):
+        block_times = times[start:start + block_size]
+        bt = ds_geost['irwin_cdr'].sel(time=block_times).transpose('time', 'lat', 'lon').values
+        precip = ds_imerg['precipitation'].sel(time=block_times).transpose('time', 'lat', 'lon').values
+
+        bt_regridded = regrid(bt.astype('float32'), weights, (len(dst_lat), len(dst_lon)))
+
+        ds_block = xr.Dataset(
+            {'irwin_cdr': (('time', 'lat', 'lon'), bt_regridded.astype('float32'), {'units': 'K'}),
+             'precipitation': (('time', 'lat', 'lon'), precip, {'units': 'mm/hr'})},
+            coords={'time': block_times, 'lat': dst_lat, 'lon': dst_lon})
+        if last_time is not None and block_times[0] <= last_time:
+            insert_times(ds_block, 'collocated', store)
+        else:
+            append_to_archive(ds_block, 'collocated', store)
+        last_time = max(last_time, block_times[-1]) if last_time is not None else block_times[-1]
+        print(f"Collocated {start + len(block_times)} of {len(times)} time steps")
+
+    return len(times)
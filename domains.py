@@ -0,0 +1,60 @@
+'''
+Registry of the domains cropped from the GridSat and IMERG granules.
+Each domain has its bounds and the root of its output tree: the files of a domain
+are saved in <root>/<year>/<product> (e.g. /data/trade_pc/ITCZ/2024/geost).
+Several domains are cut from a single read of each granule, so adding a domain
+adds only local CPU work and no download.
+
+'''
+
+
+domains = {
+    # tropical Atlantic ITCZ
+    'itcz': {'lat_min': -15., 'lat_max': 15., 'lon_min': -66., 'lon_max': 15.,
+             'root': '/data/trade_pc/ITCZ'},
+    # North Atlantic trade-wind region upstream of Barbados
+    'trade_wind': {'lat_min': 5., 'lat_max': 20., 'lon_min': -66., 'lon_max': -40.,
+                   'root': '/data/trade_pc/TRADE_WIND'},
+    # West African monsoon region
+    'west_africa': {'lat_min': 0., 'lat_max': 20., 'lon_min': -20., 'lon_max': 15.,
+                    'root': '/data/trade_pc/WEST_AFRICA'},
+}
+
+
+def domain_bounds(name):
+    """
+    Bounds of a domain of the registry.
+    Args:
+        name (str): name of the domain.
+    Returns:
+        (lat_min, lat_max, lon_min, lon_max): bounds of the domain in degrees North / East.
+    """
+    domain = domains[name]
+    return domain['lat_min'], domain['lat_max'], domain['lon_min'], domain['lon_max']
+
+def domain_folder(name, year, product):
+    """
+    Output folder of a domain for a year and a product.
+    Args:
+        name (str): name of the domain.
+        year (str or int): year of the data.
+        product (str): 'geost' or 'imerg'.
+    Returns:
+        folder (str): <root>/<year>/<product>.
+    """
+    return domains[name]['root'] + '/' + str(year) + '/' + product
+
+def crop_domains(ds, names):
+    """
+    Crop several domains from the same dataset.
+    Args:
+        ds (xarray.Dataset): dataset with increasing lat and lon coordinates.
+        names (list): names of the domains.
+    Returns:
+        crops (dict): cropped dataset for each domain name.
+    """
+    crops = {}
+    for name in names:
+        lat_min, lat_max, lon_min, lon_max = domain_bounds(name)
+        crops[name] = ds.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
+    return crops
@@ -0,0 +1,127 @@
+'''
+Helper functions shared by the download scripts (GridSat and IMERG):
+- creation of a pooled keep-alive HTTP session to be reused for all the files of a run
+- streaming, resumable download of a single file
+
+'''
+
+
+def make_session(pool_size=4, max_retries=3, backoff_factor=0, session_class=None):
+    """
+    Create a requests session with a connection pool large enough for
+    pool_size concurrent downloads. Connections are kept alive and reused
+    between files, so that each download does not pay a new TCP/TLS handshake.
+    Args:
+        pool_size (int): number of connections kept open per host (use the number of download workers).
+        max_retries (int): number of retries on connection errors.
+        backoff_factor (float): if > 0, also retry the requests answered with 429 or 5xx,
+            waiting backoff_factor * 2**(retry - 1) seconds between retries.
+        session_class (type): subclass of requests.Session to create (default: requests.Session).
+    Returns:
+        session (requests.Session): session to be shared by all download workers.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    if backoff_factor > 0:
+        max_retries = Retry(total=max_retries, backoff_factor=backoff_factor,
+                            status_forcelist=[429, 500, 502, 503, 504], respect_retry_after_header=True)
+    session = (session_class or requests.Session)()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+def stream_download(session, url, file_name, chunk_size=1024*1024, max_retries=5, timeout=60, backoff=0):
+    """
+    Download a file streaming it in chunks to a temporary file (file_name + '.part'),
+    so that memory use does not depend on the file size.
+    If the temporary file already exists (interrupted transfer), the download is
+    resumed from its current size with an HTTP Range request (a temporary file already
+    complete, answered with 416, is renamed without downloading it again). The temporary file
+    is renamed to file_name only after its size has been checked against the
+    size announced by the server.
+    Args:
+        session (requests.Session): session used for the requests.
+        url (str): URL of the file to download.
+        file_name (str): final path of the downloaded file.
+        chunk_size (int): size in bytes of the chunks written to disk.
+        max_retries (int): number of times the transfer is resumed after a connection error.
+        timeout (float): connect/read timeout in seconds.
+        backoff (float): wait backoff * 2**attempt seconds (at most 60) before resuming a transfer.
+    Returns:
+        (bool): True if the file was downloaded, False if the server answered with an error.
+    """
+    import os
+    import time
+    import requests
+    from metrics import count
+
+    part_name = file_name + '.part'
+
+    for attempt in range(max_retries + 1):
+        if attempt > 0 and backoff > 0:
+            time.sleep(min(backoff * 2 ** (attempt - 1), 60))
+
+        # resume from the bytes already on disk
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+
+                if response.status_code == 416:
+                    # Content-Range: bytes */total. The partial file is already complete if the
+                    # run stopped between the end of the transfer and the rename
+                    content_range = response.headers.get('Content-Range', '')
+                    if offset > 0 and content_range.startswith('bytes */') and content_range[8:].isdigit() \
+                            and int(content_range[8:]) == offset:
+                        os.replace(part_name, file_name)
+                        return True
+                    # the partial file does not match the remote one anymore: start again from zero
+                    print(f"Cannot resume {file_name}, restarting download")
+                    os.remove(part_name)
+                    count('download_restarts')
+                    continue
+
+                if response.status_code not in (200, 206):
+                    print(f"Failed to download {file_name}. HTTP Status Code: {response.status_code}")
+                    count('download_failures')
+                    return False
+
+                if response.status_code == 206:
+                    # Content-Range: bytes start-end/total
+                    total_size = int(response.headers['Content-Range'].split('/')[-1])
+                    mode = 'ab'
+                else:
+                    # the server ignored the range request: write the whole file again
+                    content_length = response.headers.get('Content-Length')
+                    total_size = int(content_length) if content_length is not None else None
+                    mode = 'wb'
+
+                with open(part_name, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as error:
+            print(f"Transfer of {file_name} interrupted ({error}), attempt {attempt + 1} of {max_retries + 1}")
+            count('download_retries')
+            continue
+
+        # check the size before making the file visible under its final name
+        downloaded_size = os.path.getsize(part_name)
+        if total_size is not None and downloaded_size != total_size:
+            print(f"Incomplete transfer of {file_name}: {downloaded_size} of {total_size} bytes")
+            count('download_retries')
+            continue
+
+        os.replace(part_name, file_name)
+        return True
+
+    print(f"Failed to download {file_name} after {max_retries + 1} attempts")
+    count('download_failures')
+    return False
@@ -83,7 +83,9 @@ for t in $( seq $t_beg $one_day $t_end )
   fn=3B-DAY.MS.MRG.3IMERG.$ymd-S000000-E235959.V06.nc4
 
   # get the data 
-  wget -q $b_url/$YYYY/$mm/$fn
+  # streamed to a partial file: -c resumes an interrupted transfer,
+  # the file gets its final name only if wget completed the transfer
+  wget -q -c $b_url/$YYYY/$mm/$fn -O $fn.part && mv $fn.part $fn
 
 
   # ncks = netcdf kitchen sink: restrict coordinates to Atacama region
@@ -61,12 +61,14 @@ echo ymd=$ymd
   echo try to get $fn
 
   # get the data 
+  # streamed to a partial file: -c resumes an interrupted transfer,
+  # the file gets its final name only if wget completed the transfer
   # test with 
-  #   wget --load-cookies .usr_cookies --save-cookies .usr_cookies --auth-no-challenge=on --keep-session-cookies --user=jschween --ask-password --content-disposition https://docserver.gesdisc.eosdis.nasa.gov/public/project/GPM/IMERG_ATBD_V06.pdf 
-  #   wget --load-cookies .usr_cookies --save-cookies .usr_cookies --auth-no-challenge=on --keep-session-cookies --user=jschween --content-disposition https://gpm1.gesdisc.eosdis.nasa.gov/data/doc/README.GPM.pdf
+  #   wget --load-cookies .urs_cookies --save-cookies .urs_cookies --auth-no-challenge=on --keep-session-cookies --user=jschween --ask-password --content-disposition https://docserver.gesdisc.eosdis.nasa.gov/public/project/GPM/IMERG_ATBD_V06.pdf 
+  #   wget --load-cookies .urs_cookies --save-cookies .urs_cookies --auth-no-challenge=on --keep-session-cookies --user=jschween --content-disposition https://gpm1.gesdisc.eosdis.nasa.gov/data/doc/README.GPM.pdf
   # pwd ist das �bliche einfache
 
-  wget --load-cookies .urs_cookies --save-cookies .usr_cookies --auth-no-challenge=on --keep-session-cookies --user=jschween --content-disposition $url -O $fn
+  wget --load-cookies .urs_cookies --save-cookies .urs_cookies --auth-no-challenge=on --keep-session-cookies --user=jschween --content-disposition -c $url -O $fn.part && mv $fn.part $fn
 
 
   # put into correct place
@@ -7,44 +7,130 @@ Data have already parallax correction
 '''
 
 
-# set the directory server from which to list and download files
-import pdb
+from domains import domain_bounds, domain_folder
 
+# variables of the GridSat files that are not kept in the cropped files
+variables_to_drop = ['calslp_irwin', 'calslp_irwin', 'calslp_irwvp', 'caloff_irwvp', 'vis_rad_slope', 'vis_dc_slope', 'vis_dc_offset', 'irwin_2', 'irwin_3', 'irwvp', 'vschn', 'vschn_2', 'satid_ir', 'satid_wv', 'satid_vs', 'sparse2ir', 'sparse2wv','sparse2vs', 'satid_ir3', 'irwin_vza_adj']
 
-def main():
+
+def main(config=None):
+    """
+    Download, crop and store the GridSat files of the configured years.
+    Args:
+        config (dict): settings overriding the defaults below (the [gridsat] section of the
+            configuration file of itcz_cli.py), None = defaults.
+    """
+    
+    config = config or {}
+    
+    # define ITCZ domain (see domains.py)
+    domain_name = config.get('domain', 'itcz')
+    lat_min, lat_max, lon_min, lon_max = domain_bounds(domain_name)
     
-    # define ITCZ domain
-    lat_min = -15. # degrees North
-    lat_max = 15. # degrees North
-    lon_min = -66. # degrees East
-    lon_max = 15. # degrees East
+    # other domains cut from the same downloaded files, each one saved in its own tree
+    other_domains = config.get('other_domains', [])  # e.g. ['trade_wind', 'west_africa']
     
-    # destination folder
-    destination_folder = '/data/trade_pc/ITCZ/2024/geost'
+    # years to download, the destination folder of each year is /data/trade_pc/ITCZ/<year>/geost
+    years = [str(year) for year in config.get('years', ['2024'])]
     
     # file list filename
-    file_list_name = 'file_list.txt'
+    file_list_name = config.get('file_list_name', 'file_list.txt')
+    
+    # manifest of the remote directories, updated incrementally at each run
+    manifest_file = config.get('manifest_file', '/data/trade_pc/ITCZ/gridsat_manifest.json')
+    
+    # journal of the state of each file, to resume interrupted runs
+    journal_file = config.get('journal_file', '/data/trade_pc/ITCZ/ingest_journal.sqlite')
+    
+    # number of concurrent downloads
+    n_workers = config.get('n_workers', 8)
+    
+    # number of processes cropping and compressing the downloaded files (None = all cores)
+    n_processes = config.get('n_processes', None)
+    
+    # compression of the cropped files (see compression_report to compare settings)
+    codec = config.get('codec', 'zlib')
+    complevel = config.get('complevel', 9)
+    
+    # store irwin_cdr as packed int16 (source encoding) instead of decoded floats, checking the round trip
+    packed = config.get('packed', True)
+    
+    # read only the ITCZ window from the remote files instead of downloading the global files
+    remote_subset = config.get('remote_subset', False)
+    
+    # append the cropped files to the consolidated Zarr archive of each year (None = netCDF files only)
+    zarr_store = config.get('zarr_store', '/data/trade_pc/ITCZ/{year}/geost.zarr')
+    
+    # timing events (JSON lines) and summary for the Prometheus textfile collector (see metrics.py)
+    metrics_folder = config.get('metrics_folder', '/data/trade_pc/ITCZ/metrics')
+    
+    # work queue shared by several copies of this script, on one or more machines (see work_queue.py)
+    # None = single worker
+    queue_folder = config.get('queue_folder', None)  # e.g. '/data/trade_pc/ITCZ/queue'
+    
+    # folder of the raw global files downloaded by this worker
+    raw_folder = config.get('raw_folder', '.')
     
     
     # define url for geostationary data
     # geostationary files available at https://www.ncei.noaa.gov/data/geostationary-ir-channel-brightness-temperature-gridsat-b1/access/
-    year = '2024'
-    url = 'https://www.ncei.noaa.gov/data/geostationary-ir-channel-brightness-temperature-gridsat-b1/access/'+year+'/'
-
-    # read the list of files from the url
-    get_file_list(url, file_list_name='file_list.txt')
+    base_url = config.get('base_url', 'https://www.ncei.noaa.gov/data/geostationary-ir-channel-brightness-temperature-gridsat-b1/access/')
+    
+    from metrics import configure
+    configure(events_file=metrics_folder + '/gridsat_events.jsonl', textfile=metrics_folder + '/gridsat.prom')
     
-    # filter lines not ending with .nc
-    filter_nc_files('file_list.txt')
+    if queue_folder is not None:
+        import os
+        import socket
+        # raw files and journal of each machine (SQLite locking is not reliable across
+        # machines on network filesystems, the queue coordinates the workers), file list of each worker
+        host = socket.gethostname()
+        raw_folder = os.path.join(raw_folder, 'gridsat_raw_' + host)
+        file_list_name = os.path.join(raw_folder, f'{os.getpid()}_{file_list_name}')
+        journal_file = journal_file.replace('.sqlite', '_' + host + '.sqlite')
+        os.makedirs(raw_folder, exist_ok=True)
     
-    # download files from the list 
-    download_from_list(url, 
-                       file_list_name, 
-                       destination_folder,
-                       lat_min, 
-                       lat_max,
-                       lon_min,
-                       lon_max)
+    # update the manifest of the remote files (one conditional request per year if nothing changed)
+    manifest = sync_manifest(base_url, years, manifest_file)
+    
+    for year in years:
+        url = base_url + year + '/'
+        destination_folder = domain_folder(domain_name, year, 'geost')
+        domain_folders = {name: domain_folder(name, year, 'geost') for name in other_domains}
+        
+        # write to the file list only the remote files that are not ingested yet
+        n_todo = write_todo_list(manifest, year, destination_folder, file_list_name, journal_file)
+        if n_todo == 0:
+            print(f"Nothing to download for {year}")
+            continue
+        
+        # download files from the list 
+        download_from_list(url, 
+                           file_list_name, 
+                           destination_folder,
+                           lat_min, 
+                           lat_max,
+                           lon_min,
+                           lon_max,
+                           n_workers=n_workers,
+                           remote_subset=remote_subset,
+                           n_processes=n_processes,
+                           codec=codec,
+                           complevel=complevel,
+                           packed=packed,
+                           journal_file=journal_file,
+                           domain_folders=domain_folders,
+                           queue_folder=queue_folder + '/geost_' + year if queue_folder is not None else None,
+                           raw_folder=raw_folder)
+        
+        # index the time steps of the new files
+        from time_index import update_time_index
+        update_time_index(destination_folder, 'geost')
+        
+        # append the new time steps to the Zarr archive
+        if zarr_store is not None:
+            from zarr_archive import ingest_folder
+            ingest_folder(destination_folder, 'geost', store=zarr_store.format(year=year))
     
 def get_file_list(url, file_list_name='file_list.txt'):
     """
@@ -68,18 +154,141 @@ def get_file_list(url, file_list_name='file_list.txt'):
         soup = BeautifulSoup(response.text, 'html.parser')
         
         # open a text file to save the filenames
-        with open('file_list.txt', 'w') as file:
+        with open(file_list_name, 'w') as file:
             # Find all <a> tags (links) and extract file names
             for link in soup.find_all('a'):
                 href = link.get('href')
                 if href and not href.endswith('/'):  # Exclude subdirectories
                     file.write(href + '\n')  # Write the file name to the text file
-        print('the file list has been saved to file_list.txt')
+        print(f'the file list has been saved to {file_list_name}')
     else:
         print(f"Failed to fetch the directory. HTTP Status Code: {response.status_code}")
         
     return()
 
+def sync_manifest(base_url, years, manifest_file):
+    """
+    Update the manifest of the remote GridSat files of several years.
+    The directory of each year is requested with If-None-Match / If-Modified-Since
+    using the ETag and Last-Modified of the previous run: if the directory did not
+    change the server answers 304 and nothing is parsed. Otherwise the listing is
+    parsed and the files of the year (name, size, modification time) replace the
+    ones in the manifest.
+    Args:
+        base_url (str): URL of the directory containing one subdirectory per year.
+        years (list): years (str) to synchronize.
+        manifest_file (str): path of the json manifest.
+    Returns:
+        manifest (dict): 'directories' maps each year to its etag and last_modified,
+            'files' maps each year to a dict {file name: {'size', 'mtime'}}.
+    """
+    import os
+    import json
+    from download_utils import make_session
+    
+    manifest = {'directories': {}, 'files': {}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as file:
+            manifest = json.load(file)
+    
+    session = make_session(pool_size=1)
+    changed = False
+    for year in years:
+        url = base_url + year + '/'
+        directory = manifest['directories'].get(year, {})
+        
+        # conditional request on the state of the previous run
+        headers = {}
+        if year in manifest['files']:
+            if directory.get('etag'):
+                headers['If-None-Match'] = directory['etag']
+            if directory.get('last_modified'):
+                headers['If-Modified-Since'] = directory['last_modified']
+        response = session.get(url, headers=headers)
+        
+        if response.status_code == 304:
+            print(f"Remote listing of {year} not modified")
+            continue
+        if response.status_code != 200:
+            print(f"Failed to fetch the directory {url}. HTTP Status Code: {response.status_code}")
+            continue
+        
+        manifest['files'][year] = parse_listing(response.text)
+        manifest['directories'][year] = {'etag': response.headers.get('ETag'),
+                                         'last_modified': response.headers.get('Last-Modified')}
+        changed = True
+        print(f"Remote listing of {year} updated: {len(manifest['files'][year])} files")
+    session.close()
+    
+    if changed:
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+        with open(manifest_file + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(manifest_file + '.tmp', manifest_file)
+    
+    return manifest
+
+def parse_listing(html):
+    """
+    Parse the HTML listing of a NCEI directory (one table row per file, with
+    the link, the modification time and the size).
+    Args:
+        html (str): HTML content of the directory.
+    Returns:
+        files (dict): {file name: {'size': size as listed (e.g. '6.4M'), 'mtime': modification time as listed}}
+            for the files ending with '.nc'.
+    """
+    import re
+    from bs4 import BeautifulSoup
+    
+    soup = BeautifulSoup(html, 'html.parser')
+    files = {}
+    for row in soup.find_all('tr'):
+        link = row.find('a')
+        if link is None or not (link.get('href') or '').endswith('.nc'):
+            continue
+        cells = [cell.get_text(strip=True) for cell in row.find_all('td')]
+        mtime = next((cell for cell in cells if re.match(r'\d{4}-\d{2}-\d{2}', cell)), None)
+        size = next((cell for cell in cells if re.fullmatch(r'[\d.]+[KMG]?', cell)), None)
+        files[link.get('href')] = {'size': size, 'mtime': mtime}
+    
+    return files
+
+def write_todo_list(manifest, year, destination_folder, file_list_name, journal_file=None):
+    """
+    Write in the file list the remote files of a year that are not yet ingested:
+    the files not completed in the ingest journal if journal_file is given, otherwise
+    the files not in the destination folder (one directory listing instead of a check per file).
+    Args:
+        manifest (dict): manifest of the remote files (see sync_manifest).
+        year (str): year of the files.
+        destination_folder (str): folder of the cropped files.
+        file_list_name (str): The name of the text file containing the list of file names.
+        journal_file (str): path of the ingest journal (existing valid cropped files are recorded as cleaned).
+    Returns:
+        n_todo (int): number of files to download.
+    """
+    import os
+    
+    if journal_file is not None:
+        from ingest_journal import open_journal, get_states, seed_from_outputs
+        journal = open_journal(journal_file)
+        # cropped files written before the journal
+        existing = set(os.listdir(destination_folder)) if os.path.isdir(destination_folder) else set()
+        seed_from_outputs(journal, 'geost', {name: os.path.join(destination_folder, name)
+                                             for name in manifest['files'].get(year, {}) if name in existing})
+        granule_states = get_states(journal, 'geost')
+        ingested = {name for name, (state, files) in granule_states.items() if state == 'cleaned'}
+    else:
+        ingested = set(os.listdir(destination_folder)) if os.path.isdir(destination_folder) else set()
+    todo = sorted(name for name in manifest['files'].get(year, {}) if name not in ingested)
+    
+    with open(file_list_name, 'w') as file:
+        file.writelines(name + '\n' for name in todo)
+    print(f"{len(todo)} files to download for {year} saved to {file_list_name}")
+    
+    return len(todo)
+
 def filter_nc_files(file_list_name):
     """
     Filters lines in a text file to keep only those ending with '.nc'.
@@ -101,7 +310,9 @@ def filter_nc_files(file_list_name):
     
     return()
 
-def download_from_list(path_url, file_list_name, destination_folder, lat_min, lat_max, lon_min, lon_max):
+def download_from_list(path_url, file_list_name, destination_folder, lat_min, lat_max, lon_min, lon_max, n_workers=1, remote_subset=False,
+                       n_processes=None, codec='zlib', complevel=9, journal_file=None, domain_folders=None, packed=True,
+                       queue_folder=None, raw_folder='.'):
     """
     Function to:
     - download files from a list of URLs saved in a text file
@@ -109,8 +320,30 @@ def download_from_list(path_url, file_list_name, destination_folder, lat_min, la
     - post-process variables to convert in proper units
     - save the files in a specific folder
     
+    Downloads run on a pool of n_workers threads sharing one keep-alive HTTP session,
+    while a pool of n_processes processes crops, compresses and saves the files 
+    that are already downloaded. At most 2*n_workers + n_processes files are in 
+    flight at the same time, so that raw global files do not pile up on disk when 
+    cropping is slower than downloading.
+    With remote_subset=True the global files are not downloaded: each worker reads 
+    only the chunks of the kept variables that intersect the domain from the remote 
+    file with HTTP range requests, and saves the cropped file.
+    With a journal_file, the state of each file is tracked in the ingest journal 
+    (see ingest_journal.py): the raw file is deleted only after the cropped file has
+    been verified, and an interrupted run restarts exactly the unfinished stages 
+    (resume the download, crop again, verify or clean up) without checking the outputs.
+    Each download, crop and write is recorded in the metrics (see metrics.py), and the
+    summary is written to the configured textfile at the end of the run.
+    With a queue_folder, several workers (processes or machines) share the list: a file
+    is processed only by the worker holding its lease in the work queue (see work_queue.py),
+    and is marked done when its cropped file is written (verified with a journal). Each
+    worker downloads the raw files to its own raw_folder.
+    
     dependencies:
     - read_crop_geost
+    - crop_and_save
+    - crop_and_save_remote
+    - download_utils.make_session
     Args:
         path_url (str): The base URL for downloading files.
         file_list_name (str): The name of the text file containing the list of file names.
@@ -119,74 +352,494 @@ def download_from_list(path_url, file_list_name, destination_folder, lat_min, la
         lat_max (float): Maximum latitude for filtering files.
         lon_min (float): Minimum longitude for filtering files.
         lon_max (float): Maximum longitude for filtering files.    
+        n_workers (int): number of concurrent downloads (1 = download one file at a time).
+        remote_subset (bool): if True, read only the domain from the remote files instead of downloading them.
+        n_processes (int): number of processes cropping and compressing the files (None = number of cores).
+        codec (str): compression codec of the cropped files (see compression_encoding).
+        complevel (int): compression level of the cropped files.
+        journal_file (str): path of the ingest journal (None = skip files already in destination_folder).
+        domain_folders (dict): output folder of each other domain (domains.py) cut from the same files.
+        packed (bool): write irwin_cdr as packed integers and check the round trip (see packing.py).
+        queue_folder (str): folder of the work queue shared by the workers (None = single worker).
+        raw_folder (str): folder of the downloaded raw files of this worker.
     
     """
     import os
-    import requests
     from pathlib import Path 
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from download_utils import make_session
+    from metrics import write_textfile
+    from work_queue import open_queue, claim, close_queue
 
     # Create the destination folder if it doesn't exist
-    destination_folder = '/data/trade_pc/ITCZ/2024/geost'  # Replace with your desired folder path
     Path(destination_folder).mkdir(parents=True, exist_ok=True)
+    Path(raw_folder).mkdir(parents=True, exist_ok=True)
         
     # Read the list of files from the text file
     with open(file_list_name, 'r') as file:
         files = file.readlines()
     
-    # Loop through each file and download it
-    for file_name in files:
-        file_name = file_name.strip()  # Remove any leading/trailing whitespace
-        url = path_url + file_name  # Construct the full URL
-        
-        # check if file already exists
-        if os.path.exists(os.path.join(destination_folder, file_name)):
-            print(f"File already exists: {file_name}")
-            continue
+    files = [file_name.strip() for file_name in files if file_name.strip()]  # Remove any leading/trailing whitespace
+    
+    to_download = []
+    to_crop = []
+    journal = None
+    if journal_file is None:
+        # select files that are not yet in the destination folder
+        for file_name in files:
+            # check if file already exists
+            if os.path.exists(os.path.join(destination_folder, file_name)):
+                print(f"File already exists: {file_name}")
+                continue
+            to_download.append(file_name)
+    else:
+        # restart each file from the first unfinished stage
+        from ingest_journal import open_journal, add_granules, get_states, set_state, reached, seed_from_outputs
+        journal = open_journal(journal_file)
+        add_granules(journal, 'geost', files)
+        seed_from_outputs(journal, 'geost', {file_name: os.path.join(destination_folder, file_name) for file_name in files})
+        granule_states = get_states(journal, 'geost')
+        for file_name in files:
+            state = granule_states[file_name][0]
+            if state == 'cleaned':
+                continue
+            if reached(state, 'written') and _finish_granule(journal, file_name, destination_folder, raw_folder):
+                continue
+            if reached(state, 'downloaded') and os.path.exists(os.path.join(raw_folder, file_name)):
+                to_crop.append(file_name)
+            else:
+                to_download.append(file_name)
+    
+    # work queue shared with the other workers, files leased by another worker are skipped
+    work_queue = open_queue(queue_folder) if queue_folder is not None else None
+    
+    def claimed(file_name):
+        return work_queue is None or claim(work_queue, file_name)
+    
+    try:
+        if remote_subset:
+            # read, crop and save directly from the remote files, claiming the next file
+            # only when a slot is free so that the other workers share the list
+            pending = {}
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                for file_name in to_download:
+                    if not claimed(file_name):
+                        continue
+                    pending[executor.submit(crop_and_save_remote, path_url + file_name, file_name, 
+                                            destination_folder, lat_min, lat_max, lon_min, lon_max, 
+                                            codec, complevel, domain_folders, packed)] = ('crop', file_name)
+                    while len(pending) >= 2 * n_workers:
+                        # only the destination folder of the crop arguments is used for the remote crops
+                        pending = _collect_completed(pending, None, (destination_folder,), journal, raw_folder, work_queue)
+                
+                while pending:
+                    pending = _collect_completed(pending, None, (destination_folder,), journal, raw_folder, work_queue)
+            write_textfile()
+            return()
         
-        # Download the file
-        response = requests.get(url)
+        # one session shared by all the workers: connections are kept alive between files
+        session = make_session(pool_size=n_workers)
         
-        if response.status_code == 200:
-            
-            # Save the file in the current directory
-            with open(file_name, 'wb') as f:
-                f.write(response.content)
-            print(f"Downloaded: {file_name}")
-            
-            # read and crop the file
-            ds_out = read_crop_geost(file_name, lat_min, lat_max, lon_min, lon_max)
+        # download in the thread pool, crop and save in the process pool as soon as a download completes
+        n_processes = n_processes or os.cpu_count()
+        max_in_flight = 2 * n_workers + n_processes
+        # with a journal, raw files are removed only after the cropped file has been verified
+        crop_args = (destination_folder, lat_min, lat_max, lon_min, lon_max, codec, complevel, journal is None, domain_folders, packed)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=n_workers) as download_pool, \
+             ProcessPoolExecutor(max_workers=n_processes) as crop_pool:
+            # files downloaded by a previous run
+            for file_name in to_crop:
+                if claimed(file_name):
+                    pending[crop_pool.submit(crop_and_save, os.path.join(raw_folder, file_name), *crop_args)] = ('crop', file_name)
             
-            # drop unnecessary variables
-            variables_to_drop = ['calslp_irwin', 'calslp_irwin', 'calslp_irwvp', 'caloff_irwvp', 'vis_rad_slope', 'vis_dc_slope', 'vis_dc_offset', 'irwin_2', 'irwin_3', 'irwvp', 'vschn', 'vschn_2', 'satid_ir', 'satid_wv', 'satid_vs', 'sparse2ir', 'sparse2wv','sparse2vs', 'satid_ir3', 'irwin_vza_adj']
-            ds_out = ds_out.drop_vars(variables_to_drop)
+            for file_name in to_download:
+                if not claimed(file_name):
+                    continue
+                url = path_url + file_name  # Construct the full URL
+                if journal is not None:
+                    set_state(journal, 'geost', file_name, 'downloading')
+                pending[download_pool.submit(download_file, session, url, os.path.join(raw_folder, file_name))] = ('download', file_name)
+                
+                # wait for a free slot before submitting the next download
+                while len(pending) >= max_in_flight:
+                    pending = _collect_completed(pending, crop_pool, crop_args, journal, raw_folder, work_queue)
             
-            # Save the cropped dataset to a new file
-            ds_out.to_netcdf(os.path.join(destination_folder, file_name), 
-                encoding={'irwin_cdr': {"zlib": True, "complevel": 9}})            
-            print(f"Cropped and saved: {file_name} to {destination_folder}")
-            
-            # Optionally, you can delete the original file after moving
-            os.remove(file_name)
+            while pending:
+                pending = _collect_completed(pending, crop_pool, crop_args, journal, raw_folder, work_queue)
+        
+        session.close()
+        write_textfile()
+    finally:
+        # leases of the files not completed go back to the queue
+        if work_queue is not None:
+            close_queue(work_queue)
            
     return()
 
-def read_crop_geost(file_name, lat_min, lat_max, lon_min, lon_max):
+def _collect_completed(pending, crop_pool, crop_args, journal=None, raw_folder='.', work_queue=None):
+    """
+    Wait for at least one download or crop to complete. Completed downloads
+    are submitted to the crop pool, completed crops are checked for errors.
+    With a journal, the new state of the completed files is recorded and the
+    cropped files are verified before the raw files are deleted.
+    With a work queue, completed files are marked done and the leases of the
+    files that could not be downloaded, cropped or verified are released.
+    A failed file is reported and left to the next run, the other files continue.
+    Args:
+        pending (dict): running futures mapped to their (stage, file name).
+        crop_pool (ProcessPoolExecutor): pool cropping and saving the files (None for the remote crops).
+        crop_args (tuple): arguments of crop_and_save following the file name.
+        journal (sqlite3.Connection): ingest journal (None = no journal).
+        raw_folder (str): folder of the downloaded raw files.
+        work_queue (dict): work queue shared with the other workers (None = single worker).
+    Returns:
+        pending (dict): futures that are still running.
+    """
+    import os
+    from concurrent.futures import wait, FIRST_COMPLETED
+    from ingest_journal import set_state
+    from metrics import gauge, merge
+    from work_queue import mark_done, release
+    
+    gauge('geost_in_flight', len(pending))
+    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+    pending_out = {future: pending[future] for future in not_done}
+    for future in done:
+        stage, file_name = pending[future]
+        try:
+            result = future.result()
+        except Exception as error:
+            print(f"Failed to {stage} {file_name}: {error}")
+            if work_queue is not None:
+                release(work_queue, file_name)
+            continue
+        if stage == 'download' and result:
+            if journal is not None:
+                set_state(journal, 'geost', file_name, 'downloaded')
+            pending_out[crop_pool.submit(crop_and_save, os.path.join(raw_folder, file_name), *crop_args)] = ('crop', file_name)
+        elif stage == 'download':
+            if work_queue is not None:
+                release(work_queue, file_name)
+        elif stage == 'crop':
+            # metrics of the crop process
+            merge(result)
+            finished = True
+            if journal is not None:
+                set_state(journal, 'geost', file_name, 'written')
+                finished = _finish_granule(journal, file_name, crop_args[0], raw_folder)
+            if work_queue is not None and finished:
+                mark_done(work_queue, file_name)
+            elif work_queue is not None:
+                release(work_queue, file_name)
+    
+    return pending_out
+
+def _finish_granule(journal, file_name, destination_folder, raw_folder='.'):
+    """
+    Verify a written file and delete its raw file, recording the states in the journal.
+    If the written file is not valid, the file goes back to the state 'listed'.
+    Args:
+        journal (sqlite3.Connection): ingest journal.
+        file_name (str): name of the GridSat file.
+        destination_folder (str): The folder of the cropped files.
+        raw_folder (str): folder of the downloaded raw files.
+    Returns:
+        (bool): True if the file is verified and cleaned.
+    """
+    import os
+    from ingest_journal import set_state, verify_netcdf
+    
+    if not verify_netcdf(os.path.join(destination_folder, file_name)):
+        set_state(journal, 'geost', file_name, 'listed')
+        return False
+    set_state(journal, 'geost', file_name, 'verified')
+    
+    # delete the raw file
+    raw_file = os.path.join(raw_folder, file_name)
+    if os.path.exists(raw_file):
+        os.remove(raw_file)
+    set_state(journal, 'geost', file_name, 'cleaned')
+    
+    return True
+
+def download_file(session, url, file_name):
+    """
+    Download one file (in the current directory or in the raw folder of the worker) using a shared session.
+    The file is streamed to disk and an interrupted transfer is resumed
+    from the partial file left by a previous run.
+    
+    dependencies:
+    - download_utils.stream_download
+    Args:
+        session (requests.Session): session shared between the download workers.
+        url (str): URL of the file to download.
+        file_name (str): local name of the downloaded file.
+    Returns:
+        (bool): True if the file was downloaded, False otherwise.
+    """
+    import os
+    from download_utils import stream_download
+    from metrics import stage
+    
+    # Download the file
+    with stage('geost_download', file=os.path.basename(file_name)) as record:
+        downloaded = stream_download(session, url, file_name)
+        record['files'] = int(downloaded)
+        record['bytes'] = os.path.getsize(file_name) if downloaded else 0
+    if downloaded:
+        print(f"Downloaded: {file_name}")
+    
+    return downloaded
+
+def crop_and_save(file_name, destination_folder, lat_min, lat_max, lon_min, lon_max, codec='zlib', complevel=9, remove_raw=True,
+                  domain_folders=None, packed=True):
+    """
+    Crop a downloaded file, drop unnecessary variables, save the compressed
+    result in the destination folder and delete the original file.
+    The cropped file is written to a temporary file and renamed when complete.
+    Other domains of the registry (domains.py) can be cut from the same read of the
+    file, each one saved in its own folder.
+    
+    dependencies:
+    - read_crop_geost
+    Args:
+        file_name (str): The path of the downloaded file (the cropped file gets its name).
+        destination_folder (str): The folder where the cropped file is saved.
+        lat_min (float): Minimum latitude for cropping.
+        lat_max (float): Maximum latitude for cropping.
+        lon_min (float): Minimum longitude for cropping.
+        lon_max (float): Maximum longitude for cropping.
+        codec (str): compression codec (see compression_encoding).
+        complevel (int): compression level.
+        remove_raw (bool): delete the downloaded file after saving the cropped one.
+        domain_folders (dict): output folder of each other domain to cut, by domain name.
+        packed (bool): write irwin_cdr as packed integers (see packing.py).
+    Returns:
+        counters (dict): metrics of the stages run in this call, to be merged by the
+            parent process (see metrics.collect).
+    """
+    import os
+    from metrics import stage, collect
+    
+    domain_folders = domain_folders or {}
+    
+    # read and crop the file (the crops are small, they are loaded to time the read separately from the write)
+    with stage('geost_crop', nbytes=os.path.getsize(file_name), file=os.path.basename(file_name)):
+        ds_out, domain_crops = read_crop_geost(file_name, lat_min, lat_max, lon_min, lon_max, 
+                                               domains=list(domain_folders))
+        ds_out = ds_out.load()
+        domain_crops = {name: crop.load() for name, crop in domain_crops.items()}
+    
+    # save the main domain and the other domains
+    _save_crops([(ds_out, destination_folder)] + [(domain_crops[name], domain_folders[name]) for name in domain_folders],
+                os.path.basename(file_name), codec, complevel, packed)
+    
+    # Optionally, you can delete the original file after moving
+    if remove_raw:
+        os.remove(file_name)
+    
+    return collect()
+
+def crop_and_save_remote(url, file_name, destination_folder, lat_min, lat_max, lon_min, lon_max, codec='zlib', complevel=9,
+                         domain_folders=None, packed=True):
+    """
+    Read the domain from a remote file, drop unnecessary variables and save the
+    compressed result in the destination folder, without downloading the global file.
+    With other domains, the box containing all of them is read once and each domain
+    is cut from it.
+    
+    dependencies:
+    - read_crop_geost_remote
+    Args:
+        url (str): URL of the remote file.
+        file_name (str): The name of the cropped file in the destination folder.
+        destination_folder (str): The folder where the cropped file is saved.
+        lat_min (float): Minimum latitude for cropping.
+        lat_max (float): Maximum latitude for cropping.
+        lon_min (float): Minimum longitude for cropping.
+        lon_max (float): Maximum longitude for cropping.
+        codec (str): compression codec (see compression_encoding).
+        complevel (int): compression level.
+        domain_folders (dict): output folder of each other domain to cut, by domain name.
+        packed (bool): write irwin_cdr as packed integers (see packing.py).
+    Returns:
+        counters (dict): metrics of the stages run in this call (see metrics.collect).
+    """
+    from domains import domain_bounds, crop_domains
+    from metrics import stage, collect
+    
+    domain_folders = domain_folders or {}
+    
+    # box containing all the domains
+    bounds = [(lat_min, lat_max, lon_min, lon_max)] + [domain_bounds(name) for name in domain_folders]
+    with stage('geost_remote_crop', file=file_name) as record:
+        ds_box = read_crop_geost_remote(url, 
+                                        min(b[0] for b in bounds), max(b[1] for b in bounds), 
+                                        min(b[2] for b in bounds), max(b[3] for b in bounds), 
+                                        variables_to_drop)
+        record['bytes'] = ds_box.nbytes
+    
+    ds_out = ds_box.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
+    domain_crops = crop_domains(ds_box, list(domain_folders))
+    _save_crops([(ds_out, destination_folder)] + [(domain_crops[name], domain_folders[name]) for name in domain_folders],
+                file_name, codec, complevel, packed)
+    
+    return collect()
+
+def _save_crops(crops, file_name, codec, complevel, packed=True):
+    """
+    Drop unnecessary variables and save each cropped dataset in its folder.
+    Args:
+        crops (list): list of (cropped dataset, output folder).
+        file_name (str): The name of the cropped files.
+        codec (str): compression codec (see compression_encoding).
+        complevel (int): compression level.
+        packed (bool): write irwin_cdr as packed integers and check the round trip (see packing.py).
+    """
+    import os
+    from pathlib import Path
+    from ingest_journal import atomic_to_netcdf
+    from packing import write_packed
+    
+    for ds_out, folder in crops:
+        # drop unnecessary variables
+        ds_out = ds_out.drop_vars(variables_to_drop, errors='ignore')
+        
+        # Save the cropped dataset to a new file
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        if packed:
+            write_packed(ds_out, os.path.join(folder, file_name), 'geost', 
+                         compression=compression_encoding(codec, complevel), stage_name='geost_write')
+        else:
+            atomic_to_netcdf(ds_out, os.path.join(folder, file_name), stage_name='geost_write',
+                encoding={'irwin_cdr': compression_encoding(codec, complevel)})            
+        print(f"Cropped and saved: {file_name} to {folder}")
+
+def read_crop_geost_remote(url, lat_min, lat_max, lon_min, lon_max, drop_variables=(), block_size=2**20):
+    """read a remote NetCDF4 file over HTTP and crop the domain.
+    The file is opened with fsspec, which fetches only the byte ranges requested
+    by the HDF5 library: the file metadata, the coordinates and the chunks of the 
+    kept variables that intersect the domain. The cropped data are loaded in 
+    memory before the remote file is closed.
+    Args:
+        url (str): The URL of the file to read.
+        lat_min (float): Minimum latitude for cropping.
+        lat_max (float): Maximum latitude for cropping.
+        lon_min (float): Minimum longitude for cropping.
+        lon_max (float): Maximum longitude for cropping.
+        drop_variables (list): variables that are never read.
+        block_size (int): size in bytes of the blocks fetched with each range request."""
+    
+    import fsspec
+    import xarray as xr
+    
+    from projection import kept_variables
+    
+    with fsspec.open(url, mode='rb', block_size=block_size, cache_type='blockcache') as f:
+        ds = xr.open_dataset(f, engine='h5netcdf', drop_variables=drop_variables)
+        
+        # Crop the dataset and read the selected chunks of the kept variables only
+        crop_ds = ds[kept_variables['geost']].sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max)).load()
+        ds.close()
+    
+    return crop_ds
+
+def compression_encoding(codec='zlib', complevel=9):
+    """
+    Build the netCDF encoding of a compressed variable.
+    Args:
+        codec (str): 'zlib' (deflate), 'none', or any other codec supported by
+            netCDF4 >= 1.6 (e.g. 'zstd', 'bzip2', 'blosc_lz4', 'blosc_zstd').
+        complevel (int): compression level.
+    Returns:
+        encoding (dict): encoding of the variable for to_netcdf.
+    """
+    if codec == 'none':
+        return {}
+    if codec == 'zlib':
+        return {"zlib": True, "complevel": complevel}
+    return {"compression": codec, "complevel": complevel}
+
+def compression_report(file_name, lat_min, lat_max, lon_min, lon_max, settings=None, report_file=None):
+    """
+    Compare the size of the cropped file and the time needed to write it for
+    several compression settings, to choose the codec and level of download_from_list.
+    Args:
+        file_name (str): a downloaded (global) GridSat file.
+        lat_min, lat_max, lon_min, lon_max (float): cropping bounds.
+        settings (list): list of (codec, complevel) to compare.
+        report_file (str): if given, the report is also saved in this csv file.
+    Returns:
+        report (list): for each setting a dict with codec, complevel, size_mb and write_s.
+    """
+    import os
+    import time
+    import tempfile
+    
+    if settings is None:
+        settings = [('none', 0), ('zlib', 1), ('zlib', 4), ('zlib', 9), ('zstd', 3), ('zstd', 9)]
+    
+    # crop once and keep the data in memory, so that only compression and writing are timed
+    ds_out = read_crop_geost(file_name, lat_min, lat_max, lon_min, lon_max)
+    ds_out = ds_out.drop_vars(variables_to_drop, errors='ignore').load()
+    
+    report = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for codec, complevel in settings:
+            out_name = os.path.join(tmp_dir, f'{codec}_{complevel}.nc')
+            start = time.perf_counter()
+            ds_out.to_netcdf(out_name, encoding={'irwin_cdr': compression_encoding(codec, complevel)})
+            write_s = time.perf_counter() - start
+            report.append({'codec': codec, 
+                           'complevel': complevel, 
+                           'size_mb': os.path.getsize(out_name) / 1e6, 
+                           'write_s': write_s})
+    
+    print(f"{'codec':>10} {'level':>5} {'size [MB]':>10} {'write [s]':>10}")
+    for line in report:
+        print(f"{line['codec']:>10} {line['complevel']:>5} {line['size_mb']:>10.3f} {line['write_s']:>10.3f}")
+    
+    if report_file is not None:
+        with open(report_file, 'w') as file:
+            file.write('codec,complevel,size_mb,write_s\n')
+            for line in report:
+                file.write(f"{line['codec']},{line['complevel']},{line['size_mb']:.6f},{line['write_s']:.6f}\n")
+    
+    return report
+
+def read_crop_geost(file_name, lat_min, lat_max, lon_min, lon_max, domains=None):
     
     """read file with xaryar and crop the domain
+    Only the kept variables (projection.kept_variables) are read, in the window of the domains.
     Args:
         file_name (str): The name of the file to read.
         lat_min (float): Minimum latitude for cropping.
         lat_max (float): Maximum latitude for cropping.
         lon_min (float): Minimum longitude for cropping.
-        lon_max (float): Maximum longitude for cropping."""
+        lon_max (float): Maximum longitude for cropping.
+        domains (list): names of other domains of the registry (domains.py) cut from the same read.
+    Returns:
+        crop_ds (xarray.Dataset): the cropped dataset, or if domains is given a tuple 
+            (crop_ds, domain_crops) where domain_crops is the dict of the crops of the other domains."""
         
-    import xarray as xr
-    ds = xr.open_dataset(file_name)
+    from domains import domain_bounds, crop_domains
+    from projection import open_projected
+    
+    # open only the kept variables in the box containing all the domains
+    bounds = [(lat_min, lat_max, lon_min, lon_max)] + [domain_bounds(name) for name in (domains or [])]
+    ds = open_projected([file_name], 'geost', 
+                        min(b[0] for b in bounds), max(b[1] for b in bounds), 
+                        min(b[2] for b in bounds), max(b[3] for b in bounds))
     
     # Crop the dataset to the specified latitude and longitude bounds
     crop_ds = ds.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
+    if domains is not None:
+        domain_crops = crop_domains(ds, domains)
     # Optionally, you can close the dataset after cropping
     ds.close()
+    if domains is not None:
+        return crop_ds, domain_crops
     return crop_ds
 
 
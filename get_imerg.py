@@ -8,143 +8,652 @@
     Other options instead is to get the data with wget or curl, but this is more complicated
     From this link https://disc.gsfc.nasa.gov/datasets/GPM_3IMERGHH_07/summary?keywords=IMERG one can do that way
 """
-import earthaccess
-import xarray as xr
-import numpy as np
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
-import matplotlib.ticker as mticker
-from matplotlib.colors import BoundaryNorm
 import os
+import json
+import time
+import queue
+import shutil
+import socket
+import threading
 from datetime import datetime, timedelta
+from zarr_archive import ingest_folder
+from time_index import update_time_index
+from domains import domain_bounds, domain_folder, crop_domains
+from ingest_journal import open_journal, add_granules, get_states, set_state, reached, atomic_to_netcdf, verify_netcdf, seed_from_outputs
+from metrics import configure, stage, gauge, write_textfile
+from work_queue import open_queue, claim, mark_done, release, close_queue
 
+# delay after which all the granules of a day are published (IMERG Final run: about 3.5 months)
+publication_delay = timedelta(days=120)
 
-def main():
 
-    plotting = 'no'
-    # define ITCZ domain
-    lat_min = -15
-    lat_max = 15
-    lon_min = -66
-    lon_max = 15
+def main(config=None):
+    """
+    Download, crop and store the IMERG days of a year.
+    input:
+        config (dict): settings overriding the defaults below (the [imerg] section of the
+            configuration file of itcz_cli.py), None = defaults.
+    """
+    import earthaccess
+
+    config = config or {}
 
-    path_imerg = '/data/trade_pc/ITCZ/2024/imerg'
+    plotting = config.get('plotting', 'no')
+    # read only the ITCZ window from the remote granules instead of downloading them
+    remote_subset = config.get('remote_subset', 'no')
+    # download the next days while the previous ones are cropped and written
+    pipelined = config.get('pipelined', 'yes')
+    # days for the analysis
+    year = int(config.get('year', 2024))
+    # append the daily files to the consolidated Zarr archive (None = netCDF files only)
+    zarr_store = config.get('zarr_store', '/data/trade_pc/ITCZ/{year}/imerg.zarr')
+    if zarr_store is not None:
+        zarr_store = zarr_store.format(year=year)
+    # journal of the state of each day, to resume interrupted runs
+    journal_file = config.get('journal_file', '/data/trade_pc/ITCZ/ingest_journal.sqlite')
+    # store precipitation as packed uint16 (0.01 mm/hr) instead of floats, checking the round trip
+    packed = config.get('packed', 'yes')
+    # timing events (JSON lines) and summary for the Prometheus textfile collector (see metrics.py)
+    metrics_folder = config.get('metrics_folder', '/data/trade_pc/ITCZ/metrics')
+    # work queue shared by several copies of this script, on one or more machines (see work_queue.py)
+    queue_folder = config.get('queue_folder', None)  # e.g. '/data/trade_pc/ITCZ/queue', None = single worker
+    # define ITCZ domain (see domains.py)
+    domain_name = config.get('domain', 'itcz')
+    lat_min, lat_max, lon_min, lon_max = domain_bounds(domain_name)
+    # other domains cut from the same granules, each one saved in its own tree
+    other_domains = config.get('other_domains', [])  # e.g. ['trade_wind', 'west_africa']
+
+    days = generate_days(year)
+    
+    path_imerg = domain_folder(domain_name, year, 'imerg')
+    domain_folders = {name: domain_folder(name, year, 'imerg') for name in other_domains}
     domain = [lon_min,lat_min,lon_max, lat_max]
     #domain_all = [-180, 0, 180, 90]
     
-    # days for the analysis
-    year = 2024
-    days = generate_days(year)
+    configure(events_file=metrics_folder + '/imerg_events.jsonl', textfile=metrics_folder + '/imerg.prom')
+    
+    if queue_folder is not None:
+        # one journal per machine, SQLite locking is not reliable across machines on network filesystems
+        journal_file = journal_file.replace('.sqlite', '_' + socket.gethostname() + '.sqlite')
+        queue_folder = queue_folder + '/imerg_' + str(year)
+    
+    # Authenticate once with Earthdata Login servers for the whole run
+    earthaccess.login()
+    
+    # search all the granules of the period once, or read them from the catalog of a previous run
+    catalog_file = path_imerg + '/granule_catalog_' + days[0] + '_' + days[-1] + '.json'
+    catalog = get_granule_catalog(days[0], days[-1], domain, catalog_file)
+    
+    if pipelined == 'yes':
+        process_days_pipelined(days, catalog, path_imerg, lat_min, lat_max, lon_min, lon_max,
+                               remote_subset=remote_subset, journal_file=journal_file,
+                               domain_folders=domain_folders, packed=packed, queue_folder=queue_folder)
+        update_time_index(path_imerg, 'imerg')
+        if zarr_store is not None:
+            ingest_folder(path_imerg, 'imerg', store=zarr_store)
+        return
+    
+    work_queue = open_queue(queue_folder) if queue_folder is not None else None
+    
+    # journal of the days, each day is processed again from the download unless it is cleaned
+    journal = None
+    if journal_file is not None:
+        journal = open_journal(journal_file)
+        add_granules(journal, 'imerg', days)
+        seed_from_outputs(journal, 'imerg', {day: path_imerg + '/' + day + '_imerg_30min_ITCZ.nc' for day in days})
+        day_states = get_states(journal, 'imerg')
     
     for day in days:
         
         print('Processing day:', day)
         
-        # check if the file already exists
+        # check if the day is already processed
         file_name = path_imerg + '/' + day + '_imerg_30min_ITCZ.nc'
-        if os.path.exists(file_name):
+        if journal is None and os.path.exists(file_name):
             print('File already exists:', file_name)
             continue
+        if journal is not None and day_states[day][0] == 'cleaned':
+            continue
         
-        # search files
-        start = day
-        end = day
-        results = auth_and_search(start, end)
+        # skip the days processed by another worker
+        if work_queue is not None and not claim(work_queue, day):
+            continue
         
-        # download files for the given day 
-        downloaded_files = download_imerg_granule(results, path_imerg)
+        # granules of the day from the catalog
+        start = day
+        results = [granule['url'] for granule in catalog.get(day, [])]
+        if len(results) == 0:
+            print('No granules found for day:', day)
+            if work_queue is not None:
+                mark_done(work_queue, day)
+            continue
         
-        # read and crop the dataset and merge in one dataset
-        ds = read_and_crop_dataset(downloaded_files, lat_min, lat_max, lon_min, lon_max)
+        if remote_subset == 'yes':
+            # read and crop the remote granules, nothing is downloaded
+            downloaded_files = []
+            ds, domain_crops = read_and_crop_remote(results, lat_min, lat_max, lon_min, lon_max, 
+                                                    domains=list(domain_folders))
+        else:
+            # download files for the given day 
+            if journal is not None:
+                set_state(journal, 'imerg', day, 'downloading')
+            downloaded_files = download_imerg_granule(results, path_imerg)
+            if journal is not None:
+                set_state(journal, 'imerg', day, 'downloaded', downloaded_files)
+            
+            # read and crop the dataset and merge in one dataset
+            ds, domain_crops = read_and_crop_dataset(downloaded_files, lat_min, lat_max, lon_min, lon_max, 
+                                                     domains=list(domain_folders))
 
         if plotting == 'yes':
             # plot the data for first time stamp
             plot_test_imerg(ds, lat_min, lat_max, lon_min, lon_max)
         
+        # store the other domains, then the ITCZ
+        for name, folder in domain_folders.items():
+            os.makedirs(folder, exist_ok=True)
+            write_imerg(domain_crops[name], domain_file_name(folder, start, name), packed)
+        
         # store to ncdf
-        ds.to_netcdf(path_imerg + '/'+ start + '_imerg_30min_ITCZ.nc', mode='w')
+        write_imerg(ds, path_imerg + '/'+ start + '_imerg_30min_ITCZ.nc', packed)
+        if journal is not None:
+            set_state(journal, 'imerg', day, 'written')
+            if not verify_netcdf(file_name):
+                set_state(journal, 'imerg', day, 'listed')
+                print('Verification failed for:', file_name)
+                if work_queue is not None:
+                    release(work_queue, day)
+                continue
+            set_state(journal, 'imerg', day, 'verified')
         
         # delete the downloaded files
         for file in downloaded_files:
             print('Deleting file:', file)
             os.remove(file)
+        if journal is not None:
+            set_state(journal, 'imerg', day, 'cleaned')
+        if work_queue is not None:
+            mark_done(work_queue, day)
+    if work_queue is not None:
+        close_queue(work_queue)
     print('All files processed and deleted.')
+    write_textfile()
+    
+    # index the time steps of the new days
+    update_time_index(path_imerg, 'imerg')
+    
+    # append the new days to the Zarr archive
+    if zarr_store is not None:
+        ingest_folder(path_imerg, 'imerg', store=zarr_store)
+
+def process_days_pipelined(days, catalog, path_imerg, lat_min, lat_max, lon_min, lon_max,
+                           queue_size=2, min_free_gb=20, remote_subset='no', journal_file=None, domain_folders=None,
+                           packed='yes', queue_folder=None):
+    """
+    Process the days with a pipeline of stages running in separate threads:
+    search (granules of the day from the catalog) -> download -> crop/merge -> write -> cleanup.
+    Stages are connected by bounded queues, so that the download of the next day
+    runs while the previous day is cropped and written, and at most queue_size 
+    days wait between two stages. The download stage also waits while the free
+    disk space in path_imerg is below min_free_gb plus the size of the day to download.
+    A day that fails in one stage is reported and skipped by the following stages.
+    Download, crop and write times and the depths of the queues are recorded in the
+    metrics (see metrics.py).
+    Daily files are written to a temporary file and renamed when complete. With a 
+    journal_file the state of each day is tracked in the ingest journal (see 
+    ingest_journal.py) and each day restarts from its first unfinished stage.
+    Other domains of the registry (domains.py) are cut from the same read of each day
+    and saved in their own folders.
+    With a queue_folder, several workers (processes or machines) share the days: a day
+    enters the pipeline only if this worker takes its lease in the work queue (see
+    work_queue.py), it is marked done after the cleanup, and the leases of the failed
+    days are released at the end of the run.
+    input:
+        days (list): days to process in the format 'YYYY-MM-DD'.
+        catalog (dict): granule catalog grouped by day (see get_granule_catalog).
+        path_imerg (str): folder for downloaded granules and output files.
+        lat_min, lat_max, lon_min, lon_max (float): cropping bounds.
+        queue_size (int): maximum number of days waiting between two stages.
+        min_free_gb (float): free disk space (GB) to keep in path_imerg.
+        remote_subset (str): 'yes' to read the domain from the remote granules instead of downloading them.
+        journal_file (str): path of the ingest journal (None = skip days whose file exists).
+        domain_folders (dict): output folder of each other domain, by domain name.
+        packed (str): 'yes' to write precipitation as packed integers (see write_imerg).
+        queue_folder (str): folder of the work queue shared by the workers (None = single worker).
+    output:
+        failed_days (list): days that could not be processed.
+    """
+    failed_days = []
+    domain_folders = domain_folders or {}
+    work_queue = open_queue(queue_folder) if queue_folder is not None else None
+    
+    journal = None
+    if journal_file is not None:
+        journal = open_journal(journal_file)
+        add_granules(journal, 'imerg', days)
+        # daily files written before the journal (the ITCZ file is written after the other domains)
+        seed_from_outputs(journal, 'imerg', {day: path_imerg + '/' + day + '_imerg_30min_ITCZ.nc' for day in days})
+        day_states = get_states(journal, 'imerg')
+
+    def record(day, state, files=None):
+        if journal is not None:
+            set_state(journal, 'imerg', day, state, files)
+
+    def search_stage(day):
+        file_name = path_imerg + '/' + day + '_imerg_30min_ITCZ.nc'
+        if journal is None:
+            state, files = 'listed', []
+            # check if the file already exists
+            if os.path.exists(file_name):
+                print('File already exists:', file_name)
+                return None
+        else:
+            state, files = day_states[day]
+            if state == 'cleaned':
+                return None
+        # skip the days processed by another worker
+        if work_queue is not None and not claim(work_queue, day):
+            return None
+        granules = catalog.get(day, [])
+        if len(granules) == 0:
+            print('No granules found for day:', day)
+            if work_queue is not None:
+                mark_done(work_queue, day)
+            return None
+        return {'day': day, 'state': state, 'granules': granules, 'files': files, 'file_name': file_name}
+
+    def download_stage(item):
+        # raw files of a previous run are still on disk
+        if remote_subset != 'yes' and reached(item['state'], 'downloaded') \
+                and all(os.path.exists(file) for file in item['files']):
+            return item
+        urls = [granule['url'] for granule in item['granules']]
+        if remote_subset == 'yes':
+            item['sources'] = urls
+            return item
+        # backpressure on disk space
+        day_size = sum(granule['size'] or 0 for granule in item['granules']) * 1e6
+        wait_for_disk_space(path_imerg, day_size + min_free_gb * 1e9)
+        print('Downloading day:', item['day'])
+        record(item['day'], 'downloading')
+        item['files'] = download_imerg_granule(urls, path_imerg)
+        item['state'] = 'downloaded'
+        record(item['day'], 'downloaded', item['files'])
+        return item
+
+    def crop_stage(item):
+        if reached(item['state'], 'written'):
+            return item
+        print('Processing day:', item['day'])
+        if remote_subset == 'yes':
+            item['ds'], item['domain_crops'] = read_and_crop_remote(item['sources'], lat_min, lat_max, lon_min, lon_max,
+                                                                    domains=list(domain_folders))
+        else:
+            ds, domain_crops = read_and_crop_dataset(item['files'], lat_min, lat_max, lon_min, lon_max,
+                                                     domains=list(domain_folders))
+            with stage('imerg_crop', files=len(item['files']), day=item['day']) as crop_record:
+                item['ds'] = ds.load()
+                item['domain_crops'] = {name: crop.load() for name, crop in domain_crops.items()}
+                crop_record['bytes'] = item['ds'].nbytes
+        record(item['day'], 'cropped')
+        return item
+
+    def write_stage(item):
+        if not reached(item['state'], 'written'):
+            # store the other domains first, so that 'written' means all the domains are written
+            for name, folder in domain_folders.items():
+                os.makedirs(folder, exist_ok=True)
+                write_imerg(item['domain_crops'][name], domain_file_name(folder, item['day'], name), packed)
+            # store to ncdf
+            write_imerg(item['ds'], item['file_name'], packed)
+            item['ds'].close()
+            record(item['day'], 'written')
+        if journal is not None and not reached(item['state'], 'verified'):
+            if not verify_netcdf(item['file_name']):
+                record(item['day'], 'listed')
+                raise IOError('verification failed for ' + item['file_name'])
+            record(item['day'], 'verified')
+        return item
+
+    def cleanup_stage(item):
+        # delete the downloaded files
+        for file in item['files']:
+            if os.path.exists(file):
+                print('Deleting file:', file)
+                os.remove(file)
+        record(item['day'], 'cleaned')
+        if work_queue is not None:
+            mark_done(work_queue, item['day'])
+        return None
+
+    stages = [search_stage, download_stage, crop_stage, write_stage, cleanup_stage]
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages))]
+
+    threads = []
+    # stage_function, not stage: crop_stage calls metrics.stage
+    for i, stage_function in enumerate(stages):
+        out_queue = queues[i + 1] if i + 1 < len(stages) else None
+        thread = threading.Thread(target=_run_stage, args=(stage_function, queues[i], out_queue, failed_days),
+                                  name=stage_function.__name__, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    # feed the pipeline, None marks the end of the days
+    for day in days:
+        queues[0].put(day)
+    queues[0].put(None)
+
+    for thread in threads:
+        thread.join()
+    # leases of the failed days go back to the queue
+    if work_queue is not None:
+        close_queue(work_queue)
+
+    if len(failed_days) > 0:
+        print('Days not processed:', sorted(failed_days))
+    else:
+        print('All files processed and deleted.')
+    write_textfile()
+    return failed_days
+
+def write_imerg(ds, file_name, packed='yes'):
+    """
+    Write a daily IMERG file atomically, with precipitation, randomError and
+    precipitationQualityIndex packed as uint16 and the round trip checked
+    (see packing.py), or as decoded floats.
+    input:
+        ds (xarray.Dataset): cropped daily dataset.
+        file_name (str): path of the daily file.
+        packed (str): 'yes' to write packed integers.
+    """
+    from packing import write_packed
+
+    if packed == 'yes':
+        write_packed(ds, file_name, 'imerg', stage_name='imerg_write')
+    else:
+        atomic_to_netcdf(ds, file_name, stage_name='imerg_write', mode='w')
+
+def domain_file_name(folder, day, name):
+    """
+    Name of the daily file of a domain other than the ITCZ.
+    input:
+        folder (str): output folder of the domain.
+        day (str): day in the format 'YYYY-MM-DD'.
+        name (str): name of the domain.
+    output:
+        file_name (str): folder/<day>_imerg_30min_<NAME>.nc
+    """
+    return folder + '/' + day + '_imerg_30min_' + name.upper() + '.nc'
+
+def _run_stage(stage, in_queue, out_queue, failed_days):
+    """
+    Run one stage of the pipeline: apply stage to every item of in_queue and put
+    the result (if not None) in out_queue, until the end marker None is received.
+    input:
+        stage (function): function applied to each item.
+        in_queue (queue.Queue): input items.
+        out_queue (queue.Queue or None): output items (None for the last stage).
+        failed_days (list): list where the days failing in this stage are appended.
+    """
+    while True:
+        item = in_queue.get()
+        # depth of the queue in front of the stage
+        gauge('imerg_queue_' + stage.__name__, in_queue.qsize())
+        if item is None:
+            if out_queue is not None:
+                out_queue.put(None)
+            return
+        try:
+            result = stage(item)
+        except Exception as error:
+            day = item if isinstance(item, str) else item['day']
+            print('Error in', stage.__name__, 'for day', day, ':', error)
+            failed_days.append(day)
+            continue
+        if result is not None and out_queue is not None:
+            out_queue.put(result)
+
+def wait_for_disk_space(path, required_bytes, poll_seconds=30):
+    """
+    Block until the free disk space in path is at least required_bytes.
+    input:
+        path (str): folder on the disk to check.
+        required_bytes (float): required free space in bytes.
+        poll_seconds (float): time between two checks.
+    """
+    os.makedirs(path, exist_ok=True)
+    while shutil.disk_usage(path).free < required_bytes:
+        print('Waiting for free disk space in', path)
+        time.sleep(poll_seconds)
 
 def generate_days(year=2024):
     """
-    Generates an array of strings representing all days in 2024.
+    Generates an array of strings representing all days of a year.
     input:
         year (int): The year for which to generate the dates.
     Returns:
         list: A list of date strings in the format 'YYYY-MM-DD'.
     """
-    start_date = datetime(2024, 1, 1)  # Start of 2024
-    end_date = datetime(2024, 12, 31)  # End of 2024
+    start_date = datetime(int(year), 1, 1)  # Start of the year
+    end_date = datetime(int(year), 12, 31)  # End of the year
 
-    # Generate all days in 2024
+    # Generate all days of the year
     days = [(start_date + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((end_date - start_date).days + 1)]
     return days
 
          
-def auth_and_search(start, end):
+def auth_and_search(start, end, bounding_box=(-180, 0, 180, 90)):
     """
     Authenticate with Earthdata Login servers and search for granules.
     input:
         start (str): Start date in YYYY-MM-DD format.
         end (str): End date in YYYY-MM-DD format.
+        bounding_box (tuple): (lon_min, lat_min, lon_max, lat_max) of the search.
     output:
         results (list): List of granule metadata.
     """
+    import earthaccess
+
     # Authenticate with Earthdata Login servers
     auth = earthaccess.login()
 
     # Search for granules
+    results = search_granules(start, end, bounding_box)
+
+    # Print search results
+    print(results)
+    return results
+
+def search_granules(start, end, bounding_box):
+    """
+    Search for IMERG half-hourly granules (requires a previous earthaccess.login()).
+    input:
+        start (str): Start date in YYYY-MM-DD format.
+        end (str): End date in YYYY-MM-DD format.
+        bounding_box (tuple): (lon_min, lat_min, lon_max, lat_max) of the search.
+    output:
+        results (list): List of granule metadata.
+    """
+    import earthaccess
+
     results = earthaccess.search_data(
         short_name="GPM_3IMERGHH",
         version="07",
         temporal=(start, end),
-        bounding_box=(-180, 0, 180, 90)
+        bounding_box=tuple(bounding_box)
     )
-
-    # Print search results
-    print(results)
     return results
 
+def get_granule_catalog(start, end, domain, catalog_file, search=search_granules):
+    """
+    Return the catalog of the granules between start and end, grouped by day.
+    The catalog is read from catalog_file if it exists and was built for the same
+    period and domain; otherwise one search is done for the whole period and the
+    catalog is saved to catalog_file, so that following runs do not search again.
+    A catalog searched less than publication_delay after the end of the period (year in
+    progress) may miss granules published since: the period after its last granule is
+    searched again and the new granules are added.
+    input:
+        start (str): Start date in YYYY-MM-DD format.
+        end (str): End date in YYYY-MM-DD format.
+        domain (list): [lon_min, lat_min, lon_max, lat_max] of the search.
+        catalog_file (str): path of the json file storing the catalog.
+        search (function): search backend called as search(start, end, domain),
+            returning earthaccess granules (can be replaced by a stub).
+    output:
+        catalog (dict): for each day 'YYYY-MM-DD' the list of granules, each one a dict
+            with keys granule_id, url, time and size (MB).
+    """
+    catalog = {}
+    search_start = start
+    if os.path.exists(catalog_file):
+        with open(catalog_file, 'r') as file:
+            stored = json.load(file)
+        if stored['start'] == start and stored['end'] == end and stored['domain'] == list(domain):
+            complete_after = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) + publication_delay
+            if 'searched' in stored and datetime.fromisoformat(stored['searched']) >= complete_after:
+                print('Granule catalog read from:', catalog_file)
+                return stored['days']
+            # search again from the day of the last granule (it may be incomplete)
+            catalog = stored['days']
+            if len(catalog) > 0:
+                search_start = max(catalog)
+            print('Granule catalog read from:', catalog_file, '- searching the granules from', search_start)
+
+    searched = datetime.now()
+    results = search(search_start, end, domain)
+
+    known = {record['granule_id'] for records in catalog.values() for record in records}
+    n_new = 0
+    for granule in results:
+        record = granule_record(granule)
+        if record['granule_id'] in known:
+            continue
+        catalog.setdefault(record['time'][:10], []).append(record)
+        n_new += 1
+    for day in catalog:
+        catalog[day] = sorted(catalog[day], key=lambda record: record['time'])
+
+    # write to a temporary file first, so that an interrupted run never leaves a truncated catalog
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_file)), exist_ok=True)
+    with open(catalog_file + '.tmp', 'w') as file:
+        json.dump({'start': start, 'end': end, 'domain': list(domain), 'searched': searched.isoformat(),
+                   'days': catalog}, file, indent=1)
+    os.replace(catalog_file + '.tmp', catalog_file)
+    print('Granule catalog with', n_new, 'new granules saved to:', catalog_file)
+
+    return catalog
+
+def granule_record(granule):
+    """
+    Extract the catalog record of a granule.
+    input:
+        granule (earthaccess.DataGranule): granule returned by the search.
+    output:
+        record (dict): granule_id, url, time (start of the granule, ISO format) and size (MB).
+    """
+    umm = granule['umm']
+    record = {
+        'granule_id': umm['GranuleUR'],
+        'url': granule.data_links()[0],
+        'time': umm['TemporalExtent']['RangeDateTime']['BeginningDateTime'],
+        'size': granule.size(),
+    }
+    return record
+
 def download_imerg_granule(results, path_imerg_data):
     """
     Download IMERG granules to the current working directory.
     input:
-        results (list): List of granule metadata.
+        results (list): List of granule metadata or of granule URLs.
     output:
         downloaded_files (list): List of downloaded file paths.
     """
+    import earthaccess
+
     # Download the granule to the current working directory
-    downloaded_files = earthaccess.download(
-        results,
-        local_path=path_imerg_data, # Change this string to download to a different path
-    )
+    with stage('imerg_download', files=len(results)) as record:
+        downloaded_files = earthaccess.download(
+            results,
+            local_path=path_imerg_data, # Change this string to download to a different path
+        )
+        record['files'] = len(downloaded_files)
+        record['bytes'] = sum(os.path.getsize(file) for file in downloaded_files if os.path.exists(file))
 
     return downloaded_files
 
-def read_and_crop_dataset(downloaded_files, lat_min, lat_max, lon_min, lon_max):
+def read_and_crop_dataset(downloaded_files, lat_min, lat_max, lon_min, lon_max, domains=None):
     """
     Read and crop the dataset to the specified latitude and longitude bounds.
+    Only the kept variables (projection.kept_variables) are read, in the window of the domains.
     input:
         downloaded_files (list): List of downloaded file paths.
         lat_min (float): Minimum latitude for cropping.
         lat_max (float): Maximum latitude for cropping.
         lon_min (float): Minimum longitude for cropping.
         lon_max (float): Maximum longitude for cropping.
+        domains (list): names of other domains of the registry (domains.py) cut from the same read.
     output:
-        ds (xarray.Dataset): Cropped dataset.
+        ds (xarray.Dataset): Cropped dataset, or if domains is given a tuple (ds, domain_crops)
+            where domain_crops is the dict of the crops of the other domains.
     """
-    # Open the downloaded files as an xarray dataset
-    ds = xr.open_mfdataset(downloaded_files, group="Grid")
+    from projection import open_projected
+
+    # Open the kept variables of the downloaded files in the box containing all the domains
+    bounds = [(lat_min, lat_max, lon_min, lon_max)] + [domain_bounds(name) for name in (domains or [])]
+    with stage('imerg_open', files=len(downloaded_files),
+               nbytes=sum(os.path.getsize(file) for file in downloaded_files)):
+        ds_box = open_projected(downloaded_files, 'imerg',
+                                min(b[0] for b in bounds), max(b[1] for b in bounds), 
+                                min(b[2] for b in bounds), max(b[3] for b in bounds))
 
     # Crop the dataset to the specified latitude and longitude bounds
-    ds = ds.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
+    ds = ds_box.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
+
+    if domains is not None:
+        return ds, crop_domains(ds_box, domains)
+    return ds
+
+def read_and_crop_remote(results, lat_min, lat_max, lon_min, lon_max, domains=None):
+    """
+    Read and crop the remote granules without downloading them.
+    The granules are opened as file-like objects with earthaccess, so the HDF5
+    library fetches with HTTP range requests only the metadata and the chunks
+    intersecting the domain. The cropped data are loaded in memory.
+    With other domains, the box containing all of them is read once and each
+    domain is cut from it.
+    input:
+        results (list): List of granule metadata or of granule URLs.
+        lat_min (float): Minimum latitude for cropping.
+        lat_max (float): Maximum latitude for cropping.
+        lon_min (float): Minimum longitude for cropping.
+        lon_max (float): Maximum longitude for cropping.
+        domains (list): names of other domains of the registry (domains.py) cut from the same read.
+    output:
+        ds (xarray.Dataset): Cropped dataset, or if domains is given a tuple (ds, domain_crops)
+            where domain_crops is the dict of the crops of the other domains.
+    """
+    import earthaccess
+    import xarray as xr
+    from projection import kept_variables
 
+    # authenticated file-like objects on the remote granules
+    remote_files = earthaccess.open(results)
+    
+    # Open the remote files as an xarray dataset
+    ds = xr.open_mfdataset(remote_files, group="Grid", engine="h5netcdf")
+    
+    # box containing all the domains
+    bounds = [(lat_min, lat_max, lon_min, lon_max)] + [domain_bounds(name) for name in (domains or [])]
+    ds_box = ds.sel(lat=slice(min(b[0] for b in bounds), max(b[1] for b in bounds)), 
+                    lon=slice(min(b[2] for b in bounds), max(b[3] for b in bounds)))
+    
+    # Crop the dataset and read the selected chunks of the kept variables only
+    ds_box = ds_box[kept_variables['imerg']].load()
+    ds = ds_box.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
+    
+    if domains is not None:
+        return ds, crop_domains(ds_box, domains)
     return ds
 
 def plot_test_imerg(ds, lat_min, lat_max, lon_min, lon_max):
@@ -154,50 +663,34 @@ def plot_test_imerg(ds, lat_min, lat_max, lon_min, lon_max):
     Args:
         ds (_type_): _description_
     """
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import BoundaryNorm
+    from basemap import make_quicklook, render_quicklook
+    from collocation import cell_edges
+
     # Get the precipitation, latitude, and longitude variables
     precip = ds['precipitation'][0,:,:].values
     precip = np.transpose(precip)
     theLats = ds['lat'].values
     theLons = ds['lon'].values
-    x, y = np.float32(np.meshgrid(theLons, theLats))
     
-    # Set the figure size, projection, and extent
-    fig = plt.figure(figsize=(21, 7))
-    ax = plt.axes(projection=ccrs.PlateCarree())
-    ax.set_extent([lon_min, lon_max, lat_min, lat_max])
-    #ax.set_extent([-180, 180, -60, 60])  
-    # Add coastlines and formatted gridlines
-    ax.coastlines(resolution="110m", linewidth=1)
-    gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
-                    linewidth=1, color='black', linestyle='--')
-    gl.xlabels_top = False
-    gl.ylabels_right = False
-    gl.xlines = True
-    gl.xlocator = mticker.FixedLocator([-60, -45, -30, -15, 0, 15])
-    gl.ylocator = mticker.FixedLocator([-15, -10, -5, 0, 5, 10, 15])
-    gl.xformatter = LONGITUDE_FORMATTER
-    gl.yformatter = LATITUDE_FORMATTER
-    gl.xlabel_style = {'size': 16, 'color': 'black'}
-    gl.ylabel_style = {'size': 16, 'color': 'black'}
-
     # Set contour levels
     clevs = np.arange(0, 3, 0.05)
 
     # Normalize the data to match clevs
     norm = BoundaryNorm(clevs, ncolors=plt.cm.rainbow.N, clip=True)
 
-    # Plot the data with pcolormesh
-    mesh = plt.pcolormesh(x, y, precip, cmap=plt.cm.rainbow, norm=norm, shading="auto")
-
-    # Add a colorbar
-    cb = plt.colorbar(mesh, ax=ax, orientation="vertical", pad=0.05, aspect=16, shrink=0.8)
-    cb.set_label('mm / hr', size=20)
-    cb.ax.tick_params(labelsize=16)
-
-    # Add a title
-    plt.title('GPM IMERG Monthly Mean Rain Rate for January 2014', size=24)
+    # Plot the data on the cached basemap (coastlines and gridlines rendered once, see basemap.py)
+    quicklook = make_quicklook((lon_min, lon_max, lat_min, lat_max), cell_edges(theLons), cell_edges(theLats),
+                               plt.cm.rainbow, norm, 'mm / hr', figsize=(21, 7))
+    rgba = render_quicklook(quicklook, precip, 'GPM IMERG Monthly Mean Rain Rate for January 2014')
 
     # Show the plot
+    fig = plt.figure(figsize=(21, 7))
+    plt.imshow(rgba)
+    plt.axis('off')
+    plt.subplots_adjust(left=0, right=1, bottom=0, top=1)
     plt.show()
 
 
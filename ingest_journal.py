@@ -0,0 +1,162 @@
+'''
+Crash-safe ingest journal shared by the GridSat and IMERG pipelines.
+Each granule (a GridSat file or an IMERG day) goes through the states
+    listed -> downloading -> downloaded -> cropped -> written -> verified -> cleaned
+and its state is stored in a small SQLite database, so that an interrupted run
+restarts exactly the unfinished stages instead of trusting os.path.exists on the
+output (a run killed during to_netcdf leaves a truncated file that would be skipped forever).
+Outputs are written to a temporary path and renamed atomically (atomic_to_netcdf).
+
+'''
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+# ordered states of a granule
+states = ['listed', 'downloading', 'downloaded', 'cropped', 'written', 'verified', 'cleaned']
+
+# connections are shared between the threads of a pipeline
+_lock = threading.Lock()
+
+
+def open_journal(journal_file):
+    """
+    Open (and create if needed) the journal database.
+    Args:
+        journal_file (str): path of the SQLite database.
+    Returns:
+        journal (sqlite3.Connection): connection to the journal.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(journal_file)), exist_ok=True)
+    journal = sqlite3.connect(journal_file, check_same_thread=False, isolation_level=None)
+    journal.execute('PRAGMA journal_mode=WAL')
+    journal.execute('CREATE TABLE IF NOT EXISTS granules ('
+                    'product TEXT, granule TEXT, state TEXT, files TEXT, updated TEXT, '
+                    'PRIMARY KEY (product, granule))')
+    return journal
+
+def add_granules(journal, product, granules):
+    """
+    Add granules in state 'listed' (granules already in the journal are left unchanged).
+    Args:
+        journal (sqlite3.Connection): connection to the journal.
+        product (str): 'geost' or 'imerg'.
+        granules (list): granule names (GridSat file names, IMERG days).
+    """
+    now = datetime.utcnow().isoformat()
+    with _lock:
+        journal.executemany('INSERT OR IGNORE INTO granules VALUES (?, ?, ?, ?, ?)',
+                            [(product, granule, 'listed', '[]', now) for granule in granules])
+
+def set_state(journal, product, granule, state, files=None):
+    """
+    Record the new state of a granule.
+    Args:
+        journal (sqlite3.Connection): connection to the journal.
+        product (str): 'geost' or 'imerg'.
+        granule (str): granule name.
+        state (str): one of states.
+        files (list): local files of the granule (raw downloads), kept if None.
+    """
+    if state not in states:
+        raise ValueError(f"Unknown state {state}, use one of {states}")
+    now = datetime.utcnow().isoformat()
+    with _lock:
+        if files is None:
+            journal.execute('INSERT INTO granules VALUES (?, ?, ?, ?, ?) '
+                            'ON CONFLICT(product, granule) DO UPDATE SET state=excluded.state, updated=excluded.updated',
+                            (product, granule, state, '[]', now))
+        else:
+            journal.execute('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?)',
+                            (product, granule, state, json.dumps(list(files)), now))
+
+def get_states(journal, product):
+    """
+    Read the state of all the granules of a product.
+    Args:
+        journal (sqlite3.Connection): connection to the journal.
+        product (str): 'geost' or 'imerg'.
+    Returns:
+        granule_states (dict): {granule: (state, files)}.
+    """
+    with _lock:
+        rows = journal.execute('SELECT granule, state, files FROM granules WHERE product = ?', (product,)).fetchall()
+    return {granule: (state, json.loads(files)) for granule, state, files in rows}
+
+def seed_from_outputs(journal, product, output_files):
+    """
+    Mark as cleaned the granules never processed with the journal whose output file
+    already exists and is valid (written before the journal existed, by a run without
+    journal or by another machine), so that they are not downloaded again.
+    Args:
+        journal (sqlite3.Connection): connection to the journal.
+        product (str): 'geost' or 'imerg'.
+        output_files (dict): {granule: path of its output file}.
+    Returns:
+        n_seeded (int): number of granules marked as cleaned.
+    """
+    granule_states = get_states(journal, product)
+    n_seeded = 0
+    for granule, file_name in output_files.items():
+        if granule_states.get(granule, ('listed', []))[0] != 'listed' or not os.path.exists(file_name):
+            continue
+        if verify_netcdf(file_name):
+            set_state(journal, product, granule, 'cleaned')
+            n_seeded += 1
+    if n_seeded > 0:
+        print(f"{n_seeded} existing {product} outputs recorded in the journal")
+    return n_seeded
+
+def reached(state, target):
+    """
+    Check if a granule in state has already completed the stage producing target.
+    Args:
+        state (str): current state of the granule.
+        target (str): state to compare with.
+    Returns:
+        (bool): True if state is target or a later state.
+    """
+    return states.index(state) >= states.index(target)
+
+def atomic_to_netcdf(ds, file_name, stage_name='write', **kwargs):
+    """
+    Write a dataset to a temporary file in the same folder and rename it to
+    file_name only when to_netcdf has completed, so that a killed process never
+    leaves a truncated file under the final name.
+    Args:
+        ds (xarray.Dataset): dataset to write.
+        file_name (str): final path of the file.
+        stage_name (str): name of the stage in the metrics (see metrics.py).
+        **kwargs: arguments of to_netcdf (encoding, mode, ...).
+    """
+    from metrics import stage
+
+    tmp_name = file_name + '.tmp'
+    try:
+        with stage(stage_name, file=os.path.basename(file_name)) as record:
+            ds.to_netcdf(tmp_name, **kwargs)
+            record['bytes'] = os.path.getsize(tmp_name)
+        os.replace(tmp_name, file_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+def verify_netcdf(file_name):
+    """
+    Check that a written file can be opened and contains at least one time step.
+    Args:
+        file_name (str): path of the file.
+    Returns:
+        (bool): True if the file is valid.
+    """
+    import xarray as xr
+
+    try:
+        with xr.open_dataset(file_name, decode_times=False) as ds:
+            return ds.sizes.get('time', 0) > 0
+    except Exception as error:
+        print(f"Invalid file {file_name}: {error}")
+        return False
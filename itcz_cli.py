@@ -0,0 +1,224 @@
+'''
+Command-line entry point of the ITCZ scripts, driven by a configuration file:
+
+    python itcz_cli.py [--config itcz_config.json] [--year 2024] [--domain itcz] <command>
+
+commands:
+    list gridsat|imerg   update the GridSat manifest and write the file list of the files to
+                         ingest / list the IMERG days without a daily file
+    fetch-gridsat        download, crop and store the GridSat files (get_geo_gridsat.main)
+    fetch-imerg          download, crop and store the IMERG days (get_imerg.main)
+    plot                 quick-looks of a time stamp (--time) or of a period (--start, --end) (plot_geost.main)
+    status               cropped files, time range, journal states and work queue of each product
+
+The configuration file (json) has a "common" section (domain, year, ...) and one section
+per command ("gridsat", "imerg", "plot"), see itcz_config.json; the keys are the settings
+of the main functions of the scripts, missing keys keep their defaults. The switches
+(flag_keys) are given as true/false (or 'yes'/'no') and converted to the convention of
+each script. The scripts are imported only by the commands using them, so that list and
+status do not load xarray, matplotlib or cartopy and start in a fraction of a second.
+
+'''
+import os
+import sys
+import json
+import argparse
+
+
+# configuration file used without --config
+default_config_file = os.environ.get('ITCZ_CONFIG', 'itcz_config.json')
+
+# switches of the scripts: get_imerg and plot_geost compare them with 'yes', get_geo_gridsat uses booleans
+flag_keys = ['plotting', 'remote_subset', 'pipelined', 'packed', 'read_archive', 'use_time_index', 'batch_render']
+yes_no_sections = ['imerg', 'plot']
+
+# section of the configuration file of each command
+command_sections = {
+    'list': None,
+    'fetch-gridsat': 'gridsat',
+    'fetch-imerg': 'imerg',
+    'plot': 'plot',
+    'status': None,
+}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Download, crop and plot GridSat and IMERG data of the ITCZ.')
+    parser.add_argument('--config', default=default_config_file, help='configuration file (json)')
+    parser.add_argument('--year', type=int, help='year of the data (overrides the configuration file)')
+    parser.add_argument('--domain', help='domain of domains.py (overrides the configuration file)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help='list the files or days still to ingest')
+    list_parser.add_argument('product', choices=['gridsat', 'imerg'])
+
+    fetch_gridsat = commands.add_parser('fetch-gridsat', help='download, crop and store the GridSat files')
+    fetch_gridsat.add_argument('--workers', type=int, dest='n_workers', help='number of concurrent downloads')
+    fetch_gridsat.add_argument('--queue', dest='queue_folder', help='folder of the work queue shared by several workers')
+
+    fetch_imerg = commands.add_parser('fetch-imerg', help='download, crop and store the IMERG days')
+    fetch_imerg.add_argument('--queue', dest='queue_folder', help='folder of the work queue shared by several workers')
+
+    plot_parser = commands.add_parser('plot', help='quick-looks of a time stamp or of a period')
+    plot_parser.add_argument('--time', help='time stamp of the maps (e.g. 2024-01-30T11:00)')
+    plot_parser.add_argument('--start', help='first time of a batch of quick-looks')
+    plot_parser.add_argument('--end', help='last time of a batch of quick-looks')
+
+    commands.add_parser('status', help='state of the cropped files, journals and work queues')
+
+    args = parser.parse_args(argv)
+    config = load_config(args.config, command_sections[args.command], args)
+
+    if args.command == 'list':
+        return list_todo(args.product, config)
+    if args.command == 'fetch-gridsat':
+        import get_geo_gridsat
+        return get_geo_gridsat.main(config)
+    if args.command == 'fetch-imerg':
+        import get_imerg
+        return get_imerg.main(config)
+    if args.command == 'plot':
+        import plot_geost
+        if args.start is not None:
+            config['batch_render'] = 'yes'
+        return plot_geost.main(config)
+    if args.command == 'status':
+        return print_status(config)
+
+def load_config(config_file, section, args=None):
+    """
+    Settings of a command: the "common" section of the configuration file, updated with
+    the section of the command and with the options given on the command line.
+    Args:
+        config_file (str): path of the json configuration file (missing = defaults of the scripts).
+        section (str): section of the command (None = common settings only).
+        args (argparse.Namespace): parsed command line, options that are not None override the file.
+    Returns:
+        config (dict): settings passed to the main function of the script.
+    """
+    sections = {}
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as file:
+            sections = json.load(file)
+    elif config_file != default_config_file:
+        sys.exit(f"Configuration file not found: {config_file}")
+
+    config = dict(sections.get('common', {}))
+    if section is not None:
+        config.update(sections.get(section, {}))
+    # all the sections, for the commands using the settings of several scripts (status)
+    config['sections'] = sections
+
+    options = {key: value for key, value in vars(args or argparse.Namespace()).items()
+               if value is not None and key not in ('config', 'command', 'product')}
+    config.update(options)
+    # the GridSat script processes a list of years
+    if 'year' in config and ('years' not in config or 'year' in options):
+        config['years'] = [str(config['year'])]
+    normalize_flags(config, section)
+    return config
+
+def normalize_flags(config, section):
+    """
+    Convert the switches of a configuration to the convention of the script of its section:
+    'yes'/'no' for get_imerg and plot_geost, booleans for get_geo_gridsat.
+    Args:
+        config (dict): settings (updated in place).
+        section (str): section of the command.
+    """
+    for key in flag_keys:
+        if key not in config:
+            continue
+        if config[key] in (True, 'yes'):
+            flag = True
+        elif config[key] in (False, 'no'):
+            flag = False
+        else:
+            sys.exit(f"Invalid value of {key} in the configuration: {config[key]!r}, use true or false")
+        config[key] = ('yes' if flag else 'no') if section in yes_no_sections else flag
+
+def list_todo(product, config):
+    """
+    List what is still to ingest for a year: the GridSat files of the manifest not ingested
+    (written to the file list used by fetch-gridsat), or the IMERG days without a daily file.
+    Args:
+        product (str): 'gridsat' or 'imerg'.
+        config (dict): settings (see load_config).
+    Returns:
+        n_todo (int): number of files or days to ingest.
+    """
+    from domains import domain_folder
+
+    domain = config.get('domain', 'itcz')
+    settings = dict(config)
+    settings.update(config['sections'].get(product, {}))
+
+    if product == 'gridsat':
+        from get_geo_gridsat import sync_manifest, write_todo_list
+
+        base_url = settings.get('base_url', 'https://www.ncei.noaa.gov/data/geostationary-ir-channel-brightness-temperature-gridsat-b1/access/')
+        years = [str(year) for year in settings.get('years', ['2024'])]
+        manifest = sync_manifest(base_url, years, settings.get('manifest_file', '/data/trade_pc/ITCZ/gridsat_manifest.json'))
+        n_todo = 0
+        for year in years:
+            n_todo += write_todo_list(manifest, year, domain_folder(domain, year, 'geost'),
+                                      settings.get('file_list_name', 'file_list.txt'), settings.get('journal_file'))
+        return n_todo
+
+    from get_imerg import generate_days
+
+    year = int(settings.get('year', 2024))
+    path_imerg = domain_folder(domain, year, 'imerg')
+    missing = [day for day in generate_days(year)
+               if not os.path.exists(path_imerg + '/' + day + '_imerg_30min_ITCZ.nc')]
+    print(*missing, sep='\n')
+    print(f"{len(missing)} days to download for {year} in {path_imerg}")
+    return len(missing)
+
+def print_status(config):
+    """
+    Print for each product of a year: number of cropped files, time range and number of
+    time steps of the time index, states of the ingest journal and leases of the work queue.
+    Only the existing sidecar files are read, no data file is opened.
+    Args:
+        config (dict): settings (see load_config).
+    """
+    import glob
+    from collections import Counter
+    from domains import domain_folder
+    from time_index import file_patterns, index_file_name, load_time_index
+
+    domain = config.get('domain', 'itcz')
+    year = int(config.get('year', 2024))
+    for product, section in (('geost', 'gridsat'), ('imerg', 'imerg')):
+        settings = dict(config)
+        settings.update(config['sections'].get(section, {}))
+        folder = domain_folder(domain, year, product)
+        n_files = len(glob.glob(os.path.join(folder, file_patterns[product])))
+        index = load_time_index(os.path.join(folder, index_file_name))
+        print(f"{product} {year} ({folder}): {n_files} files")
+        if len(index['entries']) > 0:
+            print(f"    time index: {len(index['entries'])} time steps from {index['entries'][0][0]} to {index['entries'][-1][0]}")
+
+        # journal of single-worker runs and journals of each machine of the runs with a work queue
+        journal_file = settings.get('journal_file', '/data/trade_pc/ITCZ/ingest_journal.sqlite')
+        journal_files = glob.glob(journal_file) + glob.glob(journal_file.replace('.sqlite', '_*.sqlite'))
+        if len(journal_files) > 0:
+            from ingest_journal import open_journal, get_states
+            counts = Counter()
+            for file in journal_files:
+                granule_states = get_states(open_journal(file), product)
+                counts.update(state for state, files in granule_states.values())
+            print('    journal: ' + ', '.join(f'{state} {count}' for state, count in sorted(counts.items())))
+
+        queue_folder = settings.get('queue_folder')
+        if queue_folder is not None:
+            queue_folder = os.path.join(queue_folder, f'{product}_{year}')
+            n_leases = len(glob.glob(os.path.join(queue_folder, '*.lock')))
+            n_done = len(glob.glob(os.path.join(queue_folder, '*.done')))
+            print(f"    work queue: {n_leases} leased, {n_done} done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+'''
+Thread-safe LRU cache bounded by the total size of its values, shared by the quick-look
+server (open datasets, rendered images, data layers) and basemap.py (basemap rasters).
+
+'''
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache bounded by the total size of its values.
+    The least recently used values are evicted (and passed to on_evict) when a new value
+    would exceed max_size.
+    Args:
+        max_size (float): maximum total size of the values.
+        sizeof (function): size of a value (default: 1 per value, i.e. a bound on the number of values).
+        on_evict (function): called with each evicted value (e.g. to close a file).
+    """
+
+    def __init__(self, max_size, sizeof=None, on_evict=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._values:
+                self.misses += 1
+                return None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return self._values[key][0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._values
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        evicted = []
+        with self._lock:
+            if key in self._values:
+                self.size -= self._values.pop(key)[1]
+            self._values[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size and len(self._values) > 1:
+                old_key, (old_value, old_size) = self._values.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_value)
+        if self.on_evict is not None:
+            for old_value in evicted:
+                self.on_evict(old_value)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._values), 'size': self.size, 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
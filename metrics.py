@@ -0,0 +1,223 @@
+'''
+Lightweight instrumentation of the ingest runs.
+Each stage (download, crop, write, ...) is wrapped in a stage() context that measures
+its duration and the files and bytes it processed. Every stage produces
+- one JSON-lines event appended to the events file (one line per stage and file)
+- counters in memory, summarized in a Prometheus textfile (node_exporter textfile
+  collector format) with seconds, files, bytes, files/s, MB/s, queue depths and retries.
+The cost is a few dictionary updates and one short append per stage and file, so it
+can stay enabled on production backfills. Without configure() only the counters are kept.
+The configuration is passed to the worker processes through environment variables;
+their counters are returned to the parent with collect() and added with merge().
+
+'''
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+# environment variables with the output files, inherited by the worker processes
+events_variable = 'ITCZ_METRICS_EVENTS'
+textfile_variable = 'ITCZ_METRICS_TEXTFILE'
+
+# minimum time between two automatic updates of the textfile (s)
+textfile_interval = 15.
+
+_lock = threading.Lock()
+_counters = {'stages': {}, 'gauges': {}, 'counts': {}}
+_started = time.time()
+_last_textfile = 0.
+
+
+def configure(events_file=None, textfile=None):
+    """
+    Set the output files of the metrics for this process and its worker processes.
+    Args:
+        events_file (str): JSON-lines file where the events are appended (None = no events).
+        textfile (str): Prometheus textfile with the summary (None = no summary).
+    """
+    for variable, path in ((events_variable, events_file), (textfile_variable, textfile)):
+        if path is None:
+            os.environ.pop(variable, None)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            os.environ[variable] = path
+
+@contextmanager
+def stage(name, files=1, nbytes=0, **labels):
+    """
+    Time a stage and record its event and counters.
+    The yielded dict can be updated inside the context with the number of files and
+    bytes known only at the end of the stage (e.g. the size of a downloaded file).
+    Args:
+        name (str): name of the stage (e.g. 'geost_download').
+        files (int): number of files processed.
+        nbytes (int): number of bytes processed.
+        **labels: extra fields of the event (e.g. file name).
+    Yields:
+        record (dict): 'files' and 'bytes' of the stage, to be updated by the caller.
+    """
+    record = {'files': files, 'bytes': nbytes}
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield record
+        ok = True
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            totals = _counters['stages'].setdefault(name, {'seconds': 0., 'files': 0, 'bytes': 0, 'errors': 0})
+            totals['seconds'] += seconds
+            if ok:
+                totals['files'] += record['files']
+                totals['bytes'] += record['bytes']
+            else:
+                totals['errors'] += 1
+        event = {'time': time.time(), 'stage': name, 'seconds': round(seconds, 6), 'files': record['files'],
+                 'bytes': record['bytes'], 'ok': ok, 'pid': os.getpid()}
+        event.update(labels)
+        _write_event(event)
+        _maybe_write_textfile()
+
+def count(name, value=1):
+    """
+    Increase a counter (e.g. 'download_retries').
+    Args:
+        name (str): name of the counter.
+        value (int): increment.
+    """
+    with _lock:
+        _counters['counts'][name] = _counters['counts'].get(name, 0) + value
+
+def gauge(name, value):
+    """
+    Set a gauge (e.g. the depth of a queue) and keep its maximum.
+    Args:
+        name (str): name of the gauge.
+        value (float): current value.
+    """
+    with _lock:
+        current = _counters['gauges'].setdefault(name, {'value': 0, 'max': 0})
+        current['value'] = value
+        current['max'] = max(current['max'], value)
+
+def collect():
+    """
+    Return the counters of this process and reset them (used by the worker processes
+    to send their counters to the parent process, see merge).
+    Returns:
+        counters (dict): stages, gauges and counts recorded since the last collect.
+    """
+    global _counters
+    with _lock:
+        counters, _counters = _counters, {'stages': {}, 'gauges': {}, 'counts': {}}
+    return counters
+
+def merge(counters):
+    """
+    Add the counters returned by a worker process (see collect).
+    Args:
+        counters (dict): counters of the worker (None is ignored).
+    """
+    if not counters:
+        return
+    with _lock:
+        for name, totals in counters['stages'].items():
+            current = _counters['stages'].setdefault(name, {'seconds': 0., 'files': 0, 'bytes': 0, 'errors': 0})
+            for key in current:
+                current[key] += totals[key]
+        for name, value in counters['counts'].items():
+            _counters['counts'][name] = _counters['counts'].get(name, 0) + value
+        for name, values in counters['gauges'].items():
+            current = _counters['gauges'].setdefault(name, {'value': 0, 'max': 0})
+            current['value'] = values['value']
+            current['max'] = max(current['max'], values['max'])
+
+def write_textfile(textfile=None):
+    """
+    Write the summary of the counters in the Prometheus textfile format.
+    The file is written to a temporary file and renamed, so the collector never reads a partial file.
+    Args:
+        textfile (str): path of the textfile (default: the configured one, nothing is written without it).
+    """
+    global _last_textfile
+
+    textfile = textfile or os.environ.get(textfile_variable)
+    if textfile is None:
+        return
+    with _lock:
+        stages = {name: dict(totals) for name, totals in _counters['stages'].items()}
+        gauges = {name: dict(values) for name, values in _counters['gauges'].items()}
+        counts = dict(_counters['counts'])
+        _last_textfile = time.time()
+
+    lines = ['# HELP itcz_stage_seconds_total Time spent in each stage.',
+             '# TYPE itcz_stage_seconds_total counter']
+    lines += [f'itcz_stage_seconds_total{{stage="{name}"}} {totals["seconds"]:.6f}' for name, totals in stages.items()]
+    lines += ['# TYPE itcz_stage_files_total counter']
+    lines += [f'itcz_stage_files_total{{stage="{name}"}} {totals["files"]}' for name, totals in stages.items()]
+    lines += ['# TYPE itcz_stage_bytes_total counter']
+    lines += [f'itcz_stage_bytes_total{{stage="{name}"}} {totals["bytes"]}' for name, totals in stages.items()]
+    lines += ['# TYPE itcz_stage_errors_total counter']
+    lines += [f'itcz_stage_errors_total{{stage="{name}"}} {totals["errors"]}' for name, totals in stages.items()]
+    lines += ['# HELP itcz_stage_files_per_second Files per second of stage time.',
+              '# TYPE itcz_stage_files_per_second gauge']
+    lines += [f'itcz_stage_files_per_second{{stage="{name}"}} {totals["files"] / totals["seconds"]:.6f}'
+              for name, totals in stages.items() if totals['seconds'] > 0]
+    lines += ['# HELP itcz_stage_megabytes_per_second MB per second of stage time.',
+              '# TYPE itcz_stage_megabytes_per_second gauge']
+    lines += [f'itcz_stage_megabytes_per_second{{stage="{name}"}} {totals["bytes"] / 1e6 / totals["seconds"]:.6f}'
+              for name, totals in stages.items() if totals['seconds'] > 0]
+    lines += ['# TYPE itcz_queue_depth gauge']
+    lines += [f'itcz_queue_depth{{queue="{name}"}} {values["value"]}' for name, values in gauges.items()]
+    lines += ['# TYPE itcz_queue_depth_max gauge']
+    lines += [f'itcz_queue_depth_max{{queue="{name}"}} {values["max"]}' for name, values in gauges.items()]
+    lines += ['# HELP itcz_count_total Counted events (e.g. download_retries).',
+              '# TYPE itcz_count_total counter']
+    lines += [f'itcz_count_total{{name="{name}"}} {value}' for name, value in counts.items()]
+    lines += ['# TYPE itcz_run_start_time_seconds gauge', f'itcz_run_start_time_seconds {_started:.0f}']
+
+    # temporary file of this thread: concurrent writers never rename each other's file
+    temporary = f'{textfile}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary, textfile)
+
+def _write_event(event):
+    """
+    Append an event to the configured JSON-lines file (one short append, safe between processes).
+    Args:
+        event (dict): the event.
+    """
+    events_file = os.environ.get(events_variable)
+    if events_file is None:
+        return
+    with open(events_file, 'a') as file:
+        file.write(json.dumps(event) + '\n')
+
+def _maybe_write_textfile():
+    """
+    Update the textfile of the parent process if the last update is older than textfile_interval.
+    The update is claimed under the lock, so only one of the concurrent stages writes it.
+    """
+    global _last_textfile
+
+    if not os.environ.get(textfile_variable) or not _is_main_process():
+        return
+    with _lock:
+        if time.time() - _last_textfile <= textfile_interval:
+            return
+        _last_textfile = time.time()
+    write_textfile()
+
+def _is_main_process():
+    """
+    Check if this is the process that configured the metrics (worker processes do not write the textfile).
+    Returns:
+        (bool): True in the main process.
+    """
+    import multiprocessing
+
+    return multiprocessing.parent_process() is None
@@ -0,0 +1,181 @@
+'''
+Packed integer storage of the cropped GridSat and IMERG files.
+The decoded floats are written back as scale/offset integers with explicit fill values:
+- variables that are already packed in the source files (GridSat irwin_cdr is int16
+  with scale_factor 0.01 K, add_offset 200 K) keep the source encoding
+- the other variables listed in packing_specs are packed with the given encoding
+  (IMERG precipitation as uint16 with scale_factor 0.01 mm/hr)
+which halves the size of the files and of every read of them. After writing, the
+file is read back and the round-trip error of each variable is checked against the
+precision required for it (required_precision, stated independently of the packing,
+so that a too coarse encoding fails); a file failing the check is removed. The
+largest error of each variable is reported in the metrics (gauges packing_error_<name>).
+Variables whose values do not fit in the packed range are written unpacked.
+
+'''
+import os
+import numpy as np
+
+
+# packed encoding of the variables of each product (scale and offset in float32, so that they decode to float32)
+packing_specs = {
+    'geost': {
+        'irwin_cdr': {'dtype': 'int16', 'scale_factor': np.float32(0.01), 'add_offset': np.float32(200.), '_FillValue': np.int16(-31999)},
+    },
+    'imerg': {
+        'precipitation': {'dtype': 'uint16', 'scale_factor': np.float32(0.01), 'add_offset': np.float32(0.), '_FillValue': np.uint16(65535)},
+        'randomError': {'dtype': 'uint16', 'scale_factor': np.float32(0.01), 'add_offset': np.float32(0.), '_FillValue': np.uint16(65535)},
+        'precipitationQualityIndex': {'dtype': 'uint16', 'scale_factor': np.float32(0.0001), 'add_offset': np.float32(0.), '_FillValue': np.uint16(65535)},
+    },
+}
+
+# maximum absolute round-trip error accepted for each variable: the resolution of the
+# products (GridSat-B1 CDR brightness temperature 0.01 K, IMERG precipitation and its
+# random error 0.01 mm/hr, quality index 1e-4)
+required_precision = {
+    'geost': {'irwin_cdr': 0.01},
+    'imerg': {'precipitation': 0.01, 'randomError': 0.01, 'precipitationQualityIndex': 0.0001},
+}
+
+# encoding keys describing the packing of a variable
+_packing_keys = ['dtype', 'scale_factor', 'add_offset', '_FillValue', 'missing_value']
+
+
+def packed_encoding(ds, product, compression=None):
+    """
+    Build the encoding writing the variables of a dataset as packed integers.
+    Args:
+        ds (xarray.Dataset): cropped dataset (decoded, lazy or in memory).
+        product (str): 'geost' or 'imerg'.
+        compression (dict): compression keys added to the encoding of every variable
+            (e.g. get_geo_gridsat.compression_encoding(codec, complevel)).
+    Returns:
+        encoding (dict): encoding for to_netcdf, one entry per data variable.
+    """
+    encoding = {}
+    for name in ds.data_vars:
+        source = {key: value for key, value in ds[name].encoding.items() if key in _packing_keys}
+        if 'dtype' in source and np.issubdtype(np.dtype(source['dtype']), np.integer):
+            # already packed (or integer) in the source file: keep it
+            var_encoding = source
+        elif name in packing_specs[product]:
+            var_encoding = dict(packing_specs[product][name])
+            if not _fits(ds[name], var_encoding):
+                print(f"Values of {name} out of the packed range, {name} is written unpacked")
+                var_encoding = {}
+        else:
+            var_encoding = {}
+        var_encoding.update(compression or {})
+        encoding[name] = var_encoding
+    return encoding
+
+def write_packed(ds, file_name, product, compression=None, validate=True, stage_name='write'):
+    """
+    Write a cropped dataset with packed integers (see packed_encoding), atomically,
+    and check the round trip of the written file.
+    Args:
+        ds (xarray.Dataset): cropped dataset.
+        file_name (str): final path of the file.
+        product (str): 'geost' or 'imerg'.
+        compression (dict): compression keys added to the encoding of every variable.
+        validate (bool): read the file back and check the round-trip error (see validate_packing).
+        stage_name (str): name of the stage in the metrics (see metrics.py).
+    """
+    from ingest_journal import atomic_to_netcdf
+
+    encoding = packed_encoding(ds, product, compression)
+    atomic_to_netcdf(ds, file_name, stage_name=stage_name, encoding=encoding)
+    if validate:
+        try:
+            validate_packing(file_name, ds, encoding, product)
+        except ValueError:
+            os.remove(file_name)
+            raise
+
+def validate_packing(file_name, ds, encoding, product=None):
+    """
+    Check that the packed variables of a written file match the decoded dataset
+    within their required precision (required_precision), with the same missing values.
+    Variables without a required precision are only checked for missing values.
+    The maximum error of each variable is recorded in the metrics gauges.
+    Args:
+        file_name (str): path of the written file.
+        ds (xarray.Dataset): dataset that was written.
+        encoding (dict): encoding used to write it (see packed_encoding).
+        product (str): 'geost' or 'imerg' (None = no precision check).
+    Returns:
+        max_errors (dict): maximum absolute round-trip error of each packed variable.
+    """
+    import xarray as xr
+    from metrics import gauge
+
+    precisions = required_precision.get(product, {})
+
+    max_errors = {}
+    with xr.open_dataset(file_name, decode_times=False) as written:
+        for name, var_encoding in encoding.items():
+            if 'scale_factor' not in var_encoding:
+                continue
+            original = np.asarray(ds[name].values, dtype='float64')
+            packed = np.asarray(written[name].values, dtype='float64')
+            if not np.array_equal(np.isnan(original), np.isnan(packed)):
+                raise ValueError(f"Missing values of {name} changed in {file_name}")
+            valid = ~np.isnan(original)
+            error = float(np.abs(original[valid] - packed[valid]).max()) if valid.any() else 0.
+            gauge('packing_error_' + name, error)
+            if name in precisions and error > precisions[name]:
+                raise ValueError(f"Round-trip error of {name} in {file_name} is {error}, above the required "
+                                 f"precision {precisions[name]} (scale_factor {var_encoding['scale_factor']})")
+            max_errors[name] = error
+    return max_errors
+
+def repack_folder(folder, product, compression=None):
+    """
+    Rewrite with packed integers the files of a folder written as decoded floats
+    (e.g. the cropped files of 2024 written before packing was used).
+    Files whose variables are all packed already are left unchanged.
+    Args:
+        folder (str): folder of the cropped files.
+        product (str): 'geost' or 'imerg'.
+        compression (dict): compression keys added to the encoding of every variable.
+    Returns:
+        n_files (int): number of files rewritten.
+    """
+    import glob
+    import xarray as xr
+    from time_index import file_patterns
+
+    n_files = 0
+    for path in sorted(glob.glob(os.path.join(folder, file_patterns[product]))):
+        with xr.open_dataset(path, decode_times=False) as ds:
+            unpacked = [name for name in packing_specs[product] if name in ds.data_vars
+                        and 'scale_factor' not in ds[name].encoding]
+            if len(unpacked) == 0:
+                continue
+            ds = ds.load()
+        write_packed(ds, path, product, compression=compression, stage_name=product + '_repack')
+        n_files += 1
+        print(f"Repacked: {path}")
+    return n_files
+
+def _fits(data, var_encoding):
+    """
+    Check if the values of a variable fit in the range of a packed encoding.
+    Args:
+        data (xarray.DataArray): decoded values.
+        var_encoding (dict): packed encoding (dtype, scale_factor, add_offset, _FillValue).
+    Returns:
+        (bool): True if all the valid values can be packed.
+    """
+    info = np.iinfo(np.dtype(var_encoding['dtype']))
+    low, high = info.min, info.max
+    # the fill value is excluded from the valid range
+    if var_encoding['_FillValue'] == high:
+        high -= 1
+    elif var_encoding['_FillValue'] == low:
+        low += 1
+    scale, offset = float(var_encoding['scale_factor']), float(var_encoding['add_offset'])
+    data_min, data_max = float(data.min()), float(data.max())
+    if np.isnan(data_min):
+        return True
+    return low <= round((data_min - offset) / scale) and round((data_max - offset) / scale) <= high
@@ -5,36 +5,56 @@ and time
 """
 
 import os
-import numpy as np
-import matplotlib.pyplot as plt
-import xarray as xr
-import cartopy.crs as ccrs
-from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
-import matplotlib.ticker as mticker
-from matplotlib.colors import BoundaryNorm
-from matplotlib import colors
-from matplotlib import cm
-from datetime import datetime, timedelta
-from matplotlib import ticker
-from matplotlib import gridspec
-from matplotlib import colorbar
-from matplotlib import rcParams
-from matplotlib import rc
 import glob
-from cftime import DatetimeJulian
+from datetime import datetime
+from time_index import update_time_index, open_nearest
+from domains import domain_bounds, domain_folder
 
 
-def main():
+def main(config=None):
+    """
+    Plot the GridSat and IMERG quick-looks of a time stamp, or of a whole period.
+    Args:
+        config (dict): settings overriding the defaults below (the [plot] section of the
+            configuration file of itcz_cli.py), None = defaults.
+    """
+    import numpy as np
+    import matplotlib.pyplot as plt
+    import xarray as xr
+    from matplotlib.colors import BoundaryNorm
+    from zarr_archive import open_archive
+    from projection import open_projected, kept_variables
+    from basemap import make_quicklook, render_quicklook
+    from collocation import cell_edges
     
-    url_itcz = '/data/trade_pc/ITCZ/2024'
+    config = config or {}
+    
+    year = config.get('year', 2024)
+    # domain of the cropped files and of the maps (see domains.py)
+    domain_name = config.get('domain', 'itcz')
+    url_itcz = config.get('folder', os.path.dirname(domain_folder(domain_name, year, 'geost')))
     path_geost = url_itcz+'/geost/'
     path_imerg = url_itcz+'/imerg/'
     
+    # folder of the images
+    path_plots = config.get('plot_folder', '/net/ostro/ITCZ/plots')
+    
+    # read the consolidated Zarr archive instead of the daily netCDF files (takes precedence over use_time_index)
+    read_archive = config.get('read_archive', 'no')
+    
+    # use the time index of the folders to open only the files containing the time stamp
+    use_time_index = config.get('use_time_index', 'yes')
+    
+    # render the quick-looks of a whole period instead of a single time stamp
+    batch_render = config.get('batch_render', 'no')
+    if batch_render == 'yes':
+        render_batch(config.get('start', f'{year}-01-01'), config.get('end', f'{year}-12-31T23:59'),
+                     path_geost, path_imerg, path_plots + '/quicklooks', *domain_bounds(domain_name))
+        return
+    
     # define date and time for plot
-    day = '2024-01-30'
-    hh = '11'
-    min = '00'
-    sec = '00'
+    day, clock = config.get('time', '2024-01-30T11:00:00').split('T')
+    hh, min, sec = (clock.split(':') + ['00', '00'])[:3]
     
     yy = day.split('-')[0]
     mm = day.split('-')[1]
@@ -54,21 +74,36 @@ def main():
     # read files 
     file_imerg = path_imerg + day + '_imerg_30min_ITCZ.nc'
     
-    print(path_geost + 'GRIDSAT-B1.' + yy + '.'+ mm+'.'+dd+'.*')
-    filelist_geost = sorted(glob.glob(path_geost + 'GRIDSAT-B1.' + yy + '.'+ mm+'.'+dd+'.*'))
+    if read_archive == 'yes':
+        # one metadata read for the whole year, then select the day
+        day_slice = slice(day, day + 'T23:59:59')
+        ds_geost = open_archive('geost', url_itcz + '/geost.zarr').drop_vars(['sparse3ir', 'irwvp_2', 'b1file'], errors='ignore')
+        ds_geost = ds_geost.sel(time=day_slice).convert_calendar('standard', align_on='year')
+        ds_imerg = open_archive('imerg', url_itcz + '/imerg.zarr')
+        ds_imerg = ds_imerg.sel(time=day_slice).convert_calendar('standard', align_on='year')
+    elif use_time_index == 'yes':
+        # nearest time step from the index: one file opened and one slice decoded per product
+        index_geost = update_time_index(path_geost, 'geost')
+        index_imerg = update_time_index(path_imerg, 'imerg')
+        ds_geost_sel = open_nearest(path_geost, index_geost, dt, drop_variables=['sparse3ir', 'irwvp_2', 'b1file'])
+        ds_imerg_sel = open_nearest(path_imerg, index_imerg, dt)
+    else:
+        print(path_geost + 'GRIDSAT-B1.' + yy + '.'+ mm+'.'+dd+'.*')
+        filelist_geost = sorted(glob.glob(path_geost + 'GRIDSAT-B1.' + yy + '.'+ mm+'.'+dd+'.*'))
+            
+        # read geostationary data (kept variables only)
+        ds_geost = open_projected(filelist_geost, 'geost', *domain_bounds(domain_name))
+        ds_geost = ds_geost.convert_calendar('standard', align_on='year')
         
-    # read geostationary data
-    ds_geost = xr.open_mfdataset(filelist_geost, drop_variables=['sparse3ir', 'irwvp_2', 'b1file'])
-    ds_geost = ds_geost.convert_calendar('standard', align_on='year')
-    
 
-    # read imerg data
-    ds_imerg = xr.open_dataset(file_imerg)
-    ds_imerg = ds_imerg.convert_calendar('standard', align_on='year')
+        # read imerg data
+        ds_imerg = xr.open_dataset(file_imerg)[kept_variables['imerg']]
+        ds_imerg = ds_imerg.convert_calendar('standard', align_on='year')
     
-    # select the time stamp
-    ds_geost_sel = ds_geost.sel(time=dt_64, method='nearest')
-    ds_imerg_sel = ds_imerg.sel(time=dt_64, method='nearest')
+    if read_archive == 'yes' or use_time_index != 'yes':
+        # select the time stamp
+        ds_geost_sel = ds_geost.sel(time=dt_64, method='nearest')
+        ds_imerg_sel = ds_imerg.sel(time=dt_64, method='nearest')
     
     print(dt)
     print(ds_geost_sel.time.values)    
@@ -90,8 +125,8 @@ def main():
     lonsBT = ds_geost_sel['lon'].values
     x1, y1 = np.float32(np.meshgrid(lonsBT, latsBT))
     # Create a meshgrid with one extra row and column
-    x1_edges = np.linspace(x1.min(), x1.max(), bt11.shape[1] + 1)
-    y1_edges = np.linspace(y1.min(), y1.max(), bt11.shape[0] + 1)
+    x1_edges = cell_edges(lonsBT)
+    y1_edges = cell_edges(latsBT)
     X1, Y1 = np.meshgrid(x1_edges, y1_edges)
 
     # find max and min of BT
@@ -99,29 +134,12 @@ def main():
     bt_max = np.nanmax(bt11)
     
        
-    # define ITCZ domain
-    lat_min = -15
-    lat_max = 15
-    lon_min = -66
-    lon_max = 15
+    # define ITCZ domain (see domains.py)
+    lat_min, lat_max, lon_min, lon_max = domain_bounds(domain_name)
 
     
-    fig = plt.figure(figsize=(12, 8))
-    ax1 = plt.axes(projection=ccrs.PlateCarree())
-    ax1.set_title('Geostationary data')
-    ax1.set_extent([lon_min, lon_max, lat_min, lat_max])
-    ax1.coastlines(resolution="110m", linewidth=1)
-    gl1 = ax1.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
-                    linewidth=1, color='black', linestyle='--')
-    gl1.xlabels_top = False
-    gl1.ylabels_right = False
-    gl1.xlines = True
-    gl1.xlocator = mticker.FixedLocator([-60, -45, -30, -15, 0, 15])
-    gl1.ylocator = mticker.FixedLocator([-15, -10, -5, 0, 5, 10, 15])
-    gl1.xformatter = LONGITUDE_FORMATTER
-    gl1.yformatter = LATITUDE_FORMATTER
-    gl1.xlabel_style = {'size': 16, 'color': 'black'}
-    gl1.ylabel_style = {'size': 16, 'color': 'black'}
+    # quick-looks: the cached basemap (coastlines, gridlines) is composited on the data layer
+    extent = (lon_min, lon_max, lat_min, lat_max)
     
     # Set contour levels
     clevs1 = np.arange(bt_min, bt_max, 5.)
@@ -131,53 +149,12 @@ def main():
                         ncolors=plt.cm.grey_r.N, 
                         clip=True)
 
-    # Plot the data with pcolormesh
-    mesh1 = plt.pcolormesh(X1, 
-                          Y1, 
-                          bt11, 
-                          cmap=plt.cm.grey_r, 
-                          norm=norm1, 
-                          shading='flat')
-
-    # Add a colorbar
-    cb1 = plt.colorbar(mesh1, 
-                      ax=ax1, 
-                      orientation="vertical", 
-                      pad=0.07, 
-                      aspect=16, 
-                      shrink=0.5)
-    
-    cb1.set_label('Kelvin', size=20)
-    cb1.ax.tick_params(labelsize=16)
-    
-    # adjusting figure proportions
-    plt.tight_layout()
-    
-    # save figure
-    plt.savefig('/net/ostro/ITCZ/plots/'+date_time_str+'_geost.png', 
-                dpi=300, 
-                transparent=True,
-                bbox_inches='tight')
-    
-    
-    
-    fig = plt.figure(figsize=(12, 8))
-    ax2 = plt.axes(projection=ccrs.PlateCarree())
-    ax2.set_title('IMERG data')
-    ax2.set_extent([lon_min, lon_max, lat_min, lat_max])
-    ax2.coastlines(resolution="110m", linewidth=1)
-    gl = ax2.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
-                    linewidth=1, color='black', linestyle='--')
-    gl.xlabels_top = False
-    gl.ylabels_right = False
-    gl.xlines = True
-    gl.xlocator = mticker.FixedLocator([-60, -45, -30, -15, 0, 15])
-    gl.ylocator = mticker.FixedLocator([-15, -10, -5, 0, 5, 10, 15])
-    gl.xformatter = LONGITUDE_FORMATTER
-    gl.yformatter = LATITUDE_FORMATTER
-    gl.xlabel_style = {'size': 16, 'color': 'black'}
-    gl.ylabel_style = {'size': 16, 'color': 'black'}
-
+    # Plot the data on the basemap and save figure
+    quicklook_geost = make_quicklook(extent, x1_edges, y1_edges, plt.cm.grey_r, norm1, 'Kelvin', dpi=300, transparent=True)
+    render_quicklook(quicklook_geost, bt11, 'Geostationary data', 
+                     path_plots + '/' + date_time_str+'_geost.png')
+    
+    
     # Set contour levels
     clevs = np.arange(0, 3, 0.05)
 
@@ -186,34 +163,115 @@ def main():
                         ncolors=plt.cm.rainbow.N, 
                         clip=True)
 
-    # Plot the data with pcolormesh
-    mesh = plt.pcolormesh(x, 
-                          y, 
-                          precip, 
-                          cmap=plt.cm.rainbow, 
-                          norm=norm, 
-                          shading="auto")
+    # Plot the data on the basemap and save figure
+    quicklook_imerg = make_quicklook(extent, cell_edges(theLons), cell_edges(theLats), plt.cm.rainbow, norm, 'mm / hr', 
+                                     dpi=300, transparent=True)
+    render_quicklook(quicklook_imerg, precip, 'IMERG data', 
+                     path_plots + '/' + date_time_str+'_imerg.png')
+    
+
+def render_batch(start, end, path_geost, path_imerg, path_out, lat_min=-15, lat_max=15, lon_min=-66, lon_max=15,
+                 n_processes=None, dpi=100):
+    """
+    Render the GridSat and IMERG quick-looks of all the GridSat time steps between start and end.
+    The frames are split in contiguous blocks, one per process. Each process builds 
+    the two data layers and their colorbars once, then for each frame only updates 
+    the data of the meshes and the titles, rasterizes them and composites the cached 
+    basemap on top (see basemap.py), so Cartopy draws the static layers once per
+    extent, size and dpi instead of once per frame.
+    The IMERG time step nearest to each GridSat time is used.
+    Args:
+        start (str): first time in ISO format (e.g. '2024-01-01').
+        end (str): last time in ISO format (e.g. '2024-12-31T23:59').
+        path_geost (str): folder of the cropped GridSat files.
+        path_imerg (str): folder of the cropped IMERG files.
+        path_out (str): folder of the images.
+        lat_min, lat_max, lon_min, lon_max (float): extent of the maps.
+        n_processes (int): number of rendering processes (None = number of cores).
+        dpi (int): resolution of the images.
+    Returns:
+        n_frames (int): number of rendered frames.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    
+    os.makedirs(path_out, exist_ok=True)
+    
+    # GridSat times of the period from the time index
+    index_geost = update_time_index(path_geost, 'geost')
+    update_time_index(path_imerg, 'imerg')
+    frames = [entry[0] for entry in index_geost['entries'] if start <= entry[0] <= end]
+    if len(frames) == 0:
+        print('No GridSat time steps between', start, 'and', end)
+        return 0
+    
+    # contiguous blocks of frames, one per process
+    n_processes = min(n_processes or os.cpu_count(), len(frames))
+    block_size = -(-len(frames) // n_processes)
+    blocks = [frames[i:i + block_size] for i in range(0, len(frames), block_size)]
+    
+    extent = (lon_min, lon_max, lat_min, lat_max)
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [executor.submit(_render_frames, block, path_geost, path_imerg, path_out, extent, dpi)
+                   for block in blocks]
+        n_frames = sum(future.result() for future in futures)
+    
+    print(f"Rendered {n_frames} frames to {path_out}")
+    return n_frames
 
-    # Add a colorbar
-    cb = plt.colorbar(mesh, 
-                      ax=ax2, 
-                      orientation="vertical", 
-                      pad=0.07, 
-                      aspect=16, 
-                      shrink=0.5)
-    
-    cb.set_label('mm / hr', size=20)
-    cb.ax.tick_params(labelsize=16)
-    
-    # adjusting figure proportions
-    plt.tight_layout()
-    
-    # save figure
-    plt.savefig('/net/ostro/ITCZ/plots/'+date_time_str+'_imerg.png', 
-                dpi=300, 
-                transparent=True,
-                bbox_inches='tight')
+def _render_frames(frames, path_geost, path_imerg, path_out, extent, dpi):
+    """
+    Render a block of frames reusing the same two figures (worker of render_batch).
+    Args:
+        frames (list): ISO times of the GridSat time steps to render.
+        path_geost (str): folder of the cropped GridSat files.
+        path_imerg (str): folder of the cropped IMERG files.
+        path_out (str): folder of the images.
+        extent (tuple): (lon_min, lon_max, lat_min, lat_max) of the maps.
+        dpi (int): resolution of the images.
+    Returns:
+        n_frames (int): number of rendered frames.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import BoundaryNorm
+    from time_index import load_time_index
+    from basemap import make_quicklook, render_quicklook
+    from collocation import cell_edges
+    
+    index_geost = load_time_index(os.path.join(path_geost, 'time_index.json'))
+    index_imerg = load_time_index(os.path.join(path_imerg, 'time_index.json'))
+    
+    # fixed color scales, so that colorbars are drawn once
+    norm_bt = BoundaryNorm(np.arange(180., 320., 5.), ncolors=plt.cm.grey_r.N, clip=True)
+    norm_precip = BoundaryNorm(np.arange(0, 3, 0.05), ncolors=plt.cm.rainbow.N, clip=True)
+    
+    quicklook_geost = quicklook_imerg = None
+    for frame in frames:
+        dt = datetime.fromisoformat(frame)
+        ds_geost_sel = open_nearest(path_geost, index_geost, dt, drop_variables=['sparse3ir', 'irwvp_2', 'b1file'])
+        ds_imerg_sel = open_nearest(path_imerg, index_imerg, dt)
+        bt11 = ds_geost_sel['irwin_cdr'].values
+        precip = np.transpose(ds_imerg_sel['precipitation'].values)
+        
+        if quicklook_geost is None or quicklook_geost['mesh'].get_array().shape != bt11.shape:
+            # first frame: build the data layers and colorbars on the cached basemap
+            quicklook_geost = make_quicklook(extent, cell_edges(ds_geost_sel['lon'].values), 
+                                             cell_edges(ds_geost_sel['lat'].values),
+                                             plt.cm.grey_r, norm_bt, 'Kelvin', dpi=dpi)
+            quicklook_imerg = make_quicklook(extent, cell_edges(ds_imerg_sel['lon'].values), 
+                                             cell_edges(ds_imerg_sel['lat'].values),
+                                             plt.cm.rainbow, norm_precip, 'mm / hr', dpi=dpi)
+        
+        # rasterize the data layers and composite the cached basemaps
+        frame_str = frame[:16].replace('T', '_').replace(':', '')
+        render_quicklook(quicklook_geost, bt11, 'Geostationary data ' + str(ds_geost_sel.time.values)[:16],
+                         os.path.join(path_out, frame_str + '_geost.png'))
+        render_quicklook(quicklook_imerg, precip, 'IMERG data ' + str(ds_imerg_sel.time.values)[:16],
+                         os.path.join(path_out, frame_str + '_imerg.png'))
     
+    return len(frames)
 
 if __name__ == "__main__":
     main()
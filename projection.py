@@ -0,0 +1,89 @@
+'''
+Projection layer used to open IMERG and GridSat files: the pipeline declares the
+variables it keeps and the spatial window, and the files are opened with only those
+variables and with dask chunks whose boundaries fall on the edges of the window, so
+that the window is exactly one chunk per time step. Memory and decoding time then
+scale with what is kept instead of with the global file.
+
+'''
+import numpy as np
+
+
+# variables kept from each product
+kept_variables = {
+    'geost': ['irwin_cdr'],
+    'imerg': ['precipitation', 'randomError', 'probabilityLiquidPrecipitation', 'precipitationQualityIndex'],
+}
+
+# group of the variables in the files of each product
+product_groups = {
+    'geost': None,
+    'imerg': 'Grid',
+}
+
+
+def open_projected(files, product, lat_min, lat_max, lon_min, lon_max, variables=None, engine=None):
+    """
+    Open one or several files of a product with only the kept variables, cropped
+    to the window and chunked along the edges of the window.
+    The variable names and the coordinates are read from the metadata of the first
+    file; the files of a product are assumed to share the same grid.
+    Args:
+        files (list): paths (or file-like objects) of the files.
+        product (str): 'geost' or 'imerg'.
+        lat_min, lat_max, lon_min, lon_max (float): bounds of the window.
+        variables (list): variables to keep (default: kept_variables[product]).
+        engine (str): xarray engine (default: xarray's choice).
+    Returns:
+        ds (xarray.Dataset): lazy dataset with the kept variables in the window.
+    """
+    import xarray as xr
+
+    variables = variables or kept_variables[product]
+    group = product_groups[product]
+
+    # metadata only: names, sizes and coordinates of the first file
+    with xr.open_dataset(files[0], group=group, engine=engine, decode_cf=False) as meta:
+        drop_variables = [name for name in meta.data_vars if name not in variables]
+        window = crop_window(meta['lat'].values, meta['lon'].values, lat_min, lat_max, lon_min, lon_max)
+        chunks = aligned_chunks(dict(meta.sizes), window)
+
+    if len(files) == 1:
+        ds = xr.open_dataset(files[0], group=group, engine=engine, drop_variables=drop_variables, chunks=chunks)
+    else:
+        ds = xr.open_mfdataset(files, group=group, engine=engine, drop_variables=drop_variables, chunks=chunks)
+
+    return ds.isel(window)
+
+def crop_window(lat, lon, lat_min, lat_max, lon_min, lon_max):
+    """
+    Index window of a lat/lon box on increasing coordinates (same cells as sel with slices).
+    Args:
+        lat (numpy.ndarray): increasing latitudes.
+        lon (numpy.ndarray): increasing longitudes.
+        lat_min, lat_max, lon_min, lon_max (float): bounds of the box.
+    Returns:
+        window (dict): index slices {'lat': slice, 'lon': slice}.
+    """
+    return {'lat': slice(int(np.searchsorted(lat, lat_min, side='left')), int(np.searchsorted(lat, lat_max, side='right'))),
+            'lon': slice(int(np.searchsorted(lon, lon_min, side='left')), int(np.searchsorted(lon, lon_max, side='right')))}
+
+def aligned_chunks(sizes, window):
+    """
+    Dask chunks with boundaries on the edges of the window, one time step per chunk.
+    Args:
+        sizes (dict): size of each dimension of the file.
+        window (dict): index slices of the window.
+    Returns:
+        chunks (dict): chunk sizes along each dimension.
+    """
+    chunks = {}
+    for dim, size in sizes.items():
+        if dim in window:
+            start, stop = window[dim].start, window[dim].stop
+            chunks[dim] = tuple(length for length in (start, stop - start, size - stop) if length > 0)
+        elif dim == 'time':
+            chunks[dim] = 1
+        else:
+            chunks[dim] = size
+    return chunks
@@ -0,0 +1,336 @@
+'''
+Local HTTP quick-look service of the cropped GridSat and IMERG files.
+Instead of editing the day and hour in plot_geost.main and rerunning the script (imports of
+matplotlib and cartopy, files reopened, two 300 dpi maps rendered), the server keeps
+- the time indexes of the two folders (see time_index.py), refreshed when a request
+  comes more than index_refresh_s after the last update, so that new files appear
+- the open dataset handles, in a LRU cache bounded by the number of open files
+- the rendered PNG images, in a LRU cache bounded by their total size
+- the data layers of the maps, one per product, region and dpi (see basemap.py), in a
+  LRU cache bounded by their number (the basemap rasters are bounded in basemap.py)
+and after each map it renders the neighbouring time steps in the background, so that
+browsing forward and backward in time is served from the image cache.
+Endpoints (GET):
+    /map?product=geost&time=2024-01-30T11:00[&bbox=lon_min,lon_max,lat_min,lat_max][&dpi=100]
+        PNG map of the time step nearest to time
+    /series?product=imerg&lat=5&lon=-30&start=2024-01-01&end=2024-01-31T23:59
+        JSON time series at the grid point nearest to (lat, lon)
+    /times?product=geost[&start=...&end=...]
+        JSON list of the time steps of the product
+    /stats
+        JSON sizes and hit rates of the caches
+Run it with python quicklook_server.py and open http://localhost:8050/map?product=geost&time=2024-01-30T11:00
+
+'''
+import os
+import json
+import threading
+import numpy as np
+from datetime import datetime
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from lru_cache import LRUCache
+
+
+# variable, color scale and colorbar label of the maps of each product
+map_settings = {
+    'geost': {'variable': 'irwin_cdr', 'cmap': 'grey_r', 'levels': (180., 320., 5.), 'label': 'Kelvin',
+              'title': 'Geostationary data'},
+    'imerg': {'variable': 'precipitation', 'cmap': 'rainbow', 'levels': (0., 3., 0.05), 'label': 'mm / hr',
+              'title': 'IMERG data'},
+}
+
+
+def main():
+
+    url_itcz = '/data/trade_pc/ITCZ/2024'
+    folders = {'geost': url_itcz + '/geost/', 'imerg': url_itcz + '/imerg/'}
+
+    # port of the server (http://localhost:8050)
+    port = 8050
+
+    # memory of the rendered images (MB) and number of files kept open
+    image_cache_mb = 256
+    max_open_files = 16
+
+    # number of data layers (figures) kept, one per product, region and dpi
+    max_quicklooks = 8
+
+    # number of time steps rendered in advance on each side of a requested map
+    n_prefetch = 2
+
+    # the time indexes are updated with the new files at most every index_refresh_s seconds
+    index_refresh_s = 60
+
+    server, url = serve_quicklooks(folders, port=port, image_cache_mb=image_cache_mb, max_open_files=max_open_files,
+                                   max_quicklooks=max_quicklooks, n_prefetch=n_prefetch, index_refresh_s=index_refresh_s)
+    print(f"Quick-looks served at {url}map?product=geost&time=2024-01-30T11:00")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+def serve_quicklooks(folders, port=8050, image_cache_mb=256, max_open_files=16, max_quicklooks=8, n_prefetch=2,
+                     index_refresh_s=60, host='127.0.0.1'):
+    """
+    Start the quick-look server (not blocking: the caller runs serve_forever or a thread).
+    Args:
+        folders (dict): folder of the cropped files of each product ('geost', 'imerg').
+        port (int): port of the server (0 = any free port).
+        image_cache_mb (float): memory of the image cache (MB).
+        max_open_files (int): number of dataset handles kept open.
+        max_quicklooks (int): number of data layers (figures) kept.
+        n_prefetch (int): number of neighbouring time steps rendered in advance on each side.
+        index_refresh_s (float): minimum time between two updates of the time indexes (s).
+        host (str): address of the server (local only by default).
+    Returns:
+        server (http.server.ThreadingHTTPServer): the server.
+        base_url (str): URL of the server, ending with '/'.
+    """
+    import time
+    from http.server import ThreadingHTTPServer
+    from concurrent.futures import ThreadPoolExecutor
+    from time_index import update_time_index
+
+    state = {
+        'folders': folders,
+        'indexes': {product: update_time_index(folder, product) for product, folder in folders.items()},
+        'index_updated': {product: time.monotonic() for product in folders},
+        'index_refresh_s': index_refresh_s,
+        'index_lock': threading.Lock(),
+        'datasets': LRUCache(max_open_files, on_evict=lambda ds: ds.close()),
+        'images': LRUCache(image_cache_mb * 1e6, sizeof=len),
+        'quicklooks': LRUCache(max_quicklooks),
+        # matplotlib figures are not thread-safe: one render at a time
+        'render_lock': threading.Lock(),
+        'open_lock': threading.Lock(),
+        'prefetch': ThreadPoolExecutor(max_workers=1, thread_name_prefix='quicklook_prefetch'),
+        'n_prefetch': n_prefetch,
+    }
+    handler = type('Handler', (_QuicklookHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    return server, f'http://{host}:{server.server_address[1]}/'
+
+def render_map(state, product, position, bbox=None, dpi=100):
+    """
+    Return the PNG image of a time step, from the image cache or rendered on the cached basemap.
+    Args:
+        state (dict): state of the server (see serve_quicklooks).
+        product (str): 'geost' or 'imerg'.
+        position (int): position of the time step in the time index of the product.
+        bbox (tuple): (lon_min, lon_max, lat_min, lat_max) of the map (None = ITCZ domain).
+        dpi (int): resolution of the image.
+    Returns:
+        png (bytes): the image.
+    """
+    import io
+    import matplotlib.image as mimage
+    from basemap import render_quicklook
+
+    bbox = tuple(bbox or _default_bbox())
+    time, file_name, offset = state['indexes'][product]['entries'][position]
+    key = (product, time, bbox, dpi)
+    png = state['images'].get(key)
+    if png is not None:
+        return png
+
+    data = read_step(state, product, file_name, offset, bbox)
+    settings = map_settings[product]
+    with state['render_lock']:
+        quicklook = _quicklook(state, product, data, bbox, dpi)
+        rgba = render_quicklook(quicklook, data.values, settings['title'] + ' ' + time[:16])
+    buffer = io.BytesIO()
+    mimage.imsave(buffer, rgba, format='png')
+    png = buffer.getvalue()
+    state['images'].put(key, png)
+    return png
+
+def read_step(state, product, file_name, offset, bbox=None):
+    """
+    Read the mapped variable of one time step, (lat, lon) ordered and cropped to bbox,
+    from a dataset handle of the cache.
+    Args:
+        state (dict): state of the server.
+        product (str): 'geost' or 'imerg'.
+        file_name (str): file of the time step (time index entry).
+        offset (int): position of the time step in the file.
+        bbox (tuple): (lon_min, lon_max, lat_min, lat_max) of the region (None = whole file).
+    Returns:
+        data (xarray.DataArray): (lat, lon) field.
+    """
+    ds = _open(state, product, file_name)
+    data = ds[map_settings[product]['variable']].isel(time=offset).transpose('lat', 'lon')
+    if bbox is not None:
+        lon_min, lon_max, lat_min, lat_max = bbox
+        data = data.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
+    return data.load()
+
+def point_series(state, product, lat, lon, start, end):
+    """
+    Time series of the mapped variable at the grid point nearest to (lat, lon).
+    Args:
+        state (dict): state of the server.
+        product (str): 'geost' or 'imerg'.
+        lat, lon (float): position of the point.
+        start (str): first time in ISO format.
+        end (str): last time in ISO format.
+    Returns:
+        series (dict): 'times', 'values', 'lat' and 'lon' of the grid point, 'units'.
+    """
+    entries = [entry for entry in state['indexes'][product]['entries'] if start <= entry[0] <= end]
+    times, values = [], []
+    point = None
+    # one read per file: all the time steps of the period in the file
+    files = OrderedDict()
+    for time, file_name, offset in entries:
+        files.setdefault(file_name, []).append((time, offset))
+    for file_name, steps in files.items():
+        ds = _open(state, product, file_name)
+        column = ds[map_settings[product]['variable']].sel(lat=lat, lon=lon, method='nearest')
+        column = column.isel(time=[offset for time, offset in steps]).values
+        point = point or (float(ds['lat'].sel(lat=lat, method='nearest')), float(ds['lon'].sel(lon=lon, method='nearest')))
+        times.extend(time for time, offset in steps)
+        values.extend(None if np.isnan(value) else float(value) for value in column)
+    return {'times': times, 'values': values, 'lat': point[0] if point else None, 'lon': point[1] if point else None,
+            'units': map_settings[product]['label']}
+
+def prefetch(state, product, position, bbox, dpi):
+    """
+    Render in the background the neighbouring time steps of a map that are not in the image cache.
+    """
+    entries = state['indexes'][product]['entries']
+    for step in range(1, state['n_prefetch'] + 1):
+        for neighbour in (position + step, position - step):
+            if 0 <= neighbour < len(entries) and (product, entries[neighbour][0], tuple(bbox), dpi) not in state['images']:
+                state['prefetch'].submit(_prefetch_one, state, product, neighbour, bbox, dpi)
+
+def _prefetch_one(state, product, position, bbox, dpi):
+    try:
+        render_map(state, product, position, bbox, dpi)
+    except Exception as error:
+        print(f"Prefetch of {product} {position} failed: {error}")
+
+def _open(state, product, file_name):
+    """
+    Dataset handle of a file, opened once and kept in the LRU cache of the open files.
+    """
+    import xarray as xr
+
+    path = os.path.join(state['folders'][product], file_name)
+    with state['open_lock']:
+        ds = state['datasets'].get(path)
+        if ds is None:
+            ds = xr.open_dataset(path, use_cftime=True)
+            state['datasets'].put(path, ds)
+    return ds
+
+def _quicklook(state, product, data, bbox, dpi):
+    """
+    Data layer of the maps of a product, region, grid and dpi, built once (see basemap.make_quicklook).
+    """
+    import matplotlib
+    from matplotlib.colors import BoundaryNorm
+    from basemap import make_quicklook
+    from collocation import cell_edges
+
+    key = (product, tuple(bbox), data.shape, dpi)
+    quicklook = state['quicklooks'].get(key)
+    if quicklook is None:
+        settings = map_settings[product]
+        cmap = matplotlib.colormaps[settings['cmap']]
+        norm = BoundaryNorm(np.arange(*settings['levels']), ncolors=cmap.N, clip=True)
+        quicklook = make_quicklook(bbox, cell_edges(data['lon'].values), cell_edges(data['lat'].values),
+                                   cmap, norm, settings['label'], dpi=dpi)
+        state['quicklooks'].put(key, quicklook)
+    return quicklook
+
+def _refresh_index(state, product):
+    """
+    Update the time index of a product with the new files, if it was updated more than
+    index_refresh_s ago (update_time_index only reads the new and modified files).
+    """
+    import time
+    from time_index import update_time_index
+
+    with state['index_lock']:
+        if time.monotonic() - state['index_updated'][product] < state['index_refresh_s']:
+            return
+        state['indexes'][product] = update_time_index(state['folders'][product], product)
+        state['index_updated'][product] = time.monotonic()
+
+def _position(index, time):
+    """
+    Position in the time index of the time step nearest to an ISO time.
+    """
+    from time_index import nearest_position
+
+    return nearest_position(index, datetime.fromisoformat(time))
+
+class _QuicklookHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of serve_quicklooks, the state of the server is a class attribute.
+    """
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        from urllib.parse import urlparse, parse_qs
+
+        parsed = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(parsed.query).items()}
+        try:
+            if parsed.path == '/stats':
+                return self._send_json({name: self.state[name].stats() for name in ('datasets', 'images', 'quicklooks')})
+            product = query.get('product', 'geost')
+            if product not in self.state['indexes']:
+                return self.send_error(400, f"Unknown product {product}, use one of {list(self.state['indexes'])}")
+            _refresh_index(self.state, product)
+            index = self.state['indexes'][product]
+            if len(index['entries']) == 0:
+                return self.send_error(404, f"No time steps for {product}")
+            if parsed.path == '/map':
+                position = _position(index, query['time'])
+                bbox = tuple(float(value) for value in query['bbox'].split(',')) if 'bbox' in query else None
+                dpi = int(query.get('dpi', 100))
+                png = render_map(self.state, product, position, bbox, dpi)
+                prefetch(self.state, product, position, bbox or _default_bbox(), dpi)
+                return self._send(png, 'image/png')
+            if parsed.path == '/series':
+                return self._send_json(point_series(self.state, product, float(query['lat']), float(query['lon']),
+                                                    query.get('start', ''), query.get('end', '9999')))
+            if parsed.path == '/times':
+                return self._send_json([entry[0] for entry in index['entries']
+                                        if query.get('start', '') <= entry[0] <= query.get('end', '9999')])
+            return self.send_error(404)
+        except (KeyError, ValueError) as error:
+            return self.send_error(400, f"Bad request: {error}")
+        except FileNotFoundError as error:
+            # file of the index removed since the index was read
+            return self.send_error(404, f"File not found: {error.filename}")
+        except OSError as error:
+            return self.send_error(500, f"Cannot read the data: {error}")
+
+    def _send_json(self, value):
+        self._send(json.dumps(value).encode(), 'application/json')
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _default_bbox():
+    """
+    Region of the maps without bbox: the ITCZ domain.
+    """
+    from domains import domain_bounds
+
+    lat_min, lat_max, lon_min, lon_max = domain_bounds('itcz')
+    return (lon_min, lon_max, lat_min, lat_max)
+
+
+if __name__ == "__main__":
+    main()
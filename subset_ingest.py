@@ -0,0 +1,235 @@
+'''
+Ingest of the GES DISC subset URL lists (subset_GPM_3IMERG*.txt) in Python,
+replacing the serial wget loops of wget_imerg.sh and download_v2.sh.
+The lists are produced by the "Subset / Get Data" page of the GES DISC datasets and
+contain direct data URLs, OPeNDAP URLs subsetting on the server side
+(...nc4?precipitation[0:0][1050:1150][449:749],...) or subsetter URLs (...HTTP_services.cgi?FILENAME=...&LABEL=...).
+All the URLs are fetched with one session:
+- Earthdata Login credentials read from ~/.netrc: requests looks up the .netrc entry
+  of the host of each redirect, so ~/.netrc must contain the Earthdata Login host
+  (create_Earthdata_files.py writes it); an Authorization header already set (e.g.
+  session.auth) is also kept on the redirects to and from the Earthdata Login server,
+  where requests would strip it because the host changes
+- the persistent cookie jar ~/.urs_cookies (the one written by create_Earthdata_files.py
+  and used by wget and .dodsrc), so that the login is done once and reused by the next runs
+- a bounded pool of download threads, with retries and exponential backoff
+and each file is streamed to its destination path, derived from its URL
+(<db>/<YYYY>/<file name>), with the resumable download of download_utils.
+The local server of benchmark.py can stand in for Earthdata Login (serve_files with credentials).
+
+'''
+import os
+import re
+import threading
+import requests
+from urllib.parse import urlparse, parse_qs
+
+
+# host of the Earthdata Login server
+urs_host = 'urs.earthdata.nasa.gov'
+
+# cookie jar shared with wget and the OPeNDAP clients (see create_Earthdata_files.py)
+cookie_file = os.path.join(os.path.expanduser('~'), '.urs_cookies')
+
+
+def main():
+
+    # subset list downloaded from the "Subset / Get Data" page of GPM_3IMERGHH_07
+    list_file = 'subset_GPM_3IMERGHH_07_20230101_20230110.txt'
+
+    # destination directory (database=db), files are saved in <db>/<YYYY>/
+    db = '/net/ostro/ITCZ/imerg'
+
+    # number of concurrent downloads
+    n_workers = 8
+
+    ingest_subset_list(list_file, db, n_workers=n_workers)
+
+class EarthdataSession(requests.Session):
+    """
+    Session keeping the authorization header on the redirects between the data
+    servers and the Earthdata Login server, where requests would strip it because
+    the host changes (unless the redirect goes from https to http). Other redirects
+    are handled as by requests, which also sets the credentials of the new host
+    from .netrc (rebuild_auth).
+    """
+    auth_host = urs_host
+
+    def should_strip_auth(self, old_url, new_url):
+        old, new = urlparse(old_url), urlparse(new_url)
+        if self.auth_host in (old.hostname, new.hostname) and new.scheme in (old.scheme, 'https'):
+            return False
+        return super().should_strip_auth(old_url, new_url)
+
+def make_earthdata_session(pool_size=4, cookies=cookie_file, auth_host=urs_host, max_retries=5, backoff_factor=1.):
+    """
+    Create the session used for all the URLs of a run: Earthdata Login credentials from
+    ~/.netrc, persistent cookie jar, connection pool and retries with backoff.
+    Args:
+        pool_size (int): number of connections kept open per host (use the number of download workers).
+        cookies (str): path of the Mozilla-format cookie jar (loaded if it exists, see save_cookies).
+        auth_host (str): host of the Earthdata Login server (a local stand-in for tests).
+        max_retries (int): number of retries of a request.
+        backoff_factor (float): backoff of the retries (s).
+    Returns:
+        session (EarthdataSession): the session.
+    """
+    from http.cookiejar import MozillaCookieJar, LoadError
+    from download_utils import make_session
+
+    session = make_session(pool_size=pool_size, max_retries=max_retries, backoff_factor=backoff_factor,
+                           session_class=EarthdataSession)
+    session.auth_host = auth_host
+
+    jar = MozillaCookieJar(cookies)
+    if os.path.exists(cookies) and os.path.getsize(cookies) > 0:
+        try:
+            jar.load(ignore_discard=True, ignore_expires=True)
+        except LoadError as error:
+            print(f"Cookie jar {cookies} not readable ({error}), starting with an empty one")
+    session.cookies = jar
+
+    return session
+
+def save_cookies(session):
+    """
+    Save the cookies of the session (including the session cookies of Earthdata Login)
+    to its cookie jar, readable only by the user.
+    Args:
+        session (EarthdataSession): session created by make_earthdata_session.
+    """
+    jar = session.cookies
+    jar.save(ignore_discard=True, ignore_expires=True)
+    os.chmod(jar.filename, 0o600)
+
+def read_subset_list(list_file):
+    """
+    Read the URLs of a GES DISC subset list.
+    Args:
+        list_file (str): path of the list (one URL per line).
+    Returns:
+        urls (list): the data URLs (blank lines, comments and documentation links are skipped).
+    """
+    with open(list_file, 'r') as file:
+        lines = [line.strip() for line in file]
+    return [line for line in lines if line.startswith('http') and not line.split('?')[0].endswith('.pdf')]
+
+def destination_path(url, db):
+    """
+    Local path of the file of a subset URL: the file name is the last element of
+    the path (OPeNDAP URLs, the constraint after '?' is dropped) or the LABEL of the
+    subsetter URLs, saved in the folder of its year <db>/<YYYY>/ (as download_v2.sh).
+    Args:
+        url (str): URL of the list.
+        db (str): destination directory.
+    Returns:
+        path (str): destination path of the file.
+    """
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    if 'LABEL' in query:
+        file_name = query['LABEL'][0]
+    else:
+        file_name = os.path.basename(parsed.path)
+
+    # date of the granule in the IMERG file names (3B-HHR.MS.MRG.3IMERG.20240101-S000000-...)
+    date = re.search(r'3IMERG\.(\d{8})', file_name)
+    if date is None:
+        return os.path.join(db, file_name)
+    return os.path.join(db, date.group(1)[:4], file_name)
+
+def ingest_subset_list(list_file, db, n_workers=8, cookies=cookie_file, auth_host=urs_host):
+    """
+    Download all the URLs of a subset list that are not in the destination directory yet.
+    Args:
+        list_file (str): path of the subset list.
+        db (str): destination directory.
+        n_workers (int): number of concurrent downloads.
+        cookies (str): path of the cookie jar.
+        auth_host (str): host of the Earthdata Login server.
+    Returns:
+        failed (list): URLs that could not be downloaded.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from metrics import write_textfile
+
+    urls = read_subset_list(list_file)
+    todo = []
+    for url in urls:
+        path = destination_path(url, db)
+        if os.path.exists(path):
+            print(f"File already exists: {path}")
+            continue
+        todo.append((url, path))
+    print(f"{len(todo)} of {len(urls)} files to download from {list_file}")
+    if len(todo) == 0:
+        return []
+
+    session = make_earthdata_session(pool_size=n_workers, cookies=cookies, auth_host=auth_host)
+    # the first request logs in, the following ones wait for its cookies: the login is
+    # complete when the first request reaches its final response (after the redirects
+    # through Earthdata Login, before the body is downloaded)
+    first = threading.Lock()
+    logged_in = threading.Event()
+
+    def login_complete(response, *args, **kwargs):
+        if not response.is_redirect:
+            logged_in.set()
+
+    session.hooks['response'].append(login_complete)
+
+    def fetch(url_path):
+        url, path = url_path
+        if not logged_in.is_set():
+            if first.acquire(blocking=False):
+                try:
+                    return fetch_url(session, url, path)
+                finally:
+                    # also if the first request failed, the others then log in themselves
+                    logged_in.set()
+            logged_in.wait()
+        return fetch_url(session, url, path)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(fetch, todo))
+    save_cookies(session)
+    session.close()
+    write_textfile()
+
+    failed = [url for (url, path), downloaded in zip(todo, results) if not downloaded]
+    if len(failed) > 0:
+        print(f"{len(failed)} files not downloaded:", *failed, sep='\n')
+    return failed
+
+def fetch_url(session, url, path):
+    """
+    Download one URL of the list to its destination path (resumable, see download_utils.stream_download).
+    Args:
+        session (EarthdataSession): session shared between the download workers.
+        url (str): URL of the file.
+        path (str): destination path.
+    Returns:
+        (bool): True if the file was downloaded, False if it failed (also after a request error).
+    """
+    import requests
+    from download_utils import stream_download
+    from metrics import stage, count
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with stage('subset_download', file=os.path.basename(path)) as record:
+        try:
+            downloaded = stream_download(session, url, path, backoff=1.)
+        except requests.RequestException as error:
+            # retries exhausted (429/5xx) or other request error: the URL is reported as failed
+            print(f"Failed to download {url} ({error})")
+            count('download_failures')
+            downloaded = False
+        record['files'] = int(downloaded)
+        record['bytes'] = os.path.getsize(path) if downloaded else 0
+    if downloaded:
+        print(f"File saved to: {path}")
+    return downloaded
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+'''
+Temporal join of the GridSat 3-hourly slots with the IMERG 30-minute time steps.
+An alignment index is built from the time indexes of the two archives (see time_index.py):
+for every GridSat time in the requested period it lists the IMERG time steps matched
+with one of the modes
+- 'exact': the IMERG time step at the same time (slots without it are skipped)
+- 'nearest': the nearest IMERG time step (within max_distance)
+- 'window-mean': all the IMERG time steps within +/- window, averaged over the valid
+  (non-NaN) steps of each pixel
+The matched pairs are then read as a stream, one GridSat slot at a time, so that
+neither archive is loaded in memory for the whole period.
+
+'''
+import os
+import numpy as np
+from collections import OrderedDict
+
+
+join_modes = ['exact', 'nearest', 'window-mean']
+
+
+def build_alignment(index_geost, index_imerg, start, end, mode='nearest',
+                    window=np.timedelta64(90, 'm'), max_distance=np.timedelta64(30, 'm')):
+    """
+    Build the sorted alignment index between the GridSat and IMERG time steps of a period.
+    Args:
+        index_geost (dict): time index of the GridSat folder.
+        index_imerg (dict): time index of the IMERG folder.
+        start (str): first time in ISO format (e.g. '2024-01-01').
+        end (str): last time in ISO format (e.g. '2024-12-31T23:59').
+        mode (str): one of join_modes.
+        window (numpy.timedelta64): half width of the averaging window ('window-mean').
+        max_distance (numpy.timedelta64): maximum distance of the nearest time step ('nearest').
+    Returns:
+        alignment (list): for each GridSat time step, a tuple (geost entry, list of imerg entries),
+            where entries are [time, file, offset] rows of the time indexes.
+    """
+    if mode not in join_modes:
+        raise ValueError(f"Unknown join mode {mode}, use one of {join_modes}")
+
+    geost_entries = [entry for entry in index_geost['entries'] if start <= entry[0] <= end]
+    imerg_entries = index_imerg['entries']
+    if len(geost_entries) == 0 or len(imerg_entries) == 0:
+        return []
+
+    geost_times = np.array([entry[0] for entry in geost_entries], dtype='datetime64[s]')
+    imerg_times = np.array([entry[0] for entry in imerg_entries], dtype='datetime64[s]')
+
+    # vectorized search of the matching IMERG time steps (the time index is sorted)
+    if mode == 'window-mean':
+        first = np.searchsorted(imerg_times, geost_times - window, side='left')
+        last = np.searchsorted(imerg_times, geost_times + window, side='right')
+    else:
+        position = np.searchsorted(imerg_times, geost_times)
+        before = np.clip(position - 1, 0, len(imerg_times) - 1)
+        after = np.clip(position, 0, len(imerg_times) - 1)
+        nearest = np.where(np.abs(imerg_times[after] - geost_times) < np.abs(geost_times - imerg_times[before]),
+                           after, before)
+        distance = np.abs(imerg_times[nearest] - geost_times)
+        limit = np.timedelta64(0, 's') if mode == 'exact' else max_distance
+        first = nearest
+        last = np.where(distance <= limit, nearest + 1, nearest)
+
+    alignment = [(geost_entry, imerg_entries[i0:i1])
+                 for geost_entry, i0, i1 in zip(geost_entries, first, last) if i1 > i0]
+
+    return alignment
+
+def iterate_pairs(path_geost, path_imerg, start, end, mode='nearest', window=np.timedelta64(90, 'm'),
+                  geost_variables=('irwin_cdr',), imerg_variables=('precipitation',), max_open_files=4, min_valid=1):
+    """
+    Stream the matched GridSat/IMERG pairs of a period, in time order.
+    Only the time steps of each pair are read; a small cache keeps the most recently
+    used files open, so consecutive slots read from the same daily IMERG file open it once.
+    Args:
+        path_geost (str): folder of the cropped GridSat files.
+        path_imerg (str): folder of the cropped IMERG files.
+        start (str): first time in ISO format.
+        end (str): last time in ISO format.
+        mode (str): one of join_modes.
+        window (numpy.timedelta64): half width of the averaging window ('window-mean').
+        geost_variables (tuple): GridSat variables read.
+        imerg_variables (tuple): IMERG variables read.
+        max_open_files (int): number of files kept open.
+        min_valid (int): minimum number of valid IMERG time steps of a pixel in the window ('window-mean'),
+            pixels with fewer valid steps are NaN.
+    Yields:
+        (time, ds_geost, ds_imerg): GridSat time (standard calendar), GridSat slot and matched IMERG
+            data (single time step or window mean), loaded in memory.
+    """
+    import xarray as xr
+    from time_index import update_time_index
+
+    index_geost = update_time_index(path_geost, 'geost')
+    index_imerg = update_time_index(path_imerg, 'imerg')
+    alignment = build_alignment(index_geost, index_imerg, start, end, mode=mode, window=window)
+
+    open_files = OrderedDict()
+    try:
+        for geost_entry, imerg_entries in alignment:
+            time = np.datetime64(geost_entry[0])
+            ds_geost = _read_step(open_files, path_geost, geost_entry, geost_variables, max_open_files)
+            steps = [_read_step(open_files, path_imerg, entry, imerg_variables, max_open_files)
+                     for entry in imerg_entries]
+            if len(steps) == 1:
+                ds_imerg = steps[0]
+            else:
+                stacked = xr.concat([step.drop_vars('time') for step in steps], 'time')
+                # a missing half-hour (NaN) only removes its own step from the mean
+                ds_imerg = stacked.mean('time', skipna=True)
+                ds_imerg = ds_imerg.where(stacked.count('time') >= min_valid)
+                ds_imerg = ds_imerg.assign_coords(time=time)
+            yield time, ds_geost, ds_imerg
+    finally:
+        for ds in open_files.values():
+            ds.close()
+
+def _read_step(open_files, folder, entry, variables, max_open_files):
+    """
+    Read one time step of a time index entry, keeping the file open in a LRU cache.
+    Args:
+        open_files (OrderedDict): open datasets by path, most recently used last.
+        folder (str): folder of the file.
+        entry (list): [time, file, offset] row of the time index.
+        variables (tuple): variables read.
+        max_open_files (int): number of files kept open.
+    Returns:
+        ds_step (xarray.Dataset): the time step (standard calendar time), loaded in memory.
+    """
+    import xarray as xr
+
+    time, file_name, offset = entry
+    path = os.path.join(folder, file_name)
+    if path in open_files:
+        open_files.move_to_end(path)
+    else:
+        open_files[path] = xr.open_dataset(path, use_cftime=True)
+        if len(open_files) > max_open_files:
+            open_files.popitem(last=False)[1].close()
+
+    ds_step = open_files[path][list(variables)].isel(time=offset).load()
+    return ds_step.assign_coords(time=np.datetime64(time))
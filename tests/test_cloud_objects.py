@@ -0,0 +1,44 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+xr = pytest.importorskip('xarray')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('scipy')
+pytest.importorskip('pyarrow')
+
+import cloud_objects
+import temporal_join
+
+
+def _slots(times):
+    """
+    GridSat/IMERG pairs with one cold object at the same place in every slot.
+    """
+    lat = np.arange(20) * 0.07
+    lon = 150. + np.arange(20) * 0.07
+    bt = np.full((20, 20), 280., dtype='float32')
+    bt[5:12, 5:12] = 220.
+    for time in times:
+        ds_geost = xr.Dataset({'irwin_cdr': (('lat', 'lon'), bt)}, coords={'lat': lat, 'lon': lon})
+        ds_imerg = xr.Dataset({'precipitation': (('lat', 'lon'), np.ones((14, 14), dtype='float32'))},
+                              coords={'lat': np.arange(14) * 0.1, 'lon': 150. + np.arange(14) * 0.1})
+        yield time, ds_geost, ds_imerg
+
+
+def test_track_objects_links_slots_and_restarts_after_gap(tmp_path, monkeypatch):
+    # first slot, a slot 3 hours later (linked) and a slot after a gap (not linked)
+    times = np.array(['2024-01-01T00', '2024-01-01T03', '2024-01-01T09'], dtype='datetime64[s]')
+    monkeypatch.setattr(temporal_join, 'iterate_pairs', lambda *args, **kwargs: _slots(times))
+
+    n_objects, n_tracks = cloud_objects.track_objects('geost', 'imerg', '2024-01-01', '2024-01-01T23:59',
+                                                      str(tmp_path), min_area=0.)
+    assert (n_objects, n_tracks) == (3, 2)
+
+    objects = pd.read_parquet(tmp_path / 'objects_part0001.parquet')
+    assert objects['object_id'].tolist() == [1, 2, 3]
+    assert objects['parent_id'].tolist() == [0, 1, 0]
+    assert objects['track_id'].tolist() == [1, 1, 2]
+
+    tracks = pd.read_parquet(tmp_path / 'tracks_part0001.parquet')
+    assert tracks['track_id'].tolist() == [1, 2]
+    assert tracks['n_objects'].tolist() == [2, 1]
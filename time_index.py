@@ -0,0 +1,178 @@
+'''
+Persistent time index of the cropped GridSat and IMERG files.
+The index is a json sidecar file in the archive folder mapping every time step to the
+file containing it and to its position (offset) along the time dimension of the file.
+Times are stored already converted to the standard calendar, so that a nearest-time
+lookup is a binary search in the index and opens exactly one file, decoding one slice,
+instead of opening and converting the calendar of all the files of a day.
+
+The index is updated incrementally: only files that are new or modified since the
+last update are opened.
+
+'''
+import os
+import glob
+import json
+from datetime import datetime
+
+
+# name of the sidecar file in the archive folder
+index_file_name = 'time_index.json'
+
+# default file patterns of the archive folders
+file_patterns = {
+    'geost': 'GRIDSAT-B1.*.nc',
+    'imerg': '*_imerg_30min_ITCZ.nc',
+}
+
+
+def update_time_index(folder, product, index_file=None):
+    """
+    Add to the time index of a folder the files that are new or modified since
+    the last update, and remove the files that do not exist anymore.
+    Args:
+        folder (str): folder of the cropped files.
+        product (str): 'geost' or 'imerg' (selects the file pattern).
+        index_file (str): path of the index (default: folder/time_index.json).
+    Returns:
+        index (dict): the updated index (see load_time_index).
+    """
+    import xarray as xr
+
+    index_file = index_file or os.path.join(folder, index_file_name)
+    index = load_time_index(index_file)
+
+    files = {os.path.basename(path): os.path.getmtime(path)
+             for path in glob.glob(os.path.join(folder, file_patterns[product]))}
+
+    # files to (re)index and files to remove
+    changed = [name for name, mtime in files.items() if index['files'].get(name) != mtime]
+    removed = [name for name in index['files'] if name not in files]
+    if len(changed) == 0 and len(removed) == 0:
+        return index
+
+    dropped = set(changed) | set(removed)
+    entries = [entry for entry in index['entries'] if entry[1] not in dropped]
+    for name in removed:
+        del index['files'][name]
+
+    for name in changed:
+        # only the time coordinate is decoded
+        with xr.open_dataset(os.path.join(folder, name), use_cftime=True) as ds:
+            times = ds['time'].values
+        for offset, time in enumerate(times):
+            entries.append([to_standard_calendar(time).isoformat(), name, offset])
+        index['files'][name] = files[name]
+
+    index['entries'] = sorted(entries)
+    index.pop('_times', None)
+    save_time_index(index, index_file)
+    print(f"Time index updated: {len(changed)} files added, {len(removed)} removed, {len(entries)} time steps")
+
+    return index
+
+def load_time_index(index_file):
+    """
+    Read a time index from its json file (an empty index if the file does not exist).
+    Args:
+        index_file (str): path of the index.
+    Returns:
+        index (dict): 'files' maps each indexed file to its modification time,
+            'entries' is the list of [time (ISO, standard calendar), file, offset] sorted by time.
+    """
+    if not os.path.exists(index_file):
+        return {'files': {}, 'entries': []}
+    with open(index_file, 'r') as file:
+        return json.load(file)
+
+def save_time_index(index, index_file):
+    """
+    Write the time index to a temporary file and rename it, so that readers
+    never see a partially written index.
+    Args:
+        index (dict): the index.
+        index_file (str): path of the index.
+    """
+    with open(index_file + '.tmp', 'w') as file:
+        json.dump({'files': index['files'], 'entries': index['entries']}, file)
+    os.replace(index_file + '.tmp', index_file)
+
+def to_standard_calendar(time):
+    """
+    Convert a time of any calendar (cftime, numpy datetime64) to a python datetime
+    of the standard calendar keeping its date and time components, as
+    convert_calendar('standard', align_on='year') does for the julian calendar of the files.
+    Args:
+        time: time value read from a file.
+    Returns:
+        (datetime.datetime): the same date and time in the standard calendar.
+    """
+    import numpy as np
+
+    if isinstance(time, np.datetime64):
+        return time.astype('datetime64[us]').astype(datetime)
+    return datetime(time.year, time.month, time.day, time.hour, time.minute, time.second)
+
+def lookup_nearest(index, dt):
+    """
+    Find the time step of the index nearest to dt with a binary search.
+    Args:
+        index (dict): the time index.
+        dt (datetime.datetime): requested time (standard calendar).
+    Returns:
+        (time, file_name, offset): ISO time, file and offset of the nearest time step.
+    """
+    return tuple(index['entries'][nearest_position(index, dt)])
+
+def nearest_position(index, dt):
+    """
+    Position in the index of the time step nearest to dt, with a binary search.
+    Args:
+        index (dict): the time index.
+        dt (datetime.datetime): requested time (standard calendar).
+    Returns:
+        position (int): position of the nearest time step in index['entries'].
+    """
+    import bisect
+
+    if len(index['entries']) == 0:
+        raise ValueError('The time index is empty')
+
+    times = _entry_times(index)
+    target = dt.isoformat()
+    position = bisect.bisect_left(times, target)
+    candidates = [i for i in (position - 1, position) if 0 <= i < len(times)]
+    return min(candidates, key=lambda i: abs(datetime.fromisoformat(times[i]) - dt))
+
+def open_nearest(folder, index, dt, drop_variables=None):
+    """
+    Open the time step nearest to dt, reading only the file that contains it.
+    The time coordinate of the returned slice is in the standard calendar.
+    Args:
+        folder (str): folder of the cropped files.
+        index (dict): the time index of the folder.
+        dt (datetime.datetime): requested time (standard calendar).
+        drop_variables (list): variables not to read.
+    Returns:
+        ds_sel (xarray.Dataset): the selected time step, loaded in memory.
+    """
+    import numpy as np
+    import xarray as xr
+
+    time, file_name, offset = lookup_nearest(index, dt)
+    with xr.open_dataset(os.path.join(folder, file_name), drop_variables=drop_variables, use_cftime=True) as ds:
+        ds_sel = ds.isel(time=offset).load()
+
+    return ds_sel.assign_coords(time=np.datetime64(time))
+
+def _entry_times(index):
+    """
+    Sorted list of the ISO times of the index, cached in the index dictionary.
+    Args:
+        index (dict): the time index.
+    Returns:
+        times (list): ISO times of the entries.
+    """
+    if len(index.get('_times', [])) != len(index['entries']):
+        index['_times'] = [entry[0] for entry in index['entries']]
+    return index['_times']
@@ -44,9 +44,11 @@ for url in $(less subset_GPM_3IMERGHH_07_20230101_20230110.txt)
   # Build the full destination file path
   dest_file="$db/$fn"
 
-  wget --load-cookies ~/.urs_cookies --save-cookies ~/.urs_cookies --keep-session-cookies --content-disposition -i $url
+  # streamed to a partial file: -c resumes an interrupted transfer,
+  # the file gets its final name only if wget completed the transfer
+  wget --load-cookies ~/.urs_cookies --save-cookies ~/.urs_cookies --keep-session-cookies -c -O $dest_file.part $url && mv $dest_file.part $dest_file
 
-  #wget --load-cookies ~/.urs_cookies --save-cookies ~/.usr_cookies --auth-no-challenge=on --keep-session-cookies --user=cacquist --content-disposition $url -O $url
+  #wget --load-cookies ~/.urs_cookies --save-cookies ~/.urs_cookies --auth-no-challenge=on --keep-session-cookies --user=cacquist --content-disposition $url -O $url
   #wget --load-cookies ~/.urs_cookies --save-cookies ~/.urs_cookies --keep-session-cookies --content-disposition -i "subset_GPM_3IMERGHH_07_20250409_130513_.txt" -O   $fn
   
 
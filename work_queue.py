@@ -0,0 +1,206 @@
+'''
+Lease-based work queue on the shared filesystem (/data/trade_pc, /net/ostro), so that
+several copies of get_geo_gridsat.py and get_imerg.py, on one or more machines, can
+share the granules (GridSat files, IMERG days) of a run without doing the same work twice.
+For each item the queue folder contains:
+- <item>.lock: the lease of the worker processing the item, created with O_EXCL
+  (only one worker can create it) and touched by a heartbeat thread of the worker
+- <item>.done: written when the item is completed, the item is never claimed again
+A lease whose lock file was not touched for lease_seconds belongs to a dead (or stuck)
+worker: the lock is renamed away by the first worker noticing it, which claims the item.
+The heartbeat also checks that the lock still belongs to the worker, and warns if the
+lease was lost. Leases are compared to the modification time set by the file server,
+keep lease_seconds well above the clock skew between the machines.
+
+'''
+import os
+import json
+import time
+import socket
+import threading
+
+
+def open_queue(queue_folder, lease_seconds=600, worker=None):
+    """
+    Open (and create if needed) a work queue and start the heartbeat of its leases.
+    Args:
+        queue_folder (str): folder of the lock and done files (on the shared filesystem).
+        lease_seconds (float): a lease not renewed for lease_seconds can be taken over.
+        worker (str): name of this worker (default: <host>_<pid>).
+    Returns:
+        work_queue (dict): state of the queue, to pass to claim, mark_done, release and close_queue.
+    """
+    os.makedirs(queue_folder, exist_ok=True)
+    work_queue = {
+        'folder': queue_folder,
+        'lease_seconds': lease_seconds,
+        'worker': worker or f'{socket.gethostname()}_{os.getpid()}',
+        'held': set(),
+        'lock': threading.Lock(),
+        'stop': threading.Event(),
+    }
+    # the leases are renewed several times within lease_seconds
+    thread = threading.Thread(target=_heartbeat, args=(work_queue, lease_seconds / 4),
+                              name='work_queue_heartbeat', daemon=True)
+    thread.start()
+    work_queue['thread'] = thread
+    return work_queue
+
+def claim(work_queue, item):
+    """
+    Try to take the lease of an item.
+    Args:
+        work_queue (dict): queue opened with open_queue.
+        item (str): name of the item (file name or day, must be a valid file name).
+    Returns:
+        (bool): True if this worker holds the lease and must process the item, False if
+            the item is done or leased by another worker.
+    """
+    if is_done(work_queue, item):
+        return False
+    lock_file = _path(work_queue, item, 'lock')
+    for _ in range(2):
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not _take_over_expired(work_queue, item):
+                return False
+            continue
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'worker': work_queue['worker'], 'claimed': time.time()}, file)
+        # the item may have been completed between the check and the creation of the lock
+        if is_done(work_queue, item):
+            os.remove(lock_file)
+            return False
+        with work_queue['lock']:
+            work_queue['held'].add(item)
+        return True
+    return False
+
+def mark_done(work_queue, item):
+    """
+    Record an item as completed and release its lease.
+    Args:
+        work_queue (dict): queue opened with open_queue.
+        item (str): name of the item.
+    """
+    done_file = _path(work_queue, item, 'done')
+    tmp_file = done_file + '.' + work_queue['worker'] + '.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump({'worker': work_queue['worker'], 'done': time.time()}, file)
+    os.replace(tmp_file, done_file)
+    release(work_queue, item)
+
+def release(work_queue, item):
+    """
+    Release the lease of an item that is not completed (e.g. failed), so that
+    another worker (or the next run) can claim it.
+    Args:
+        work_queue (dict): queue opened with open_queue.
+        item (str): name of the item.
+    """
+    with work_queue['lock']:
+        work_queue['held'].discard(item)
+    if _owner(work_queue, item) == work_queue['worker']:
+        try:
+            os.remove(_path(work_queue, item, 'lock'))
+        except FileNotFoundError:
+            pass
+
+def is_done(work_queue, item):
+    """
+    Check if an item was completed by any worker.
+    Args:
+        work_queue (dict): queue opened with open_queue.
+        item (str): name of the item.
+    Returns:
+        (bool): True if the done file of the item exists.
+    """
+    return os.path.exists(_path(work_queue, item, 'done'))
+
+def close_queue(work_queue):
+    """
+    Stop the heartbeat and release the leases still held (items not completed).
+    Args:
+        work_queue (dict): queue opened with open_queue.
+    """
+    work_queue['stop'].set()
+    work_queue['thread'].join()
+    with work_queue['lock']:
+        held = list(work_queue['held'])
+    for item in held:
+        release(work_queue, item)
+
+def _path(work_queue, item, kind):
+    """
+    Path of the lock or done file of an item.
+    """
+    return os.path.join(work_queue['folder'], f'{item}.{kind}')
+
+def _owner(work_queue, item):
+    """
+    Worker holding the lease of an item (None if the item is not leased).
+    """
+    try:
+        with open(_path(work_queue, item, 'lock'), 'r') as file:
+            return json.load(file)['worker']
+    except (FileNotFoundError, ValueError, KeyError):
+        # missing, or just created and not written yet
+        return None
+
+def _take_over_expired(work_queue, item):
+    """
+    Remove the lock of an item if its lease has expired.
+    The lock is renamed to a name of this worker, which only one worker can do. If the
+    renamed file is not the expired lock (it was replaced by a new lease in the
+    meantime), it is linked back to its name.
+    Returns:
+        (bool): True if the lock was removed (or had disappeared) and the item can be claimed.
+    """
+    lock_file = _path(work_queue, item, 'lock')
+    try:
+        expired = os.stat(lock_file)
+    except FileNotFoundError:
+        return True
+    if time.time() - expired.st_mtime < work_queue['lease_seconds']:
+        return False
+
+    stale_file = lock_file + '.' + work_queue['worker'] + '.stale'
+    try:
+        os.rename(lock_file, stale_file)
+    except FileNotFoundError:
+        # taken over by another worker
+        return False
+    if os.stat(stale_file).st_ino != expired.st_ino:
+        try:
+            os.link(stale_file, lock_file)
+        except FileExistsError:
+            pass
+        os.remove(stale_file)
+        return False
+    try:
+        with open(stale_file, 'r') as file:
+            previous = json.load(file).get('worker')
+    except ValueError:
+        previous = None
+    os.remove(stale_file)
+    print(f"Lease of {item} held by {previous} expired, taken over by {work_queue['worker']}")
+    return True
+
+def _heartbeat(work_queue, interval):
+    """
+    Renew the leases held by the worker every interval seconds until the queue is closed.
+    """
+    while not work_queue['stop'].wait(interval):
+        with work_queue['lock']:
+            held = list(work_queue['held'])
+        for item in held:
+            if _owner(work_queue, item) != work_queue['worker']:
+                print(f"Lease of {item} lost by {work_queue['worker']}")
+                with work_queue['lock']:
+                    work_queue['held'].discard(item)
+                continue
+            try:
+                os.utime(_path(work_queue, item, 'lock'))
+            except FileNotFoundError:
+                pass
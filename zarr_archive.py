@@ -0,0 +1,268 @@
+'''
+Consolidated, time-appendable Zarr archive of the cropped GridSat and IMERG data.
+Instead of thousands of small netCDF files (one per GridSat 3-hourly slot and one per
+IMERG day), each product is stored in a single chunked Zarr store with consolidated
+metadata, so that opening one year reads a single metadata file.
+
+Cropped files produced by get_geo_gridsat and get_imerg are added with ingest_files; the
+files already ingested are recorded in the store (ingested_files.json) and are not opened
+again. Files later than the store are appended, files arriving late (retried downloads,
+several workers) are inserted in time order. The archive is opened with open_archive.
+
+'''
+import os
+import glob
+
+
+# default stores of the 2024 ITCZ archive
+archive_stores = {
+    'geost': '/data/trade_pc/ITCZ/2024/geost.zarr',
+    'imerg': '/data/trade_pc/ITCZ/2024/imerg.zarr',
+}
+
+# chunk shapes of the stores: one day along time and blocks of about 1/3 x 1/3 of the
+# ITCZ domain in space. A map reads 9 chunks of a single day, a time series at one
+# point of one year reads 366 small chunks instead of every file of the year.
+archive_chunks = {
+    'geost': {'time': 8, 'lat': 143, 'lon': 386},   # 3-hourly, 0.07 deg grid (429 x 1157)
+    'imerg': {'time': 48, 'lon': 270, 'lat': 100},  # 30 min, 0.1 deg grid (810 x 300)
+    'collocated': {'time': 8, 'lat': 100, 'lon': 270},  # GridSat times on the IMERG grid (see collocation.py)
+}
+
+# encoding keys of the netCDF files that are kept when writing to zarr
+_kept_encoding = ['dtype', 'scale_factor', 'add_offset', '_FillValue', 'units', 'calendar']
+
+
+def ingest_files(file_list, product, store=None):
+    """
+    Add cropped netCDF files to the Zarr store of a product.
+    The files recorded as ingested (same modification time) are skipped, so the function
+    can be called again on the whole list of files of the archive. The files later than
+    the last time of the store are appended in time order, the others (late or rewritten
+    files) are inserted with insert_times.
+    Args:
+        file_list (list): paths of the cropped netCDF files.
+        product (str): 'geost' or 'imerg'.
+        store (str): path of the Zarr store (default: archive_stores[product]).
+    Returns:
+        n_times (int): number of time steps added or rewritten.
+    """
+    import numpy as np
+    import xarray as xr
+
+    store = store or archive_stores[product]
+
+    last_time = None
+    store_times = None
+    ingested = _load_ingested(store)
+    if os.path.exists(store):
+        store_times = open_archive(product, store).time.values
+        last_time = store_times[-1]
+    # stores written before the record: the files whose time steps are all in the store
+    # are recorded without being written again
+    seed = store_times is not None and len(ingested) == 0
+
+    n_times = 0
+    late = {}
+    for file_name in sorted(file_list):
+        name = os.path.basename(file_name)
+        mtime = os.path.getmtime(file_name)
+        if ingested.get(name) == mtime:
+            continue
+        with xr.open_dataset(file_name) as ds:
+            if seed and np.isin(ds.time.values, store_times).all():
+                ingested[name] = mtime
+                continue
+            if last_time is not None and ds.time.values[0] <= last_time:
+                late[name] = (mtime, ds.load())
+                continue
+            append_to_archive(ds.load(), product, store)
+            last_time = ds.time.values[-1]
+            n_times += ds.sizes['time']
+        ingested[name] = mtime
+        print(f"Appended to {store}: {file_name}")
+
+    if len(late) > 0:
+        ds_late = xr.concat([ds for mtime, ds in late.values()], 'time').sortby('time')
+        n_times += insert_times(ds_late, product, store)
+        ingested.update({name: mtime for name, (mtime, ds) in late.items()})
+        print(f"Inserted in {store}: {', '.join(sorted(late))}")
+
+    # a run stopped before the record is saved only writes the same time steps again
+    _save_ingested(store, ingested)
+    return n_times
+
+def ingest_folder(folder, product, pattern=None, store=None):
+    """
+    Append all the cropped files of a folder to the Zarr store of a product.
+    Args:
+        folder (str): folder of the cropped netCDF files.
+        product (str): 'geost' or 'imerg'.
+        pattern (str): glob pattern of the files (default: all the files of the product).
+        store (str): path of the Zarr store (default: archive_stores[product]).
+    Returns:
+        n_times (int): number of time steps appended.
+    """
+    if pattern is None:
+        pattern = 'GRIDSAT-B1.*.nc' if product == 'geost' else '*_imerg_30min_ITCZ.nc'
+    return ingest_files(glob.glob(os.path.join(folder, pattern)), product, store)
+
+def append_to_archive(ds, product, store=None):
+    """
+    Append the time steps of a dataset to the Zarr store of a product, creating the
+    store with the chunk shapes of archive_chunks if it does not exist yet.
+    The consolidated metadata are updated at each append.
+    Args:
+        ds (xarray.Dataset): cropped dataset with a time dimension (loaded in memory).
+        product (str): 'geost' or 'imerg'.
+        store (str): path of the Zarr store (default: archive_stores[product]).
+    """
+    store = store or archive_stores[product]
+
+    if not os.path.exists(store):
+        ds.to_zarr(store, mode='w', consolidated=True,
+                   encoding=_zarr_encoding(ds, archive_chunks[product]))
+        return
+
+    # variables without time (e.g. lat_bnds) are written only when the store is created
+    ds = ds.drop_vars([name for name in ds.data_vars if 'time' not in ds[name].dims])
+    for name in ds.variables:
+        ds[name].encoding = {}
+    ds.to_zarr(store, mode='a', append_dim='time', consolidated=True)
+
+def insert_times(ds, product, store=None):
+    """
+    Insert time steps that are not later than the last time of the store, keeping the
+    time axis sorted. Time steps already in the store are overwritten in place (region
+    write). For the missing ones, the time steps of the store from the first insertion
+    are merged with the new ones: the store is extended by the number of new steps, then
+    the merged steps are written by blocks from the end of the store backwards, so that
+    each block of the store is read before it is overwritten. The rewrite is not atomic,
+    a run stopped during it must be followed by a rebuild of the store.
+    Args:
+        ds (xarray.Dataset): time steps to insert (loaded in memory, sorted by time).
+        product (str): 'geost' or 'imerg'.
+        store (str): path of the Zarr store (default: archive_stores[product]).
+    Returns:
+        n_times (int): number of time steps written.
+    """
+    import numpy as np
+    import xarray as xr
+
+    store = store or archive_stores[product]
+
+    def time_variables(ds):
+        # region writes only take the variables with time
+        ds = ds.drop_vars([name for name in ds.variables if 'time' not in ds[name].dims])
+        for name in ds.variables:
+            ds[name].encoding = {}
+        return ds
+
+    ds = time_variables(ds)
+    archive = time_variables(open_archive(product, store))
+    times = archive.time.values
+    n_store = len(times)
+    position = np.searchsorted(times, ds.time.values)
+    existing = times[np.minimum(position, n_store - 1)] == ds.time.values
+
+    # overwrite the time steps already in the store
+    for i in np.flatnonzero(existing):
+        ds.isel(time=[i]).to_zarr(store, region={'time': slice(int(position[i]), int(position[i]) + 1)})
+
+    new = ds.isel(time=np.flatnonzero(~existing))
+    n_new = new.sizes['time']
+    if n_new == 0:
+        return int(existing.sum())
+
+    # source of each time step of the merged tail: index in the store (>= 0) or in new (< 0)
+    first = int(position[~existing][0])
+    tail_times = np.concatenate([times[first:], new.time.values])
+    source = np.concatenate([np.arange(first, n_store), -1 - np.arange(n_new)])[np.argsort(tail_times, kind='stable')]
+
+    def merged(start, stop):
+        block = source[start - first:stop - first]
+        parts = []
+        if (block >= 0).any():
+            parts.append(archive.isel(time=block[block >= 0]).load())
+        if (block < 0).any():
+            parts.append(new.isel(time=-1 - block[block < 0]))
+        return xr.concat(parts, 'time').sortby('time')
+
+    # extend the store with the last merged steps, then shift the others by blocks of chunks
+    append_to_archive(merged(n_store, n_store + n_new), product, store)
+    step = archive_chunks[product]['time']
+    for stop in range(n_store, first, -step):
+        start = max(first, stop - step)
+        merged(start, stop).to_zarr(store, region={'time': slice(start, stop)})
+
+    return int(existing.sum()) + n_new
+
+def open_archive(product, store=None):
+    """
+    Open the Zarr store of a product lazily, reading only the consolidated metadata.
+    Args:
+        product (str): 'geost' or 'imerg'.
+        store (str): path of the Zarr store (default: archive_stores[product]).
+    Returns:
+        ds (xarray.Dataset): the whole archive of the product.
+    """
+    import xarray as xr
+
+    store = store or archive_stores[product]
+    return xr.open_zarr(store, consolidated=True)
+
+def _load_ingested(store):
+    """
+    Read the record of the files ingested in a store.
+    Args:
+        store (str): path of the Zarr store.
+    Returns:
+        ingested (dict): {file name: modification time} (empty for a new store).
+    """
+    import json
+
+    record_file = os.path.join(store, 'ingested_files.json')
+    if not os.path.exists(record_file):
+        return {}
+    with open(record_file, 'r') as file:
+        return json.load(file)
+
+def _save_ingested(store, ingested):
+    """
+    Write the record of the files ingested in a store.
+    Args:
+        store (str): path of the Zarr store.
+        ingested (dict): {file name: modification time}.
+    """
+    import json
+
+    if not os.path.exists(store):
+        return
+    record_file = os.path.join(store, 'ingested_files.json')
+    with open(record_file + '.tmp', 'w') as file:
+        json.dump(ingested, file)
+    os.replace(record_file + '.tmp', record_file)
+
+def _zarr_encoding(ds, chunks):
+    """
+    Build the encoding of a new store: keep the packing and time encoding of the
+    source files, drop the netCDF specific ones (zlib, chunksizes, ...) and set the chunks.
+    Args:
+        ds (xarray.Dataset): dataset written to the new store.
+        chunks (dict): chunk size for each dimension.
+    Returns:
+        encoding (dict): encoding for each variable.
+    """
+    encoding = {}
+    for name in ds.variables:
+        var_encoding = {key: value for key, value in ds[name].encoding.items() if key in _kept_encoding}
+        if name in ds.data_vars:
+            var_encoding['chunks'] = tuple(min(chunks.get(dim, size), size)
+                                           for dim, size in zip(ds[name].dims, ds[name].shape))
+            if 'time' in ds[name].dims:
+                # the time chunk is not limited by the size of the first file
+                time_axis = ds[name].dims.index('time')
+                var_encoding['chunks'] = tuple(chunks['time'] if axis == time_axis else size
+                                               for axis, size in enumerate(var_encoding['chunks']))
+        encoding[name] = var_encoding
+    return encoding